@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark: Timing and comparison of Pangloss components against the tools or code they replace.
+
+Each benchmark is run as a subcommand on the output of an earlier Pangloss run, e.g.:
+
+    ./Benchmark.py orf gm_pred/td/genomes/STRAIN.fna/ --min_len 100
+    ./Benchmark.py gtf gm_pred/gmes/genomes/STRAIN.fna/genemark.gtf --format gtf
+    ./Benchmark.py gtf synthetic.gtf --synthetic 500000
+    ./Benchmark.py fasta gm_pred/sets/allprot.db
+    ./Benchmark.py fasta synthetic.faa --synthetic 300000
+    ./Benchmark.py exonerate genomes/STRAIN.fna ref_prot.faa --exonerate /usr/bin/exonerate
+
+Subcommands:
+    orf - Built-in ORF caller vs. TransDecoder, on a genome's NCR.fna and TransDecoder output.
+    gtf - Streaming GTF/GFF3 parser throughput and peak memory, on any GTF or GFF3 file.
+    fasta - FASTA module vs. Bio.SeqIO for reading, indexing and writing, on any FASTA file.
+    exonerate - Gene models read from Exonerate's --ryo output vs. its alignment output (as read by
+                earlier versions through Bio.SearchIO), on any genome and reference proteins.
+"""
+
+import os
+import random
+import resource
+import shutil
+import subprocess as sp
+import tempfile
+import time
+from argparse import ArgumentParser
+from csv import reader
+
+from Pangloss.FASTA import FASTAId, FASTAIndex, ReadFASTA, WriteFASTA
+from Pangloss.GTF import ParseGeneRecords
+
+
+def ReadCDSCalls(gff3):
+    """
+    Return dictionary of NCR IDs to (strand, start, end) of their CDS in a TransDecoder GFF3 file.
+    """
+    calls = {}
+    for row in reader(open(gff3), delimiter="\t"):
+        if len(row) == 9 and row[2] == "CDS":
+            calls[row[0]] = (row[6], int(row[3]), int(row[4]))
+    return calls
+
+
+def CompareCalls(first, second):
+    """
+    Count NCRs where two sets of calls (from ReadCDSCalls) are identical, overlap on the same
+    strand, disagree, or only have a call in one set.
+    """
+    counts = {"identical": 0, "overlapping": 0, "different": 0, "first only": 0, "second only": 0}
+    for ncr in set(first) | set(second):
+        if ncr not in second:
+            counts["first only"] += 1
+        elif ncr not in first:
+            counts["second only"] += 1
+        elif first[ncr] == second[ncr]:
+            counts["identical"] += 1
+        elif first[ncr][0] == second[ncr][0] and first[ncr][1] <= second[ncr][2] and second[ncr][1] <= first[ncr][2]:
+            counts["overlapping"] += 1
+        else:
+            counts["different"] += 1
+    return counts
+
+
+def BenchmarkORF(tdir, min_len):
+    """
+    Run the built-in ORF caller on a genome's NCRs and compare its calls with TransDecoder's.
+    """
+    # Imported here so that NumPy is only needed for this benchmark.
+    from Pangloss import ORF
+
+    # Run built-in caller on a copy of NCRs, so TransDecoder output isn't overwritten.
+    tmp = tempfile.mkdtemp()
+    try:
+        ncr = "{0}/NCR.fna".format(tmp)
+        shutil.copy("{0}/NCR.fna".format(tdir), ncr)
+        start = time.time()
+        count = ORF.CallORFs(ncr, min_len)
+        elapsed = time.time() - start
+        builtin = ReadCDSCalls(ncr + ".transdecoder.gff3")
+    finally:
+        shutil.rmtree(tmp)
+    transdecoder = ReadCDSCalls("{0}/NCR.fna.transdecoder.gff3".format(tdir))
+
+    # Report timing and agreement.
+    counts = CompareCalls(transdecoder, builtin)
+    print "Built-in ORF caller: {0} ORFs called in {1:.2f} seconds.".format(count, elapsed)
+    print "TransDecoder calls: {0}".format(len(transdecoder))
+    print "Identical CDS: {0}".format(counts["identical"])
+    print "Overlapping CDS on same strand: {0}".format(counts["overlapping"])
+    print "Different CDS: {0}".format(counts["different"])
+    print "TransDecoder only: {0}".format(counts["first only"])
+    print "Built-in only: {0}".format(counts["second only"])
+
+
+def WriteSyntheticGTF(path, genes):
+    """
+    Write a GeneMark-style GTF file with the given number of three-exon genes, spread over
+    contigs of 1000 genes each (roughly 550 MB per million genes).
+    """
+    with open(path, "w") as outfile:
+        for gene in range(genes):
+            contig = "contig_{0}".format(gene // 1000)
+            start = (gene % 1000) * 3000 + 1
+            attributes = "gene_id \"{0}_g\"; transcript_id \"{0}_t\";".format(gene + 1)
+            for exon in range(3):
+                left = start + exon * 900
+                for feature in ["exon", "CDS"]:
+                    outfile.write("\t".join([contig, "GeneMark.hmm", feature, str(left), str(left + 599),
+                                             ".", "+", "0", attributes]) + "\n")
+
+
+def BenchmarkGTF(path, fmt, synthetic=None):
+    """
+    Time streaming a GTF/GFF3 file into gene records, and report peak memory use. If a number
+    of synthetic genes is given, a GTF file of that many genes is written to the path first.
+    """
+    if synthetic:
+        WriteSyntheticGTF(path, synthetic)
+    start = time.time()
+    genes = 0
+    exons = 0
+    for gene in ParseGeneRecords(path, fmt):
+        genes += 1
+        exons += gene.exons
+    elapsed = time.time() - start
+    size = os.path.getsize(path) / 1048576.0
+    print "Parsed {0} genes ({1} exons) from {2:.1f} MB in {3:.2f} seconds ({4:.1f} MB/s).".format(
+        genes, exons, size, elapsed, size / elapsed if elapsed else 0)
+    print "Peak memory: {0:.1f} MB".format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0)
+
+
+def WriteSyntheticFASTA(path, proteins):
+    """
+    Write a FASTA file of the given number of random proteins, 100 to 1000 residues long, with
+    gene model style headers (roughly 170 MB per 300,000 proteins).
+    """
+    # Proteins are random slices of a pool of random residues, which is much faster than
+    # generating every protein residue by residue.
+    random.seed(0)
+    pool = "".join(random.choice("ACDEFGHIKLMNPQRSTVWY") for _ in range(1048576))
+
+    def Proteins():
+        for protein in range(proteins):
+            offset = random.randint(0, len(pool) - 1000)
+            yield ("STRAIN{0}|contig_{1}_{2}_{3}".format(protein % 40, protein // 1000, protein, protein + 999),
+                   pool[offset:offset + random.randint(100, 1000)])
+    with open(path, "w") as outfile:
+        WriteFASTA(outfile, Proteins())
+
+
+def TimeStep(name, step, baseline=None):
+    """
+    Run a benchmark step, print its run time (and speed-up over a baseline time, if given) and
+    return the run time.
+    """
+    start = time.time()
+    step()
+    elapsed = time.time() - start
+    if baseline:
+        print "{0}: {1:.2f} seconds ({2:.1f}x)".format(name, elapsed, baseline / elapsed if elapsed else 0)
+    else:
+        print "{0}: {1:.2f} seconds".format(name, elapsed)
+    return elapsed
+
+
+def BenchmarkFASTA(path, synthetic=None):
+    """
+    Time a full pass over, indexed lookup of every record in, and writing out of a FASTA file with
+    Bio.SeqIO and with the FASTA module. If a number of synthetic proteins is given, a FASTA file
+    of that many proteins is written to the path first.
+    """
+    # Imported here so that Biopython is only needed for this benchmark.
+    from Bio import SeqIO
+
+    if synthetic:
+        WriteSyntheticFASTA(path, synthetic)
+    records = list(ReadFASTA(path, use_mmap=True))
+    ids = [FASTAId(header) for header, _ in records]
+    print "{0} records, {1:.1f} MB.".format(len(records), os.path.getsize(path) / 1048576.0)
+
+    # Full pass over (ID, sequence) of every record.
+    def SeqIOParse():
+        for seq in SeqIO.parse(open(path), "fasta"):
+            seq.id, str(seq.seq)
+    baseline = TimeStep("Bio.SeqIO.parse", SeqIOParse)
+    TimeStep("ReadFASTA (buffered)", lambda: [FASTAId(header) for header, _ in ReadFASTA(path)], baseline)
+    TimeStep("ReadFASTA (mmap)", lambda: [FASTAId(header) for header, _ in ReadFASTA(path, use_mmap=True)], baseline)
+
+    # Index file and fetch every record by ID.
+    def SeqIOIndex():
+        index = SeqIO.index(path, "fasta")
+        for record_id in ids:
+            str(index[record_id].seq)
+        index.close()
+
+    def FASTAModuleIndex():
+        index = FASTAIndex(path)
+        for record_id in ids:
+            index[record_id]
+        index.Close()
+    baseline = TimeStep("Bio.SeqIO.index + lookups", SeqIOIndex)
+    TimeStep("FASTAIndex + lookups", FASTAModuleIndex, baseline)
+
+    # Write every record to a temporary file.
+    tmp = tempfile.mkdtemp()
+    try:
+        seq_records = list(SeqIO.parse(open(path), "fasta"))
+
+        def FASTAModuleWrite():
+            with open("{0}/fasta.fa".format(tmp), "w") as outfile:
+                WriteFASTA(outfile, records)
+        baseline = TimeStep("Bio.SeqIO.write", lambda: SeqIO.write(seq_records, "{0}/seqio.fa".format(tmp), "fasta"))
+        TimeStep("WriteFASTA", FASTAModuleWrite, baseline)
+        same = open("{0}/seqio.fa".format(tmp)).read() == open("{0}/fasta.fa".format(tmp)).read()
+        print "Written files identical: {0}".format(same)
+    finally:
+        shutil.rmtree(tmp)
+
+
+def SearchIOGenes(path):
+    """
+    Return dictionary of query IDs to (contig ID, locs, protein, nucleotides, internal stop, introns)
+    of their first hit in Exonerate's alignment and vulgar output, read as by earlier versions of
+    ExonerateGene. Placeholders for gaps and split codons (X, ---) are left out of the sequences.
+    """
+    # Imported here so that Bio.SearchIO is only needed for this benchmark.
+    from Bio import SearchIO
+
+    genes = {}
+    for result in SearchIO.parse(path, "exonerate-text"):
+        hit = result[0]
+        prot = []
+        nucl = []
+        stop = False
+        for fragment in hit[0].fragments:
+            for record in fragment.aln._records:
+                if record.name == "aligned hit sequence":
+                    seq = str(record.seq)
+                    if seq.startswith("X"):
+                        prot.append(seq[1:])
+                    elif seq.endswith("X"):
+                        prot.append(seq[:-1])
+                    else:
+                        prot.append(seq)
+                    if "*" in record.seq[:-1]:
+                        stop = True
+            nucl.append("".join(codon for codon in fragment.aln_annotation["hit_annotation"] if len(codon) == 3))
+        genes[result.id] = [hit.id, None, "".join(prot).replace("X", ""), "".join(nucl).replace("-", "").upper(),
+                            "IS={0}".format(stop), "Introns={0}".format(len(hit[0].hit_inter_ranges))]
+    for result in SearchIO.parse(path, "exonerate-vulgar"):
+        genes[result.id][1] = result[0][0].hit_range
+    return dict((query, tuple(gene)) for query, gene in genes.items())
+
+
+def BenchmarkExonerate(ex_path, genome, queries):
+    """
+    Run Exonerate on a genome and reference proteins with --ryo output (as PanGuess does) and with
+    alignment output (as earlier versions did), and compare the gene models read from each.
+    """
+    # Imported here so that Biopython is only needed for this benchmark.
+    from Pangloss.ExonerateGene import ParseExonerateOutput
+    from Pangloss.PanGuess import ExonerateCmd
+
+    # Alignment output is Exonerate's default, so is run without the output options.
+    ryo_cmd = ExonerateCmd(ex_path, genome, queries)
+    aln_cmd = ryo_cmd[:ryo_cmd.index("--showalignment")]
+
+    tmp = tempfile.mkdtemp()
+    try:
+        # Run Exonerate with both output formats.
+        ryo = "{0}/ryo.exn".format(tmp)
+        aln = "{0}/aln.exn".format(tmp)
+        with open(ryo, "w") as outfile:
+            baseline = TimeStep("Exonerate (--ryo output)", lambda: sp.check_call(ryo_cmd, stdout=outfile))
+        with open(aln, "w") as outfile:
+            TimeStep("Exonerate (alignment output)", lambda: sp.check_call(aln_cmd, stdout=outfile), baseline)
+
+        # Read gene models from each.
+        new = {}
+        for gene in ParseExonerateOutput(open(ryo)):
+            new[gene.ref.split("=", 1)[1]] = (gene.contig_id, gene.locs, gene.prot, gene.nucl.upper(),
+                                              gene.internal_stop, gene.introns)
+        old = SearchIOGenes(aln)
+    finally:
+        shutil.rmtree(tmp)
+
+    # Report agreement, field by field.
+    fields = ["contig", "location", "protein", "nucleotides", "internal stop", "introns"]
+    diffs = dict((field, 0) for field in fields)
+    for query in set(new) & set(old):
+        for i, field in enumerate(fields):
+            if new[query][i] != old[query][i]:
+                diffs[field] += 1
+                print "{0}: {1} differs ({2} vs. {3}).".format(query, field, new[query][i], old[query][i])
+    print "Gene models from both outputs: {0}".format(len(set(new) & set(old)))
+    print "--ryo output only: {0}".format(len(set(new) - set(old)))
+    print "Alignment output only: {0}".format(len(set(old) - set(new)))
+    for field in fields:
+        print "Differing {0}: {1}".format(field, diffs[field])
+
+
+def CmdLineParser():
+    """
+    Create and return a command line parser with a subcommand per benchmark.
+    """
+    ap = ArgumentParser(description="Benchmarks for Pangloss components.")
+    subparsers = ap.add_subparsers(dest="benchmark")
+
+    # Built-in ORF caller vs. TransDecoder.
+    orf = subparsers.add_parser("orf", help="Compare built-in ORF caller with TransDecoder.")
+    orf.add_argument("tdir", help="TransDecoder directory of a genome from a previous run (gm_pred/td/<genome>).")
+    orf.add_argument("--min_len", type=int, default=100, help="Minimum protein length (trans_aa_length).")
+
+    # Streaming GTF/GFF3 parser.
+    gtf = subparsers.add_parser("gtf", help="Time streaming GTF/GFF3 parser.")
+    gtf.add_argument("path", help="GTF or GFF3 file (e.g. genemark.gtf or NCR.fna.transdecoder.gff3).")
+    gtf.add_argument("--format", choices=["gtf", "gff3"], default="gtf", help="File format.")
+    gtf.add_argument("--synthetic", type=int, help="Write a GTF file of this many synthetic genes to path first.")
+
+    # FASTA module vs. Bio.SeqIO.
+    fasta = subparsers.add_parser("fasta", help="Time FASTA module against Bio.SeqIO.")
+    fasta.add_argument("path", help="FASTA file (e.g. gm_pred/sets/allprot.db).")
+    fasta.add_argument("--synthetic", type=int, help="Write a FASTA file of this many random proteins to path first.")
+
+    # Exonerate --ryo output vs. alignment output.
+    exonerate = subparsers.add_parser("exonerate", help="Compare gene models read from Exonerate's two output formats.")
+    exonerate.add_argument("genome", help="Genome FASTA file.")
+    exonerate.add_argument("queries", help="Reference protein FASTA file.")
+    exonerate.add_argument("--exonerate", default="exonerate", help="Path of Exonerate.")
+
+    return ap.parse_args()
+
+
+def main():
+    """
+    Main function.
+    """
+    ap = CmdLineParser()
+    if ap.benchmark == "orf":
+        BenchmarkORF(os.path.abspath(ap.tdir), ap.min_len)
+    elif ap.benchmark == "gtf":
+        BenchmarkGTF(ap.path, ap.format, ap.synthetic)
+    elif ap.benchmark == "fasta":
+        BenchmarkFASTA(ap.path, ap.synthetic)
+    elif ap.benchmark == "exonerate":
+        BenchmarkExonerate(ap.exonerate, ap.genome, ap.queries)
+
+
+if __name__ == "__main__":
+    main()
@@ -12,6 +12,54 @@ To-do:
     - Improve logging.
 
 Recent changes:
+    v0.10.0 (in development)
+    - Added batched Exonerate searches (exonerate_batch_size in config file).
+    - Added tblastn-seeded Exonerate searches over padded genomic windows (exonerate_seed_search).
+    - Added concurrent gene model prediction of several genomes in sandbox directories (parallel_genomes).
+    - Exonerate results are now read in one pass from a custom --ryo format into a compact ExonerateGene.
+    - Added exonerate-server mode with a prebuilt genome index (exonerate_server).
+    - Exonerate results are journalled to disk as they finish, and restarted runs pick up from the journal.
+    - Exonerate searches now run longest-first, with optional timeouts and retries (exonerate_timeout).
+    - Added CD-HIT clustering of reference proteins, searching cluster representatives only (reference_cluster_identity).
+    - Merging of gene model calls now resolves all overlaps on a contig at once, via a per-contig interval index.
+    - Non-coding regions are now extracted contig by contig from an indexed genome straight to NCR.fna.
+    - Added a cache of per-genome gene model predictions, keyed on genome, reference set, tools and options
+      (prediction_cache).
+    - Added reuse of a GeneMark-ES model trained once on a single genome for all others (genemark_reuse_model).
+    - Added sharding of non-coding regions across parallel TransDecoder runs (transdecoder_shards).
+    - Added a built-in NumPy ORF caller as a faster alternative to TransDecoder (ncr_orf_caller).
+    - GeneMark-ES gene model sequences are now extracted in Python, replacing get_sequence_from_GTF.pl.
+    - GeneMark-ES and TransDecoder output is now read through a streaming GTF/GFF3 parser (see GTF.py).
+    - Temporary GeneMark-ES and TransDecoder folders can be compressed in the background with pigz or zstd
+      (compress_temp_dirs).
+    - Gene model sets are now loaded once into an indexed SQLite store (gm_pred/sets/genemodels.sqlite), used
+      by QC, cluster FASTA extraction and karyotype plots in place of re-parsing the text files. Strains
+      without their own gene model set files (e.g. with --no_pred) are loaded from allprot.db, allnucl.db
+      and allatt.db.
+    - Genomes are imported once into a memory-mapped genome store (gm_pred/genomes), which serves contig
+      lengths and slices to PanGuess and Karyotype in place of re-parsing the FASTA files.
+    - Added a lightweight FASTA reader, writer and offset index (see FASTA.py), used in place of Bio.SeqIO
+      wherever only headers and sequences are needed, with a benchmark (Benchmark.py fasta).
+    - Genomes, reference proteins and other input files can be gzip/bgzip compressed, and all-vs.-all BLASTp
+      results can be written compressed (compress_output), which PanOCT now reads directly. Compressed inputs
+      are streamed wherever possible (genome stores, makeblastdb/tblastn, PanOCT), and only decompressed into
+      gm_pred/staged while Exonerate, GeneMark-ES, CD-HIT or QC BLASTp searches need a plain file. Gene model
+      sets and concatenated datasets (allprot.db &c.) stay uncompressed, as they're memory-mapped or handed
+      to makeblastdb, which can't read them compressed from a file.
+    - Concatenated datasets and BLAST databases are only rebuilt when the gene model sets they're built from
+      change, tracked by content hashes in gm_pred/sets/manifest.json.
+    - Cluster sequences are now written to one packed, indexed archive per component and sequence type
+      (panoct/clusters/core.fna &c., see ClusterArchive.py) instead of one FASTA file per cluster, with
+      --export_clusters to write individual files. yn00 results are written to panoct/clusters/yn00.
+    - Refined cluster archives are written as a diff against the unrefined ones, sharing unchanged clusters.
+      yn00 results are recorded with a fingerprint of each cluster's members and sequences and reused for
+      clusters that haven't changed since, whether from an earlier run on the same clusters or, for refined
+      clusters, from an earlier --yn00 run on the unrefined clusters (so running --yn00 and then
+      --refine --yn00 only runs yn00 on clusters changed by gap filling). Results of clusters that no
+      longer exist are removed before summarizing.
+    - All-vs.-all BLASTp queries are now run in chunks, one multi-threaded blastp process per chunk, with
+      workers and threads balanced against run_threads (blast_chunk_size, blast_threads).
+
     v0.9.1 (August 2019)
     - Fixes to how Pangloss reads in config file.
     - Made Pangloss.py executable.
@@ -83,20 +131,29 @@ Recent changes:
 
 import logging
 import os
+import shutil
 import sys
+import threading
 import multiprocessing as mp
-from Bio.Data.CodonTable import TranslationError
 from ConfigParser import SafeConfigParser
+from Queue import Queue
 from datetime import datetime
 from argparse import ArgumentParser
 from glob import glob
 
 from Pangloss import BLASTAll, BUSCO, GO, Karyotype, PAML, PanGuess, PanOCT, QualityCheck, Size, UpSet
-from Pangloss.Tools import ConcatenateDatasets, CheckGeneMarkLicence
+from Pangloss.ClusterArchive import ExportClusters
+from Pangloss.GeneModelStore import GeneModelStore
+from Pangloss.Tools import ConcatenateDatasets, CheckGeneMarkLicence, GenomeTags, HashFile, ReleaseInput, \
+                          StageInput, TryMkDirs
 
 
 def PanGuessHandler(ex_path, gm_path, tp_path, tl_path,
-                    genomelist, workdir, ref, gm_branch, td_len, cores=None, skip=False):
+                    genomelist, workdir, ref, gm_branch, td_len, cores=None, batch_size=None,
+                    seed_search=None, seed_pad=None, parallel=None, server=None, timeout=None, retry_model=None,
+                    cluster_identity=None, cache=None, gm_reuse=None, gm_training=None, td_shards=None,
+                    orf_caller=None, compressor=None, cd_path="cd-hit", mb_path="makeblastdb", tn_path="tblastn",
+                    skip=False):
     """
     Runs PanGuess from master script.
 
@@ -105,6 +162,9 @@ def PanGuessHandler(ex_path, gm_path, tp_path, tl_path,
         gm_path      = GeneMark-ES path.
         tp_path      = TransDecoder.Predict path.
         tl_path      = TransDecoder.LongOrfs path.
+        cd_path      = CD-HIT path (optional, defaults to cd-hit).
+        mb_path      = makeblastdb path (optional, defaults to makeblastdb).
+        tn_path      = tblastn path (optional, defaults to tblastn).
     
     Arguments taken from Gene_model_prediction section of config file as follows:
         genomelist   = List of strain genomes specified by genomes_list.
@@ -115,6 +175,39 @@ def PanGuessHandler(ex_path, gm_path, tp_path, tl_path,
         td_len       = Amino acid sequence length cutoff for TransDecoder given by
                        trans_aa_length (int).
         cores        = Number of threads to run predictions on.
+        batch_size   = Number of reference proteins per Exonerate process given by
+                       exonerate_batch_size (int, 0 or 1 runs one process per protein).
+        seed_search  = Option for restricting Exonerate searches to padded windows around
+                       tblastn seeds given by exonerate_seed_search (0 or 1).
+        seed_pad     = Padding (bp) either side of seeded loci given by exonerate_seed_padding (int).
+        parallel     = Number of genomes to predict at the same time given by parallel_genomes
+                       (int). Cores are split evenly between genomes.
+        server       = Option for running Exonerate searches against an exonerate-server holding
+                       a prebuilt index of each genome given by exonerate_server (0 or 1). Not
+                       used for seeded searches, which only search small windows of the genome.
+        timeout      = Wall-clock limit (seconds) for each Exonerate process given by
+                       exonerate_timeout (int, 0 for no limit).
+        retry_model  = Exonerate model to retry timed out searches with given by
+                       exonerate_retry_model (e.g. protein2dna, leave empty to not retry).
+        cluster_identity = Identity (0.4-1.0) at which to cluster reference proteins with CD-HIT
+                       before searching, given by reference_cluster_identity (0 for no clustering).
+                       Hits of cluster representatives are refined against the other members.
+        cache        = Option for caching each genome's gene model predictions under
+                       <workdir>/cache, and reusing them in later runs, given by prediction_cache
+                       (0 or 1). Cache entries are keyed on the genome, reference protein set,
+                       tool executables and the options above that change predictions.
+        gm_reuse     = Option for training GeneMark-ES once and predicting genes in all genomes
+                       with that model given by genemark_reuse_model (0 or 1). Trained models are
+                       kept in <workdir>/gm_models and reused between runs.
+        gm_training  = Genome to train GeneMark-ES on given by genemark_training_genome (leave
+                       empty to train on the largest genome in genomelist).
+        td_shards    = Number of shards to split non-coding regions into for running TransDecoder
+                       in parallel given by transdecoder_shards (int, 1 for no sharding).
+        orf_caller   = ORF caller for non-coding regions given by ncr_orf_caller (transdecoder, or
+                       builtin for the faster built-in caller, which needs NumPy).
+        compressor   = Compressor for archiving each genome's temporary GeneMark-ES and TransDecoder
+                       folders in the background once it's predicted, given by compress_temp_dirs
+                       (pigz, zstd or none). Folders are removed once their archives are verified.
 
     Arguments activated by command line flags:
         skip         = Skip Exonerate gene model predictions.
@@ -124,6 +217,27 @@ def PanGuessHandler(ex_path, gm_path, tp_path, tl_path,
     if not cores:
         cores = str(mp.cpu_count() - 1)
 
+    # Batch size is read in as a string from the config file, 0 or 1 means no batching.
+    # Seeded searches use one set of windows per protein, so batching doesn't apply to them.
+    seed_search = bool(int(seed_search)) if seed_search else False
+    seed_pad = int(seed_pad) if seed_pad else 2000
+    batch_size = int(batch_size) if batch_size else 0
+    batched = batch_size > 1 and not seed_search
+    parallel = max(1, int(parallel)) if parallel else 1
+    server = bool(int(server)) and not seed_search if server else False
+    timeout = int(timeout) if timeout and int(timeout) > 0 else None
+    retry_model = retry_model if retry_model else None
+    cluster_identity = float(cluster_identity) if cluster_identity else 0
+    cache = bool(int(cache)) if cache else False
+    gm_reuse = bool(int(gm_reuse)) if gm_reuse else False
+    td_shards = max(1, int(td_shards)) if td_shards else 1
+    orf_caller = orf_caller if orf_caller else "transdecoder"
+    if orf_caller not in ["transdecoder", "builtin"]:
+        raise ValueError("ncr_orf_caller must be transdecoder or builtin, not {0}.".format(orf_caller))
+    compressor = compressor if compressor and compressor != "none" else None
+    if compressor not in [None, "pigz", "zstd"]:
+        raise ValueError("compress_temp_dirs must be pigz, zstd or none, not {0}.".format(compressor))
+
     # Generate list of genomes from user-provided genome list file.
     logging.info("Master: Parsing genome list.")
     genomes = [line.strip("\n") for line in open(genomelist)]
@@ -132,29 +246,183 @@ def PanGuessHandler(ex_path, gm_path, tp_path, tl_path,
     logging.info("Master: Building working directory for gene model prediction.")
     PanGuess.MakeWorkingDir(workdir)
 
+    # Train GeneMark-ES model once (on largest genome unless user chose one) if reusing it.
+    model = None
+    if gm_reuse:
+        if not gm_training:
+            gm_training = max(genomes, key=os.path.getsize)
+        logging.info("Master: Training GeneMark-ES model on {0} for all genomes.".format(gm_training))
+        model = PanGuess.TrainGeneMarkModel(workdir, gm_training, gm_path, gm_branch, cores)
+
+    # Everything other than the genome itself that predictions depend on, for the prediction cache.
+    settings = None
+    if cache:
+        logging.info("Master: Fingerprinting reference protein set and tools for prediction cache.")
+        tools = [ex_path, gm_path, tp_path, tl_path] + ([cd_path] if cluster_identity else [])
+        tools += [mb_path, tn_path] if seed_search and not skip else []
+        settings = [PanGuess.ToolFingerprint(path) for path in tools] + [HashFile(ref)]
+        settings += [str(opt) for opt in [gm_branch, td_len, skip, seed_search, seed_pad if seed_search else None,
+                                          timeout, retry_model, cluster_identity, td_shards, orf_caller]]
+        settings += [HashFile(model) if model else None]
+
     # Build reference protein directory for Exonerate (unless --no_exonerate is enabled).
+    # If clustering, only cluster representatives are searched. Compressed reference sets are
+    # streamed where possible, and only decompressed while CD-HIT or batching need a plain file.
+    clusters = None
     if not skip:
         logging.info("Master: Building working directory for gene model prediction.")
-        PanGuess.BuildRefSet(workdir, ref)
-    
-    # Loop over each genome and carry out gene model prediction.
-    for genome in genomes:
-        # Make tag from genome name (assuming genome name is in the format STRAIN.fna).
-        if "/" in genome:
-            tag = genome.split(".")[0].split("/")[1]
+        if cluster_identity:
+            staged = StageInput(ref, "{0}/staged".format(workdir))
+            try:
+                reps, clusters = PanGuess.ClusterRefSet(workdir, staged, cd_path, cluster_identity, cores)
+            finally:
+                ReleaseInput(ref, staged)
+            ref = reps
+        if batched:
+            staged = StageInput(ref, "{0}/staged".format(workdir))
+            try:
+                PanGuess.BuildRefBatches(workdir, staged, batch_size)
+            finally:
+                ReleaseInput(ref, staged)
+        else:
+            PanGuess.BuildRefSet(workdir, ref)
+
+    # Compress temporary folders of each genome in the background once it's finished, at low priority.
+    compress_jobs = Queue()
+    if compressor:
+        worker = threading.Thread(target=PanGuess.TarballWorker,
+                                  args=(compress_jobs, compressor, max(1, int(cores) // 2)))
+        worker.daemon = True
+        worker.start()
+
+    try:
+        # Loop over each genome and carry out gene model prediction.
+        if parallel == 1:
+            for genome in genomes:
+                PanGuessGenomeHandler(genome, ex_path, gm_path, tp_path, tl_path, mb_path, tn_path, workdir, ref,
+                                      gm_branch, td_len, cores, batched, seed_search, seed_pad, server, timeout,
+                                      retry_model, clusters, model, td_shards, orf_caller, settings, skip)
+                compress_jobs.put((workdir, genome))
+
+        # Otherwise predict several genomes at once, each in its own sandbox directory as GeneMark-ES and
+        # TransDecoder write fixed filenames into the current directory. Paths have to be absolute there.
         else:
-            tag = genome.split(".")[0]
-        logging.info("Master: Running gene model prediction for {0}.".format(tag))
+            genome_cores = str(max(1, int(cores) // parallel))
+            logging.info("Master: Predicting {0} genomes at a time on {1} threads each.".format(parallel,
+                                                                                                 genome_cores))
+            paths = [os.path.abspath(path) if os.sep in path else path
+                     for path in [ex_path, gm_path, tp_path, tl_path, mb_path, tn_path]]
+            queue = list(genomes)
+            running = {}
+            failed = []
+            while queue or running:
+                while queue and len(running) < parallel:
+                    genome = queue.pop(0)
+                    args = [genome] + paths + [os.path.abspath(workdir), os.path.abspath(ref), gm_branch, td_len,
+                                               genome_cores, batched, seed_search, seed_pad, server, timeout,
+                                               retry_model, clusters, model, td_shards, orf_caller, settings, skip,
+                                               True]
+                    running[genome] = mp.Process(target=PanGuessGenomeHandler, args=args)
+                    running[genome].start()
+                for genome in running.keys():
+                    running[genome].join(1)
+                    if running[genome].exitcode is not None:
+                        if running[genome].exitcode != 0:
+                            logging.error("Master: Gene model prediction failed for {0}.".format(genome))
+                            failed.append(genome)
+                        else:
+                            compress_jobs.put((workdir, genome))
+                        del running[genome]
+            if failed:
+                raise RuntimeError("Gene model prediction failed for {0}.".format(", ".join(failed)))
+
+    # Wait for compression to finish, even if prediction failed, so archives aren't cut off part way
+    # through when the interpreter exits.
+    finally:
+        if compressor:
+            logging.info("Master: Waiting for compression of temporary folders to finish.")
+            compress_jobs.put(None)
+            worker.join()
+
+    # Concatenate gene model sets, and load them into the gene model store used by later steps.
+    ConcatenateDatasets(genomelist)
+    store = GeneModelStore("{0}/sets".format(workdir))
+    store.Sync(GenomeTags(genomelist))
+    store.Close()
+
+
+def PanGuessGenomeHandler(genome, ex_path, gm_path, tp_path, tl_path, mb_path, tn_path, workdir, ref, gm_branch,
+                          td_len, cores, batched, seed_search, seed_pad, server, timeout, retry_model, clusters,
+                          model, td_shards, orf_caller, settings, skip, sandbox=False):
+    """
+    Runs gene model prediction for a single genome, see PanGuessHandler for arguments.
+
+    If sandbox is enabled, prediction is run from the directory <workdir>/sandbox/<tag> so
+    that other genomes can be predicted at the same time. This changes the current directory,
+    so should only be done in a child process.
+
+    If settings are given (see PanGuessHandler), gene model predictions are fetched from
+    the prediction cache if possible, and cached otherwise.
+    """
+    # Make tag from genome name (assuming genome name is in the format STRAIN.fna).
+    if "/" in genome:
+        tag = genome.split(".")[0].split("/")[1]
+    else:
+        tag = genome.split(".")[0]
+    logging.info("Master: Running gene model prediction for {0}.".format(tag))
+
+    # Genome is read from its absolute path so that it can be found from a sandbox directory,
+    # but temporary folders are still named after the genome as given in the genome list.
+    genome_path = os.path.abspath(genome)
+
+    # Use cached gene model predictions for genome if there are any.
+    if settings:
+        key = PanGuess.PredictionCacheKey(genome_path, tag, settings)
+        if PanGuess.FetchCachedPrediction(workdir, key, tag):
+            logging.info("Master: Using cached gene model predictions for {0} ({1}).".format(tag, key))
+            return
+
+    # Exonerate and GeneMark-ES can't read compressed genomes, so they're given a decompressed copy in
+    # <workdir>/staged, which is removed once GeneMark-ES is done (or prediction fails). Everything else
+    # reads the genome (or its genome store) straight from the compressed file.
+    staged = StageInput(genome_path, os.path.abspath("{0}/staged".format(workdir)))
+    try:
+        if sandbox:
+            sandbox = "{0}/sandbox/{1}".format(workdir, tag)
+            TryMkDirs(sandbox)
+            os.chdir(sandbox)
 
         if not skip:
             # Run prediction using Exonerate.
-            cmds = PanGuess.BuildExonerateCmds(workdir, ex_path, genome)
-            exonerate_genes = PanGuess.RunExonerate(cmds, cores)
-        
+            seeds = None
+            process = None
+            target = None
+            if seed_search:
+                seeds = PanGuess.SeedExonerateRegions(workdir, ref, genome_path, tag, cores, seed_pad, mb_path, tn_path)
+            elif server:
+                process, target = PanGuess.StartExonerateServer(workdir, ex_path, genome_path, tag, cores)
+            else:
+                target = staged
+            try:
+                cmds = PanGuess.BuildExonerateCmds(workdir, ex_path, genome_path, batched, seeds, target)
+                journal = "{0}/exonerate/{1}.journal".format(workdir, tag)
+                TryMkDirs(os.path.dirname(journal))
+                exonerate_genes = PanGuess.RunExonerate(cmds, cores, journal, genome_path, seed_search,
+                                                        timeout, retry_model)
+            finally:
+                if process:
+                    PanGuess.StopExonerateServer(process)
+
+            # Check hits of clustered reference proteins against the rest of their cluster.
+            if clusters:
+                exonerate_genes = PanGuess.RefineClusterHits(workdir, ex_path, genome_path, tag, exonerate_genes,
+                                                             clusters, cores, seed_pad, timeout, retry_model)
+
             # Order gene models predicted via Exonerate by Contig ID: Location.
+            # Reference homolog breaks ties so batched and per-protein runs sort identically.
             logging.info("Master: Sorting gene model predictions by genomic location.")
-            exonerate_genes.sort(key=lambda x: (x.contig_id, x.locs[0]))
-        
+            exonerate_genes.sort(key=lambda x: (x.contig_id, x.locs[0], x.ref))
+
             # Extract genomic attributes from Exonerate gene model set.
             exonerate_attributes = PanGuess.GetExonerateAttributes(exonerate_genes, tag)
 
@@ -162,60 +430,75 @@ def PanGuessHandler(ex_path, gm_path, tp_path, tl_path,
             logging.info("Master: Skipping gene model prediction via Exonerate (--no_exonerate enabled).")
             exonerate_genes = None
             exonerate_attributes = None
-        
+
         # Run prediction using GeneMark-ES.
         logging.info("Master: Running gene model prediction for {0} using GeneMark-ES.".format(genome))
-        genemark_gtf = PanGuess.RunGeneMark(genome, gm_path, gm_branch, cores)
-        
-        # Convert GeneMark-ES GTF file into a more PanOCT-compatible version.
-        logging.info("Master: Converting GeneMark GTF data to attribute data.")
-        genemark_attributes = PanGuess.GeneMarkGTFConverter(genemark_gtf, tag)
-        
-        # Merge unique gene model calls between Exonerate and GeneMark-ES.
-        if not skip:
-            logging.info("Master: Merging Exonerate and GeneMark-ES gene calls.")
-            merged_attributes = PanGuess.MergeAttributes(exonerate_attributes, genemark_attributes)
-        else:
-            merged_attributes = genemark_attributes
-            del genemark_attributes
-
-        # Clean up GeneMark-ES files and folders.
-        logging.info("Master: Tidying up GeneMark-ES temporary files.")
-        PanGuess.MoveGeneMarkFiles(workdir, genome)
-        
-        # Extract NCRs into list.
-        logging.info("Master: Extracting non-coding regions of {0} for TransDecoder analysis.".format(genome))
-        noncoding = PanGuess.ExtractNCR(merged_attributes, genome)
-        
-        # Run TransDecoder on NCRs.
+        genemark_gtf = PanGuess.RunGeneMark(staged, gm_path, gm_branch, cores, model)
+    finally:
+        ReleaseInput(genome_path, staged)
+
+    # Convert GeneMark-ES GTF file into a more PanOCT-compatible version.
+    logging.info("Master: Converting GeneMark GTF data to attribute data.")
+    genemark_attributes = PanGuess.GeneMarkGTFConverter(genemark_gtf, tag)
+
+    # Extract GeneMark-ES gene model sequences.
+    logging.info("Master: Extracting GeneMark-ES gene model sequences.")
+    genemark_nucl, genemark_prot = PanGuess.ExtractGeneMarkSequences(genemark_gtf, genome_path, workdir)
+
+    # Merge unique gene model calls between Exonerate and GeneMark-ES.
+    if not skip:
+        logging.info("Master: Merging Exonerate and GeneMark-ES gene calls.")
+        merged_attributes = PanGuess.MergeAttributes(exonerate_attributes, genemark_attributes)
+    else:
+        merged_attributes = genemark_attributes
+        del genemark_attributes
+
+    # Clean up GeneMark-ES files and folders.
+    logging.info("Master: Tidying up GeneMark-ES temporary files.")
+    PanGuess.MoveGeneMarkFiles(workdir, genome)
+
+    # Extract NCRs into FASTA file.
+    logging.info("Master: Extracting non-coding regions of {0} for TransDecoder analysis.".format(genome))
+    noncoding = PanGuess.ExtractNCR(merged_attributes, genome_path, workdir, genome)
+
+    # Run TransDecoder (or built-in ORF caller) on NCRs.
+    if orf_caller == "builtin":
+        logging.info("Master: Calling ORFs in non-coding regions of {0}.".format(genome))
+        tdir = PanGuess.RunBuiltinORFCaller(noncoding, workdir, genome, td_len)
+    else:
         logging.info("Master: Running TransDecoder on non-coding regions of {0}.".format(genome))
-        tdir = PanGuess.RunTransDecoder(noncoding, tp_path, tl_path, workdir, genome, td_len)
-        
-        # Move TransDecoder files.
-        logging.info("Master: Tidying up TransDecoder temporary files.")
-        PanGuess.MoveTransDecoderFiles(tdir)
-        
-        # Extract TransDecoder attributes.
-        logging.info("Master: Converting TransDecoder GTF data to attribute data.")
-        trans_attributes = PanGuess.TransDecoderGTFToAttributes(tdir, tag)
-
-        # Merge TransDecoder calls into the Exonerate + GeneMark-ES set.
-        logging.info("Master: Merging all remmaining gene calls for {0}.".format(genome))
-        full_attributes = PanGuess.MergeAttributes(merged_attributes, trans_attributes)
-        
-        # Write out gene set, protein set and attributes set.
-        logging.info("Master: Writing out datasets for {0}.".format(genome))
-        PanGuess.ConstructGeneModelSets(full_attributes, exonerate_genes, workdir, genome, tag)
-        
-        # Compress temporary folders and finish up.
-        #logging.info("Master: Compressing temporary folders for {0}.".format(genome))
-        #PanGuess.TarballGenePredictionDirs(workdir, genome)
-        logging.info("Master: Finished gene model predction for {0}.".format(genome))
+        tdir = PanGuess.RunTransDecoder(noncoding, tp_path, tl_path, workdir, genome, td_len, td_shards,
+                                            cores)
 
-    ConcatenateDatasets(genomelist)
+    # Move TransDecoder files.
+    logging.info("Master: Tidying up TransDecoder temporary files.")
+    PanGuess.MoveTransDecoderFiles(tdir)
+
+    # Extract TransDecoder attributes.
+    logging.info("Master: Converting TransDecoder GTF data to attribute data.")
+    trans_attributes = PanGuess.TransDecoderGTFToAttributes(tdir, tag)
+
+    # Merge TransDecoder calls into the Exonerate + GeneMark-ES set.
+    logging.info("Master: Merging all remmaining gene calls for {0}.".format(genome))
+    full_attributes = PanGuess.MergeAttributes(merged_attributes, trans_attributes)
 
+    # Write out gene set, protein set and attributes set.
+    logging.info("Master: Writing out datasets for {0}.".format(genome))
+    PanGuess.ConstructGeneModelSets(full_attributes, exonerate_genes, genemark_nucl, genemark_prot, workdir,
+                                    genome, tag)
+    if settings:
+        PanGuess.StorePrediction(workdir, key, tag)
 
-def QualityCheckHandler(sets, queries, cores=None):
+    # Remove sandbox directory (everything worth keeping has been moved out by now).
+    if sandbox:
+        os.chdir(workdir)
+        shutil.rmtree(sandbox)
+
+    # Finish up (temporary folders are compressed by PanGuessHandler).
+    logging.info("Master: Finished gene model predction for {0}.".format(genome))
+
+
+def QualityCheckHandler(sets, queries, cores=None, workdir="./gm_pred"):
     """
     Search a user-provided set of genes of dubious-quality (i.e. pseudogenes, transposable elements or
     transposons &c.) against predicted gene model sets and filter out sufficiently similar genes in the latter.
@@ -223,12 +506,18 @@ def QualityCheckHandler(sets, queries, cores=None):
     Arguments:
         gene_sets   = List of strains in analysis (easy access to all files associated with a strain).
         queries     = Set of genes (protein sequences, in fact) to search against all gene model sets.
+        workdir     = Gene model prediction directory (holding the gene model store in <workdir>/sets).
     """
     # Build BLAST DB, run QC searches against DB and filter out any dubious gene calls.
     logging.info("Master: Running QualityCheckHandler.")
-    QualityCheck.BuildMakeBLASTDBs(sets, cores)
-    blasts = QualityCheck.QCBLAST(queries, sets, cores)
-    QualityCheck.RemoveDubiousCalls(blasts, sets)
+    # Compressed queries are decompressed while they're searched, as every strain's blastp reads them.
+    staged = StageInput(queries, "{0}/staged".format(workdir))
+    try:
+        QualityCheck.BuildMakeBLASTDBs(sets, cores)
+        blasts = QualityCheck.QCBLAST(staged, sets, cores)
+    finally:
+        ReleaseInput(queries, staged)
+    QualityCheck.RemoveDubiousCalls(blasts, sets, "{0}/sets".format(workdir))
 
 
 def BUSCOHandler(buscopath, lineagepath, tags):
@@ -240,7 +529,7 @@ def BUSCOHandler(buscopath, lineagepath, tags):
     pass
 
 
-def BLASTAllHandler(tags, cores=None):
+def BLASTAllHandler(tags, cores=None, compress=None, chunk_size=None, threads=None):
     """
     Runs all-vs.-all BLASTp search of gene model dataset as required for PanOCT. BLASTp searches "parallelized"
     via subprocessing and cStringIO magic. Can be skipped from command-line, and in general it might be better
@@ -250,22 +539,27 @@ def BLASTAllHandler(tags, cores=None):
         tags   = List of strains in analysis (easy access to all files associated with a strain).
         evalue = E-value cutoff for BLASTp searches (default is 10^-4).
         cores  = Number of BLASTp searches to run simulatenously (default will be available cores - 1).
+        compress = Write results gzip-compressed to panoct.blast.gz instead of panoct.blast (0 or 1).
+        chunk_size = Number of queries per blastp process (default is 200).
+        threads = Threads per blastp process (default balances processes and threads against cores).
     """
     # Concatenate all protein sequence datasets together, BLAST them against themselves,
     # pool all farmed results together and write output (in tabular format) to file.
     logging.info("Master: Running BLASTAllHandler.")
     ConcatenateDatasets(tags)
-    blasts = BLASTAll.BLASTAll(cores)
-    BLASTAll.MergeBLASTsAndWrite(blasts)
+    blasts = BLASTAll.BLASTAll(cores, chunk_size, threads)
+    compress = bool(int(compress)) if compress else False
+    BLASTAll.MergeBLASTsAndWrite(blasts, "panoct.blast.gz" if compress else "panoct.blast")
 
 
-def PanOCTHandler(fasta_db, attributes, blast, tags, gaps=False, **kwargs):
+def PanOCTHandler(fasta_db, attributes, blast, tags, gaps=False, workdir="./gm_pred", **kwargs):
     """
     Runs PanOCT, refines initial construction if enabled and does some post-run cleanup and sequence extraction.
 
     Arguments:
         gene_sets   = List of strains in analysis (easy access to all files associated with a strain).
         queries     = Set of genes (protein sequences, in fact) to search against all gene model sets.
+        workdir     = Gene model prediction directory (holding the gene model store in <workdir>/sets).
     """
     # Run PanOCT with provided files (and optional additional arguments.
     logging.info("Master: Running PanOCTHandler.")
@@ -273,17 +567,28 @@ def PanOCTHandler(fasta_db, attributes, blast, tags, gaps=False, **kwargs):
         ConcatenateDatasets("genomes/genomes.txt")
     elif not os.path.isfile(attributes):
         ConcatenateDatasets("genomes/genomes.txt")
+
+    # Use compressed BLASTp results if they're newer than (or in place of) the given file. PanOCT reads
+    # compressed BLASTp results, sequences and attributes itself.
+    if os.path.isfile(blast + ".gz") and (not os.path.isfile(blast) or
+                                          os.path.getmtime(blast + ".gz") > os.path.getmtime(blast)):
+        blast = blast + ".gz"
     PanOCT.RunPanOCT(fasta_db, attributes, blast, tags, **kwargs)
 
     # If enabled, try to fill potential gaps in syntenic clusters within pangenome using BLAST+ data.
+    # SearchIO.index needs a plain file, so compressed BLASTp results are decompressed while gap filling.
     if gaps:
         logging.info("Master: Running gap filling method.")
-        PanOCT.FillGaps(blast, "./matchtable.txt", fasta_db, "./panoct_tags.txt")
+        staged = StageInput(blast, "{0}/staged".format(workdir))
+        try:
+            PanOCT.FillGaps(staged, "./matchtable.txt", fasta_db, "./panoct_tags.txt")
+        finally:
+            ReleaseInput(blast, staged)
         PanOCT.PanOCTOutputHandler()
-        PanOCT.GenerateClusterFASTAs("genomes/genomes.txt", gaps)
+        PanOCT.GenerateClusterFASTAs("genomes/genomes.txt", "{0}/sets".format(workdir), gaps)
     else:
         PanOCT.PanOCTOutputHandler()
-        PanOCT.GenerateClusterFASTAs("genomes/genomes.txt")
+        PanOCT.GenerateClusterFASTAs("genomes/genomes.txt", "{0}/sets".format(workdir))
 
 
 def IPSHandler(ips_path, cores=None):
@@ -321,39 +626,43 @@ def GOHandler(go_path, gs_path, refine=False):
 
 def PAMLHandler(ml_path, yn_path, refine=False):
     """
-    Run Yn00 on core and accessory gene model clusters.
+    Run Yn00 on core and accessory gene model clusters, streamed from the cluster archives. Alignments and
+    yn00 results are written to a yn00 folder next to the archives. Results are only reused for clusters with
+    the same members and sequences as when they were run (see PAML.RunClusterYn00): the same cluster in an
+    earlier run, or for refined clusters, an unchanged unrefined cluster from an earlier run without --refine.
+    A --refine run doesn't run yn00 on the unrefined clusters itself, so there's nothing to reuse within it.
     """
     if refine:
-        clusters = glob("./panoct/clusters/refined/core/fna/Core*.fna") + glob("./panoct/clusters/refined/acc/fna/Acc*.fna")
+        fdir = "./panoct/clusters/refined"
     else:
-        clusters = glob("./panoct/clusters/core/fna/Core*.fna") + glob("./panoct/clusters/acc/fna/Acc*.fna")
-    for cluster in clusters:
-        try:
-            trans_seqs = PAML.TranslateCDS(cluster)
-        except TranslationError as e:
-            print "{0}, {1} has unusual frameshift mutation and can't be run through yn00.".format(e, cluster)
-            trans_seqs = None
-        if trans_seqs:
-            prot_alignment = PAML.MUSCLEAlign(ml_path, trans_seqs)
-            nucl_alignment = PAML.PutGaps(prot_alignment, cluster)
-            PAML.RunYn00(yn_path, nucl_alignment)
-        else:
-            pass
+        fdir = "./panoct/clusters"
+    clusters, _ = PAML.RunClusterYn00(ml_path, yn_path, fdir)
+    PAML.SummarizeYn00(clusters, refine)
+
 
-    PAML.SummarizeYn00(refine)
+def ExportClustersHandler(refine=False):
+    """
+    Export the cluster archives to one FASTA file per cluster, for users and tools that need individual files.
+    """
+    count = ExportClusters("./panoct/clusters")
+    if refine:
+        count = count + ExportClusters("./panoct/clusters/refined")
+    logging.info("Master: Exported {0} cluster FASTA files.".format(count))
 
 
-def KaryoploteRHandler(refined=False):
+def KaryoploteRHandler(refined=False, workdir="./gm_pred"):
     """
     Generates chromosomal plots of core and accessory gene models for each genome in a dataset, similar to
-    the Ruby program PhenoGram but with way less overhead.
+    the Ruby program PhenoGram but with way less overhead. Contig lengths and gene model attributes are read
+    from the genome and gene model stores in the gene model prediction directory (workdir).
     """
     # Make lengths and karyotypes files (don't think these can be passed as objects to R without a lot of effort).
-    Karyotype.GenerateContigLengths("./genomes")
+    Karyotype.GenerateContigLengths("./genomes", "{0}/genomes".format(workdir))
     if refined:
-        Karyotype.GenerateKaryotypeFiles("./gm_pred/sets/allatt.db", "./panoct/refined_matchtable.txt")
+        Karyotype.GenerateKaryotypeFiles("genomes/genomes.txt", "./panoct/refined_matchtable.txt",
+                                         "{0}/sets".format(workdir))
     else:
-        Karyotype.GenerateKaryotypeFiles("./gm_pred/sets/allatt.db", "./panoct/matchtable.txt")
+        Karyotype.GenerateKaryotypeFiles("genomes/genomes.txt", "./panoct/matchtable.txt", "{0}/sets".format(workdir))
 
     # Pass required files to KaryPloteR and run R script.
     Karyotype.KaryoPloteR("./panoct_tags.txt", "./karyotypes.txt", "./genomes/lengths.txt")
@@ -425,6 +734,10 @@ def CmdLineParser():
     # Add argument for gap filling in PanOCT-dervied pangenome.
     ap.add_argument("--refine", action="store_true", help="Attempt to fill potential gaps in syntenic clusters.")
 
+    # Add argument for exporting cluster archives to individual FASTA files.
+    ap.add_argument("--export_clusters", action="store_true", help="Export core and accessory cluster sequences "
+                                                                   "to one FASTA file per cluster.")
+
     # Add arguments for annotation and GO-enrichment analysis.
     ap.add_argument("--ips", action="store_true", help="Perform InterProScan analysis of gene model sets. NOTE:"
                                                        " Do not enable this option on non-Linux operating systems,"
@@ -433,7 +746,10 @@ def CmdLineParser():
 
     # Add argument for selection analysis using yn00.
     ap.add_argument("--yn00", action="store_true", help="Perform selection analysis on core and accessory gene "
-                                                        "families using yn00.")
+                                                        "families using yn00. Results of families unchanged since an "
+                                                        "earlier --yn00 run are reused. With --refine, only refined "
+                                                        "families are analysed, reusing results of unchanged "
+                                                        "families from an earlier --yn00 run without --refine.")
 
     # Add argument to produce all R plots.
     ap.add_argument("--plots", action="store_true", help="Generate all downstream plots (karyotype, cluster size, "
@@ -490,7 +806,16 @@ def main():
         ap.CONFIG_FILE = os.path.dirname(os.path.realpath(sys.argv[0])) + "/config.ini"
     cp.read(ap.CONFIG_FILE)
 
+    # Gene model prediction directory, which also holds the gene model and genome stores read by later steps
+    # (even with --no_pred).
+    workdir = "./gm_pred"
+    if cp.has_option("Gene_model_prediction", "prediction_dir") and cp.get("Gene_model_prediction", "prediction_dir"):
+        workdir = cp.get("Gene_model_prediction", "prediction_dir").rstrip("/")
+
     # Get paths for prediction dependencies.
+    cd_path = "cd-hit"
+    mb_path = "makeblastdb"
+    tn_path = "tblastn"
     for arg in cp.items("Gene_prediction_dependencies"):
         if arg[0] == "exonerate_path":
             ex_path = arg[1]
@@ -500,6 +825,12 @@ def main():
             tp_path = arg[1]
         if arg[0] == "transdecoder_longorfs_path":
             tl_path = arg[1]
+        if arg[0] == "cdhit_path" and arg[1]:
+            cd_path = arg[1]
+        if arg[0] == "makeblastdb_path" and arg[1]:
+            mb_path = arg[1]
+        if arg[0] == "tblastn_path" and arg[1]:
+            tn_path = arg[1]
 
     # Get paths for QC dependencies.
     for arg in cp.items("Quality_control_dependencies"):
@@ -529,23 +860,48 @@ def main():
                   "Go to http://exon.gatech.edu/GeneMark/gmes_instructions.html to download a new license key," \
                   "and place it in your home folder under the name .gm_key. Exiting out of Pangloss."
             exit(0)
-        panguess_args = [ex_path, gm_path, tp_path, tl_path]
         logging.info("Master: Performing gene prediction steps using PanGuess.")
-        for arg in cp.items("Gene_model_prediction"):
-            panguess_args.append(arg[1])
-        if ap.no_exonerate:
-            panguess_args.append(True)
-        PanGuessHandler(*panguess_args)
+
+        # Read prediction settings by name, optional settings missing from older config files are left
+        # to PanGuessHandler's defaults.
+        pred_settings = dict(cp.items("Gene_model_prediction"))
+        missing = [option for option in ["genomes_list", "prediction_dir", "reference_proteins",
+                                         "genemark_fungal_model", "trans_aa_length"] if not pred_settings.get(option)]
+        if missing:
+            logging.error("Master: Missing Gene_model_prediction settings {0}.".format(", ".join(missing)))
+            sys.exit("Missing Gene_model_prediction settings in {0}: {1}.".format(ap.CONFIG_FILE, ", ".join(missing)))
+        PanGuessHandler(ex_path, gm_path, tp_path, tl_path,
+                        genomelist=pred_settings["genomes_list"],
+                        workdir=workdir,
+                        ref=pred_settings["reference_proteins"],
+                        gm_branch=pred_settings["genemark_fungal_model"],
+                        td_len=pred_settings["trans_aa_length"],
+                        cores=pred_settings.get("run_threads") or None,
+                        batch_size=pred_settings.get("exonerate_batch_size") or None,
+                        seed_search=pred_settings.get("exonerate_seed_search") or None,
+                        seed_pad=pred_settings.get("exonerate_seed_padding") or None,
+                        parallel=pred_settings.get("parallel_genomes") or None,
+                        server=pred_settings.get("exonerate_server") or None,
+                        timeout=pred_settings.get("exonerate_timeout") or None,
+                        retry_model=pred_settings.get("exonerate_retry_model") or None,
+                        cluster_identity=pred_settings.get("reference_cluster_identity") or None,
+                        cache=pred_settings.get("prediction_cache") or None,
+                        gm_reuse=pred_settings.get("genemark_reuse_model") or None,
+                        gm_training=pred_settings.get("genemark_training_genome") or None,
+                        td_shards=pred_settings.get("transdecoder_shards") or None,
+                        orf_caller=pred_settings.get("ncr_orf_caller") or None,
+                        compressor=pred_settings.get("compress_temp_dirs") or None,
+                        cd_path=cd_path, mb_path=mb_path, tn_path=tn_path, skip=ap.no_exonerate)
         logging.info("Master: Gene prediction finished.")
 
         # If enabled, check gene sets against user-provided sets of dubious genes, or transposable elements, &c.
         if ap.qc:
             logging.info("Master: Performing gene model QC using QualityCheck.")
-            qc_args = [[i for i in glob("./gm_pred/sets/*.faa")]]
+            qc_args = [[i for i in glob("{0}/sets/*.faa".format(workdir))]]
             for arg in cp.items("Quality_control"):
                 if arg[1]:
                     qc_args.append(arg[1])
-            QualityCheckHandler(*qc_args)
+            QualityCheckHandler(*qc_args, workdir=workdir)
             logging.info("Master: QC analysis finished.")
         else:
             logging.info("Master: Skipped gene model QC (--qc not enabled).")
@@ -554,7 +910,7 @@ def main():
         if ap.busco:
             logging.info("Master: Performing BUSCO analysis of gene model sets.")
             busco_args = [bu_path, bl_path]
-            busco_args = busco_args + [[i for i in glob("./gm_pred/sets/*.faa")]]
+            busco_args = busco_args + [[i for i in glob("{0}/sets/*.faa".format(workdir))]]
             BUSCOHandler(*busco_args)
 
         # Allow program to finish after gene prediction and (optionally) QC/BUSCO if --pred_only is enabled.
@@ -569,11 +925,11 @@ def main():
     # Run all-vs.-all BLASTp, unless --no_blast is enabled (i.e., user provides own blast file).
     if not ap.no_blast:
         logging.info("Master: Performing all-vs.-all BLASTp searches for entire dataset.")
-        blast_args = []
-        for arg in cp.items("BLASTAll_settings"):
-            if arg[1]:
-                blast_args.append(arg[1])
-        BLASTAllHandler(*blast_args)
+        blast_settings = dict(cp.items("BLASTAll_settings"))
+        BLASTAllHandler(blast_settings["genomes_list"], blast_settings.get("run_threads") or None,
+                        compress=blast_settings.get("compress_output") or None,
+                        chunk_size=blast_settings.get("blast_chunk_size") or None,
+                        threads=blast_settings.get("blast_threads") or None)
         logging.info("Master: All-vs.-all analysis finished.")
     else:
         logging.info("Master: Skipping all-vs.-all BLASTp searches (--no_blast enabled).")
@@ -590,10 +946,15 @@ def main():
             panoct_default_args.append(True)
         else:
             pass
-        PanOCTHandler(*panoct_default_args)
+        PanOCTHandler(*panoct_default_args, workdir=workdir)
     else:
         logging.info("Master: Skipping PanOCT analysis (--no_panoct enabled).")
 
+    # If enabled, export cluster archives to one FASTA file per cluster.
+    if ap.export_clusters:
+        logging.info("Master: Exporting cluster sequences to individual FASTA files.")
+        ExportClustersHandler(ap.refine)
+
     # If enabled, run InterProScan analysis on entire dataset.
     if ap.ips:
         if not sys.platform.startswith("linux"):
@@ -621,7 +982,7 @@ def main():
     # If enabled, generate karyotype plots for all strain genomes in pangenome dataset.
     if ap.karyo:
         logging.info("Master: Generating karyotype plots for all genomes in dataset.")
-        KaryoploteRHandler(ap.refine)
+        KaryoploteRHandler(ap.refine, workdir)
 
     # If enabled, generate bar charts and Chao estimate of pangenome size.
     if ap.size:
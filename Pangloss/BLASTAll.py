@@ -8,46 +8,70 @@ import logging
 import multiprocessing as mp
 import subprocess as sp
 
-from Bio import SeqIO, SearchIO
+from Bio import SearchIO
 
-from Tools import StringBLAST
+from FASTA import FASTAId, ReadFASTA
+from Tools import BLASTDBCurrent, ChunkBLAST, OpenFile, RecordBLASTDB
 
+# Default number of queries per blastp process.
+CHUNK_SIZE = 200
 
-def BLASTAll(cores=None):
+
+def BLASTAll(cores=None, chunk_size=None, threads=None):
     """
     Load all query files into memory as strings and BLAST them against all other gene models
-    using mp.Pool and the StringBLAST function with n number of cores.
+    using mp.Pool and the ChunkBLAST function, in chunks of queries that each run as a single
+    multi-threaded blastp process, so the database is loaded once per chunk rather than once
+    per query. Workers and threads per worker are balanced to use n number of cores.
     """
     # If user doesn't specify cores in command line, just leave them with one free.
     if not cores:
         cores = mp.cpu_count() - 1
+    cores = max(int(cores), 1)
+    chunk_size = int(chunk_size) if chunk_size else CHUNK_SIZE
+
+    # Only rebuild protein sequence database if the dataset has changed since it was last built.
+    db = "./gm_pred/sets/allprot.db"
+    if BLASTDBCurrent(db, db):
+        logging.info("BLASTAll: Protein sequence dataset unchanged, reusing BLAST database.")
+    else:
+        logging.info("BLASTAll: Running makeblastdb command for protein sequence database.")
+        sp.check_call(["makeblastdb", "-in", db, "-dbtype", "prot"])
+        RecordBLASTDB(db, db)
 
-    logging.info("BLASTAll: Running makeblastdb command for protein sequence database.")
-    sp.call(["makeblastdb", "-in", "./gm_pred/sets/allprot.db", "-dbtype", "prot"])
+    # Extract FASTA header/sequence strings from database to memory, and pack them into chunks.
+    queries = [">{0}\n{1}".format(FASTAId(header), seq)
+               for header, seq in ReadFASTA("./gm_pred/sets/allprot.db", use_mmap=True)]
+    chunks = [queries[i:i + chunk_size] for i in range(0, len(queries), chunk_size)]
 
-    # Extract FASTA header/sequence strings from database to memory.
-    queries = []
-    for seq in SeqIO.parse(open("./gm_pred/sets/allprot.db"), "fasta"):
-        queries.append(">{0}\n{1}".format(seq.id, seq.seq))
+    # Run one worker per core unless there are fewer chunks than cores (or threads per worker are
+    # given), in which case each worker's blastp gets a share of the spare cores as threads.
+    if threads:
+        threads = min(max(int(threads), 1), cores)
+        workers = max(cores // threads, 1)
+    else:
+        workers = max(min(cores, len(chunks)), 1)
+        threads = max(cores // workers, 1)
 
-    # Run individual StringBLAST tasks simultaneously.
-    logging.info("BLASTAll: Running all-vs.-all BLASTp searches using {0} threads.".format(cores))
-    farm = mp.Pool(processes=int(cores))
-    results = farm.map(StringBLAST, queries)
+    # Run ChunkBLAST tasks simultaneously.
+    logging.info("BLASTAll: Running all-vs.-all BLASTp searches of {0} queries in {1} chunks using {2} workers "
+                 "with {3} threads each.".format(len(queries), len(chunks), workers, threads))
+    farm = mp.Pool(processes=workers)
+    results = farm.map(ChunkBLAST, [(chunk, threads) for chunk in chunks], 1)
     farm.close()
     farm.join()
 
     # Return the raw strings (could incorporate some filtering here, but I don't think it's necessary).
     logging.info("BLASTAll: All-vs.-all BLAST finished.")
-    return results
+    return [result for chunk in results for result in chunk]
 
 
-def MergeBLASTsAndWrite(results):
+def MergeBLASTsAndWrite(results, output="panoct.blast"):
     """
     Merge all individual BLASTp searches together and write to file in tabular format (without comments this time).
     One thing to note is we have to fool SearchIO into correctly parsing all the results as one big "file" by removing
     the last two lines ("# BLAST processed x queries" &c) from each result object while we're merging everything
-    together (see join line).
+    together (see join line). Results are written gzip-compressed if output ends in .gz.
     """
     # Filter last two lines of each BLASTp result and join remaining lines together, making one big SearchIO object.
     logging.info("BLASTAll: Merging all-vs.-all results together and parsing into tabular format.")
@@ -55,5 +79,6 @@ def MergeBLASTsAndWrite(results):
     parsed = SearchIO.parse(cStringIO.StringIO(merged), "blast-tab", comments=True)
 
     # Write merged BLASTp results to file for PanOCT.
-    logging.info("BLASTAll: Writing BLASTp results to file panoct.blast.")
-    SearchIO.write(parsed, "panoct.blast", "blast-tab")
\ No newline at end of file
+    logging.info("BLASTAll: Writing BLASTp results to file {0}.".format(output))
+    with OpenFile(output, "w") as outfile:
+        SearchIO.write(parsed, outfile, "blast-tab")
\ No newline at end of file
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+ClusterArchive: Packed, indexed archives of cluster sequences, written by PanOCT.GenerateClusterFASTAs.
+
+Rather than one FASTA file per cluster, all clusters of a pangenome component and sequence type are
+written back to back into a single FASTA file (e.g. panoct/clusters/core.fna), with an index file
+(core.fna.idx) giving each cluster's ID, byte offset, byte length and number of sequences. Clusters
+can be read at random through the index, streamed in order, or exported to the old layout of one
+FASTA file per cluster (core/fna/Core_<n>.fna &c.) with ExportClusters.
+
+An archive can also share clusters with a base archive (used for the refined clusters, most of which
+are unchanged from the unrefined ones): shared clusters aren't written again, their index lines give
+the offset and length in the base archive instead, followed by the base archive's path (relative to
+the index) and the cluster's ID there.
+"""
+
+import hashlib
+import mmap
+import os
+
+from FASTA import SplitRecords, WriteFASTA
+
+# Pangenome components and sequence types with an archive each, and cluster ID prefixes of components.
+COMPONENTS = {"core": "Core", "acc": "Acc"}
+SEQ_TYPES = ["faa", "fna"]
+
+
+def ArchivePath(fdir, component, seq_type):
+    """
+    Return path of the archive of a component's (core or acc) sequences of a type (faa or fna).
+    """
+    return "{0}/{1}.{2}".format(fdir, component, seq_type)
+
+
+def WriteClusterArchive(path, clusters, base=None):
+    """
+    Write an archive from (cluster ID, records) tuples, with records as (header, sequence) tuples.
+    If a base archive (an open ClusterArchive) is given, records can instead be the ID of a cluster
+    in the base archive, which is then shared rather than written again. The archive and its index
+    are written under temporary names and moved into place when complete. Returns the number of
+    clusters written (shared clusters aren't counted).
+    """
+    count = 0
+    with open(path + ".tmp", "w") as outfile, open(path + ".idx.tmp", "w") as outidx:
+        for cluster_id, records in clusters:
+            if isinstance(records, basestring):
+                offset, length, members = base.index[records]
+                source, source_id = base.Source(records) or (base.path, records)
+                source = os.path.relpath(source, os.path.dirname(os.path.abspath(path)))
+                outidx.write("{0}\t{1}\t{2}\t{3}\t{4}\t{5}\n".format(cluster_id, offset, length, members,
+                                                                   source, source_id))
+                continue
+            offset = outfile.tell()
+            members = WriteFASTA(outfile, records)
+            outidx.write("{0}\t{1}\t{2}\t{3}\n".format(cluster_id, offset, outfile.tell() - offset, members))
+            count = count + 1
+    os.rename(path + ".tmp", path)
+    os.rename(path + ".idx.tmp", path + ".idx")
+    return count
+
+
+class ClusterArchive(object):
+    """
+    Read-only access to an archive of cluster sequences, memory-mapped so clusters are read straight from
+    the page cache.
+    """
+
+    def __init__(self, path):
+        """
+        Open an archive.
+
+        - path:     Path of archive.
+        - clusters: Cluster IDs in archive order.
+        - index:    Dictionary of cluster IDs to (offset, length, number of sequences).
+        - shared:   Dictionary of shared cluster IDs to (base archive path, cluster ID in base archive).
+        - maps:     Dictionary of archive paths to (handle, memory map), for this archive and its bases.
+        """
+        self.path = path
+        self.clusters = []
+        self.index = {}
+        self.shared = {}
+        self.maps = {}
+        idx_dir = os.path.dirname(os.path.abspath(path))
+        for line in open(path + ".idx"):
+            fields = line.rstrip("\n").split("\t")
+            cluster_id = fields[0]
+            self.clusters.append(cluster_id)
+            self.index[cluster_id] = (int(fields[1]), int(fields[2]), int(fields[3]))
+            if len(fields) > 4:
+                self.shared[cluster_id] = (os.path.normpath(os.path.join(idx_dir, fields[4])), fields[5])
+        self.data = self.Map(os.path.abspath(path))
+
+    def Map(self, path):
+        """
+        Return memory map of an archive file (this archive or a base), mapping it on first use. Raises
+        ValueError if a base archive has been rewritten since this archive's index was written, as the
+        offsets of shared clusters would no longer be valid.
+        """
+        if path not in self.maps:
+            if path != os.path.abspath(self.path) and os.path.getmtime(path) > os.path.getmtime(self.path + ".idx"):
+                raise ValueError("ClusterArchive: {0} changed since {1} was written.".format(path, self.path))
+            handle = open(path, "rb")
+            if os.path.getsize(path):
+                data = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                data = ""
+            self.maps[path] = (handle, data)
+        return self.maps[path][1]
+
+    def Data(self, cluster_id):
+        """
+        Return the memory map holding a cluster's sequences.
+        """
+        if cluster_id in self.shared:
+            return self.Map(self.shared[cluster_id][0])
+        return self.data
+
+    def __contains__(self, cluster_id):
+        return cluster_id in self.index
+
+    def __iter__(self):
+        return iter(self.clusters)
+
+    def __len__(self):
+        return len(self.clusters)
+
+    def __getitem__(self, cluster_id):
+        """
+        Return list of (header, sequence) tuples of a cluster's sequences.
+        """
+        offset, length, _ = self.index[cluster_id]
+        return list(SplitRecords(self.Data(cluster_id), offset, offset + length))
+
+    def Size(self, cluster_id):
+        """
+        Return number of sequences in a cluster.
+        """
+        return self.index[cluster_id][2]
+
+    def Raw(self, cluster_id):
+        """
+        Return a cluster's sequences as FASTA formatted text, as stored in the archive.
+        """
+        offset, length, _ = self.index[cluster_id]
+        return self.Data(cluster_id)[offset:offset + length]
+
+    def Fingerprint(self, cluster_id):
+        """
+        Return SHA-1 hex digest of a cluster's sequences as stored (member IDs, locations and sequences),
+        which identifies the cluster across archives and PanOCT runs.
+        """
+        return hashlib.sha1(self.Raw(cluster_id)).hexdigest()
+
+    def Source(self, cluster_id):
+        """
+        Return (base archive path, cluster ID in base archive) of a shared cluster, or None if the
+        cluster was written to this archive.
+        """
+        return self.shared.get(cluster_id)
+
+    def Iterate(self):
+        """
+        Yield (cluster ID, records) tuples for every cluster, in archive order.
+        """
+        for cluster_id in self.clusters:
+            yield cluster_id, self[cluster_id]
+
+    def Close(self):
+        """
+        Unmap and close the archive and any base archives.
+        """
+        for handle, data in self.maps.values():
+            if data:
+                data.close()
+            handle.close()
+        self.maps = {}
+
+
+def ExportClusters(fdir):
+    """
+    Export every archive in a cluster folder to one FASTA file per cluster, in the layout written
+    by earlier versions (<fdir>/core/faa/Core_<n>.faa, <fdir>/acc/fna/Acc_<n>.fna &c.). Returns
+    the number of files written.
+    """
+    count = 0
+    for component in COMPONENTS:
+        for seq_type in SEQ_TYPES:
+            path = ArchivePath(fdir, component, seq_type)
+            if not os.path.isfile(path + ".idx"):
+                continue
+            outdir = "{0}/{1}/{2}".format(fdir, component, seq_type)
+            if not os.path.isdir(outdir):
+                os.makedirs(outdir)
+            archive = ClusterArchive(path)
+            for cluster_id in archive:
+                with open("{0}/{1}.{2}".format(outdir, cluster_id, seq_type), "w") as outfile:
+                    outfile.write(archive.Raw(cluster_id))
+                count = count + 1
+            archive.Close()
+    return count
@@ -1,15 +1,29 @@
 # -*- coding: utf-8 -*-
 """
 ExonerateGene: Module defining gene object called through Exonerate.
+
+Exonerate is run with alignment and vulgar output turned off, and with a custom --ryo
+("roll your own") format instead, which ParseExonerateOutput reads in one pass.
 """
 
-from Bio import SearchIO
+from Bio.Seq import translate
+
+# Output format passed to Exonerate via --ryo. Exonerate expands the escapes itself. One line
+# per alignment: query ID, target ID, target alignment begin and end, raw alignment score,
+# vulgar block and the aligned target sequence (which the called gene's codons are read from,
+# following the vulgar block).
+RYO_FORMAT = "RYO\\t%qi\\t%ti\\t%tab\\t%tae\\t%s\\t%V\\t%tas\\n"
+# Number of tab-separated fields in a complete output line.
+RYO_FIELDS = len(RYO_FORMAT.split("\\t"))
+
 
-class ExonerateGene:
+class ExonerateGene(object):
     """
     An object that stores the attributes of a gene called via Exonerate.
     """
-    def __init__(self, string):
+    __slots__ = ("contig_id", "locs", "id", "ref", "internal_stop", "introns", "prot", "nucl", "score")
+
+    def __init__(self, ref, contig_id, locs, introns, nucl, score=0):
         """
         Define the attributes of a ExonerateGene object.
 
@@ -21,71 +35,44 @@ class ExonerateGene:
         - introns:       Number of introns in called gene.
         - prot:          Called gene's translated protein sequence.
         - nucl:          Called gene's nucleotide sequence.
+        - score:         Raw Exonerate alignment score.
 
         All attributes above are derived ultimately from exonerate output.
 
         Note: locs are always given in "positive" sense, regardless of gene's
         actual sense, this is consistent with Biopython.SearchIO.
+        """
+        # Translate coding sequence (whole aligned codons only, see AlignedCodons).
+        prot = translate(nucl.upper())
+
+        # Populate attributes.
+        self.ref = "Exonerate={0}".format(ref)
+        self.contig_id = contig_id
+        self.locs = (min(locs), max(locs))
+        self.id = "{0}_{1}".format(contig_id, "_".join(str(loc) for loc in self.locs))
+        self.internal_stop = "IS={0}".format(str("*" in prot[:-1]))
+        self.introns = "Introns={0}".format(str(introns))
+        self.prot = prot
+        self.nucl = nucl
+        self.score = score
 
-        Note: In weird cases, exonerate-text returns a negative start
-        co-ordinate for some (not all?) reverse complement genes. I put in
-        a second parse using exonerate-vulgar to determine co-ordinates for
-        genes.
+    def __getstate__(self):
         """
-        
-        # Temporary variables.
-        contig_id = ""
-        introns = 0
-        prot = []
-        nucl = []
-        
-        # Parse text alignment in exonerate result, get attributes and nuclear/protein data.
-        # When adding protein sequence from sequence with introns, remove ambiguous
-        # residues (X) that may arise from intron/exon boundaries (does happen).
-        for result in SearchIO.parse(string, "exonerate-text"):
-            ref = result.id
-            stop = False
-            for hit in result:
-                contig_id = hit.id
-                introns = len(hit[0].hit_inter_ranges)
-                for fragment in hit[0].fragments:
-                    for record in fragment.aln._records:
-                        if record.name == "aligned hit sequence":
-                            seq = str(record.seq)
-                            if seq.startswith("X"):
-                                prot.append(seq[1:])
-                            elif seq.endswith("X"):
-                                prot.append(seq[:-1])
-                            else:
-                                prot.append(seq)
-                            if "*" in record.seq[:-1]:
-                                stop = True
-                    cds_region = filter(lambda x: len(x) == 3, fragment.aln_annotation["hit_annotation"])
-                    nucl.append(str("".join(cds_region)))
-            
-            # Populate attributes.
-            self.ref = "Exonerate={0}".format(str(ref))
-            self.contig_id = contig_id
-            self.internal_stop = "IS={0}".format(str(stop))
-            self.introns = "Introns={0}".format(str(introns))
-            self.prot = "".join(prot)
-            self.nucl = "".join(nucl)
-        
-        # Reread result and parse the vulgar output.
-        string.seek(0)
-        for result in SearchIO.parse(string, "exonerate-vulgar"):
-            for hit in result:
-                locs = hit[0].hit_range
-                gene_id = "{0}_{1}".format(hit.id, "_".join(str(loc) for loc in locs))
-                
-                # Populate attributes.
-                self.locs = locs
-                self.id = gene_id
-                
+        Return attributes as a tuple, keeps objects small when pickled between processes.
+        """
+        return tuple(getattr(self, slot) for slot in self.__slots__)
+
+    def __setstate__(self, state):
+        """
+        Restore attributes from tuple returned by __getstate__.
+        """
+        for slot, value in zip(self.__slots__, state):
+            setattr(self, slot, value)
+
     def __str__(self):
         """
         Return a string summary of a called gene, a la Biopython.SeqIO.
-        
+
         Useful for debugging?
         """
         lines = []
@@ -118,3 +105,54 @@ class ExonerateGene:
         else:
             lines.append("Called protein sequence: {0}\n".format(self.prot))
         return "\n".join(lines)
+
+
+def AlignedCodons(vulgar, seq):
+    """
+    Return the coding sequence of the target side of a protein2genome alignment, given its vulgar
+    triples (label, query length, target length) and the aligned target sequence: the whole codons
+    in match (M), codon (C) and gap (G) blocks, in alignment order. Bases of split codons (S),
+    frameshifts (F), splice sites (5, 3), introns (I) and non-equivalenced regions (N) are left out,
+    as they were when gene models were read from Exonerate's alignment output, so the coding
+    sequence translates in frame to the protein Exonerate shows (less its placeholders).
+    """
+    codons = []
+    pos = 0
+    for i in range(0, len(vulgar) - 2, 3):
+        label, length = vulgar[i], int(vulgar[i + 2])
+        if label in ["M", "C", "G"]:
+            codons.append(seq[pos:pos + length - length % 3])
+        pos = pos + length
+    return "".join(codons)
+
+
+def ParseExonerateOutput(handle):
+    """
+    Parse Exonerate output written in RYO_FORMAT line by line, yielding an ExonerateGene for
+    each query with a hit. Works on the output of single- and multi-protein query files alike.
+
+    If a query has more than one alignment (ties under --bestn 1), only its first alignment
+    is used. Other lines (command line, hostname, &c.) are ignored, as are incomplete lines
+    (e.g. the last line of a killed Exonerate process).
+    """
+    last_query = None
+    for line in handle:
+        if not line.startswith("RYO\t") or not line.endswith("\n"):
+            continue
+        fields = line.rstrip("\n").split("\t")
+        if len(fields) != RYO_FIELDS:
+            continue
+        if fields[1] == last_query:
+            continue
+        last_query = fields[1]
+
+        # Vulgar block may or may not be prefixed with the 9 sugar fields. Introns are counted as
+        # the gaps between exonic fragments of the alignment, as Biopython's SearchIO does, i.e. the
+        # introns (I) and frameshifts (F) in the match/gap/intron triples that follow.
+        vulgar = fields[6].split()
+        if len(vulgar) >= 9 and vulgar[0] == fields[1] and (len(vulgar) - 9) % 3 == 0:
+            vulgar = vulgar[9:]
+        introns = vulgar[0::3].count("I") + vulgar[0::3].count("F")
+
+        yield ExonerateGene(fields[1], fields[2], (int(fields[3]), int(fields[4])), introns,
+                            AlignedCodons(vulgar, fields[7]), int(fields[5]))
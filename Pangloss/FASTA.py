@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+FASTA: Lightweight FASTA reading, writing and indexing, used across Pangloss in place of Bio.SeqIO
+wherever only headers and sequences are needed.
+
+Records are plain (header, sequence) string tuples, with the header being the full header line
+without its ">" (use FASTAId for the first word, which is what Bio.SeqIO calls the ID). Records
+are written wrapped at 60 columns with the header as given, so files written here are identical
+to those written by Bio.SeqIO for the same records. Files ending in .gz or .bgz are read
+(and written, through OpenFile) via gzip.
+"""
+
+import gzip
+import mmap
+import os
+
+# Number of records joined into a single write call by WriteFASTA.
+WRITE_BATCH = 1000
+
+
+def FASTAId(header):
+    """
+    Return the ID of a record (first word of its header).
+    """
+    return header.split(None, 1)[0] if header.strip() else ""
+
+
+def IsCompressed(path):
+    """
+    Return True if a file is gzip or bgzip compressed (judging by its extension).
+    """
+    return path.endswith((".gz", ".bgz"))
+
+
+def OpenFile(path, mode="r"):
+    """
+    Open a file for reading or writing, through gzip if it's compressed (bgzip files are valid
+    gzip files, so read the same way). Compressed files are written at the fastest level.
+    """
+    if IsCompressed(path):
+        return gzip.open(path, mode.replace("b", "") + "b", 1)
+    return open(path, mode)
+
+
+def ReadFASTA(path, use_mmap=False):
+    """
+    Yield (header, sequence) tuples from a FASTA file in file order. The file is either read
+    through a large buffer line by line, or (if use_mmap is enabled) memory-mapped and split
+    into records with string searches, which is faster for large files. Compressed files are
+    always streamed line by line, without being decompressed to disk.
+    """
+    with (OpenFile(path, "rb") if IsCompressed(path) else open(path, "rb", 1048576)) as handle:
+        if use_mmap and not IsCompressed(path) and os.path.getsize(path):
+            data = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for record in SplitRecords(data, data.find(">"), len(data)):
+                    yield record
+            finally:
+                data.close()
+            return
+
+        header = None
+        seq = []
+        for line in handle:
+            if line.startswith(">"):
+                if header is not None:
+                    yield header, "".join(seq)
+                header = line[1:].rstrip()
+                seq = []
+            else:
+                seq.extend(line.split())
+        if header is not None:
+            yield header, "".join(seq)
+
+
+def SplitRecords(data, start, end):
+    """
+    Yield (header, sequence) tuples from the records in a string or memory map between start
+    (the position of a ">") and end.
+    """
+    while start != -1 and start < end:
+        newline = data.find("\n", start, end)
+        if newline == -1:
+            yield data[start + 1:end].rstrip(), ""
+            return
+        next_start = data.find("\n>", newline, end)
+        stop = end if next_start == -1 else next_start
+        yield data[start + 1:newline].rstrip(), "".join(data[newline + 1:stop].split())
+        start = -1 if next_start == -1 else next_start + 1
+
+
+def WriteFASTA(handle, records, width=60):
+    """
+    Write (header, sequence) tuples to an open file in FASTA format, wrapping sequences at the
+    same width as Bio.SeqIO. Records are formatted in batches and written with one call per batch.
+    Returns the number of records written.
+    """
+    batch = []
+    count = 0
+    for header, seq in records:
+        batch.append(">{0}\n".format(header))
+        batch.extend(seq[i:i + width] + "\n" for i in xrange(0, len(seq), width))
+        count = count + 1
+        if count % WRITE_BATCH == 0:
+            handle.write("".join(batch))
+            batch = []
+    if batch:
+        handle.write("".join(batch))
+    return count
+
+
+class FASTAIndex(object):
+    """
+    Offset index of the records in a FASTA file, keyed by record ID, for random access without
+    loading the file (a lighter Bio.SeqIO.index). Records are read from a memory map of the file.
+    """
+
+    def __init__(self, path):
+        """
+        Index a FASTA file.
+
+        - path:    Path of FASTA file.
+        - ids:     Record IDs in file order.
+        - offsets: Dictionary of record IDs to (start, end) byte offsets of their records.
+
+        Raises ValueError if an ID appears more than once, like Bio.SeqIO.index.
+        """
+        self.path = path
+        self.ids = []
+        self.offsets = {}
+        self.handle = open(path, "rb")
+        if os.path.getsize(path):
+            self.data = mmap.mmap(self.handle.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.data = ""
+
+        # Find start of every record, record ID is the first word of its header.
+        start = self.data.find(">")
+        while start != -1:
+            newline = self.data.find("\n", start)
+            next_start = self.data.find("\n>", start)
+            end = len(self.data) if next_start == -1 else next_start + 1
+            record_id = FASTAId(self.data[start + 1:len(self.data) if newline == -1 else newline])
+            if record_id in self.offsets:
+                raise ValueError("FASTA: Duplicate key {0} in {1}.".format(record_id, path))
+            self.ids.append(record_id)
+            self.offsets[record_id] = (start, end)
+            start = -1 if next_start == -1 else next_start + 1
+
+    def __contains__(self, record_id):
+        return record_id in self.offsets
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, record_id):
+        """
+        Return (header, sequence) tuple of a record.
+        """
+        start, end = self.offsets[record_id]
+        return next(SplitRecords(self.data, start, end))
+
+    def Fetch(self, record_ids):
+        """
+        Yield (header, sequence) tuples of several records, in the given order.
+        """
+        for record_id in record_ids:
+            yield self[record_id]
+
+    def Close(self):
+        """
+        Unmap and close the FASTA file.
+        """
+        if self.data:
+            self.data.close()
+        self.handle.close()
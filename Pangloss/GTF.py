@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+GTF: Streaming GTF/GFF3 parser used by PanGuess to read GeneMark-ES and TransDecoder output.
+
+Rows are read one at a time and grouped into genes, with only the current gene held in memory.
+Comment lines, blank lines (which separate genes in TransDecoder GFF3 files) and any other rows
+without the standard 9 columns are skipped.
+"""
+
+from collections import namedtuple
+from csv import reader
+
+# A gene parsed from a GTF/GFF3 file.
+# - contig:        ID of contig (first word of column 1).
+# - start, end:    Smallest and largest co-ordinates over all of the gene's rows.
+# - strand:        Strand of gene.
+# - exons:         Number of exon rows.
+# - gene_id:       gene_id attribute (GTF), or ID of gene row (GFF3).
+# - transcript_id: transcript_id attribute (GTF), or parent of the CDS rows (GFF3).
+# - cds:           Smallest and largest co-ordinates over CDS rows, or None if there aren't any.
+GeneRecord = namedtuple("GeneRecord", ["contig", "start", "end", "strand", "exons", "gene_id", "transcript_id", "cds"])
+
+
+def GTFAttributes(column):
+    """
+    Return dictionary of attributes in column 9 of a GTF row (key "value"; pairs).
+    """
+    attributes = {}
+    for pair in column.split(";"):
+        pair = pair.strip().split(" ", 1)
+        if len(pair) == 2:
+            attributes[pair[0]] = pair[1].strip("\"")
+    return attributes
+
+
+def GFF3Attributes(column):
+    """
+    Return dictionary of attributes in column 9 of a GFF3 row (key=value; pairs).
+    """
+    attributes = {}
+    for pair in column.split(";"):
+        pair = pair.strip().split("=", 1)
+        if len(pair) == 2:
+            attributes[pair[0]] = pair[1]
+    return attributes
+
+
+def ParseGeneRecords(path, fmt="gtf"):
+    """
+    Parse a GTF (fmt="gtf") or GFF3 (fmt="gff3") file into GeneRecords, yielded one at a time
+    in file order.
+
+    GTF rows are grouped into genes by runs of the same gene_id. GFF3 rows are grouped by gene
+    row, with each gene's rows running until the next gene row (as in TransDecoder output).
+    """
+    gene = None
+    for row in reader(open(path), delimiter="\t"):
+        if len(row) != 9 or row[0].startswith("#"):
+            continue
+        start, end = int(row[3]), int(row[4])
+
+        # Work out which gene row belongs to, yield last gene if it's a new one.
+        if fmt == "gtf":
+            attributes = GTFAttributes(row[8])
+            gene_id = attributes.get("gene_id")
+            new_gene = gene is None or gene_id != gene["gene_id"]
+        else:
+            attributes = GFF3Attributes(row[8])
+            gene_id = attributes.get("ID") if row[2] == "gene" else gene["gene_id"] if gene else None
+            new_gene = gene is None or row[2] == "gene"
+        if new_gene:
+            if gene:
+                yield GeneRecordFromDict(gene)
+            gene = {"contig": row[0].split()[0], "start": start, "end": end, "strand": row[6], "exons": 0,
+                    "gene_id": gene_id, "transcript_id": attributes.get("transcript_id"), "cds": None}
+
+        # Update gene with row.
+        gene["start"] = min(gene["start"], start)
+        gene["end"] = max(gene["end"], end)
+        if row[2] == "exon":
+            gene["exons"] += 1
+        elif row[2] == "CDS":
+            if fmt == "gff3":
+                gene["transcript_id"] = attributes.get("Parent")
+            if gene["cds"]:
+                gene["cds"] = (min(gene["cds"][0], start), max(gene["cds"][1], end))
+            else:
+                gene["cds"] = (start, end)
+
+    # Yield last gene in file.
+    if gene:
+        yield GeneRecordFromDict(gene)
+
+
+def GeneRecordFromDict(gene):
+    """
+    Freeze a gene being built by ParseGeneRecords into a GeneRecord.
+    """
+    return GeneRecord(gene["contig"], gene["start"], gene["end"], gene["strand"], gene["exons"],
+                      gene["gene_id"], gene["transcript_id"], gene["cds"])
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""
+GeneModelStore: Indexed store of predicted gene model sets, shared by QualityCheck, PanOCT and Karyotype.
+
+Each strain's gene models are written by PanGuess as three parallel text files in gm_pred/sets
+(<tag>.faa, <tag>.nucl and <tag>.attributes). GeneModelStore loads them once into a SQLite database
+(gm_pred/sets/genemodels.sqlite) holding protein, nucleotide and attributes rows keyed by gene ID, so
+later steps can fetch or delete genes in bulk instead of re-parsing and re-indexing the text files.
+
+The text files stay the primary copy, as PanOCT and BLAST read them directly. A strain is reloaded
+whenever its text files change size or modification time, and any change made through the store is
+exported back to the text files straight away.
+
+Strains without their own text files (e.g. runs that skip gene prediction and supply only the
+concatenated gene model sets) are loaded from the concatenated files instead (allprot.db, allnucl.db
+and allatt.db), split by the strain tag in the last column of allatt.db.
+"""
+
+import logging
+import os
+import sqlite3
+from collections import OrderedDict as od
+
+from FASTA import FASTAId, ReadFASTA, WriteFASTA
+
+# Largest number of gene IDs per "IN (...)" query (SQLite's default limit on variables is 999).
+QUERY_SIZE = 500
+
+
+def FileStamp(paths):
+    """
+    Return a string of the sizes and modification times of the given files.
+    """
+    stats = [os.stat(path) for path in paths]
+    return " ".join("{0}:{1}".format(stat.st_size, stat.st_mtime) for stat in stats)
+
+
+def AttributeRows(tag, lines, prot, aa_path, nucl, nt_path):
+    """
+    Return store rows for a strain's attributes lines, given dictionaries of gene IDs to (header,
+    sequence) of the protein and nucleotide files they're found in. Raises ValueError if a gene is
+    missing from either.
+    """
+    rows = []
+    for line in lines:
+        gene_id = line.split("\t")[1]
+        for seqs, path in [(prot, aa_path), (nucl, nt_path)]:
+            if gene_id not in seqs:
+                raise ValueError("GeneModelStore: {0} has no sequence in {1}.".format(gene_id, path))
+        rows.append((gene_id, tag) + prot[gene_id] + nucl[gene_id] + (line,))
+    return rows
+
+
+class GeneModelStore(object):
+    """
+    SQLite store of gene model sets for all strains in gm_pred/sets.
+    """
+
+    def __init__(self, sdir="./gm_pred/sets"):
+        """
+        Open (or create) the store in the given gene model set folder.
+
+        - sdir: Folder holding <tag>.faa, <tag>.nucl and <tag>.attributes for each strain.
+        - path: Path of SQLite database.
+        """
+        self.sdir = sdir
+        self.path = "{0}/genemodels.sqlite".format(sdir)
+        self.db = sqlite3.connect(self.path)
+        self.db.text_factory = str
+        self.db.execute("CREATE TABLE IF NOT EXISTS strains (tag TEXT PRIMARY KEY, stamp TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS genes (gene_id TEXT PRIMARY KEY, tag TEXT, "
+                        "prot_header TEXT, prot TEXT, nucl_header TEXT, nucl TEXT, attributes TEXT)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS genes_tag ON genes (tag)")
+        self.db.commit()
+
+    def Paths(self, tag):
+        """
+        Return paths of a strain's protein, nucleotide and attributes files.
+        """
+        return ["{0}/{1}.{2}".format(self.sdir, tag, ext) for ext in ["faa", "nucl", "attributes"]]
+
+    def CombinedPaths(self):
+        """
+        Return paths of the concatenated protein, nucleotide and attributes files of all strains.
+        """
+        return ["{0}/{1}.db".format(self.sdir, name) for name in ["allprot", "allnucl", "allatt"]]
+
+    def Stamp(self, tag):
+        """
+        Return a string of the sizes and modification times of a strain's text files.
+        """
+        return FileStamp(self.Paths(tag))
+
+    def Sync(self, tags):
+        """
+        Make the store match the text files of the given strains: strains whose files have changed
+        since they were loaded are reloaded, and strains not in the list are dropped. Strains without
+        text files of their own are loaded from the concatenated files of all strains (see
+        LoadCombined). Raises IOError if neither are there.
+        """
+        combined = [tag for tag in tags if not all(os.path.isfile(path) for path in self.Paths(tag))]
+        if combined:
+            missing = [path for path in self.CombinedPaths() if not os.path.isfile(path)]
+            if missing:
+                raise IOError("GeneModelStore: Missing gene model set files for {0}, and concatenated gene model "
+                              "sets {1} to load them from.".format(", ".join(combined), ", ".join(missing)))
+        stored = dict(self.db.execute("SELECT tag, stamp FROM strains"))
+        for tag in set(stored) - set(tags):
+            self.DropStrain(tag)
+        for tag in tags:
+            if tag not in combined and stored.get(tag) != self.Stamp(tag):
+                self.LoadStrain(tag)
+        combined_stamp = "combined " + FileStamp(self.CombinedPaths()) if combined else None
+        combined = [tag for tag in combined if stored.get(tag) != combined_stamp]
+        if combined:
+            self.LoadCombined(combined, combined_stamp)
+        self.db.commit()
+
+    def DropStrain(self, tag):
+        """
+        Remove all of a strain's genes from the store.
+        """
+        self.db.execute("DELETE FROM genes WHERE tag = ?", (tag,))
+        self.db.execute("DELETE FROM strains WHERE tag = ?", (tag,))
+
+    def LoadStrain(self, tag):
+        """
+        (Re)load a strain's genes from its text files. Genes are stored in attributes file order,
+        followed by any sequences without an attributes row (which are kept, but have no attributes
+        and only the sequences they were found with). Raises ValueError if a gene in the attributes
+        file is missing from either FASTA file.
+        """
+        aa_path, nt_path, at_path = self.Paths(tag)
+        prot = od((FASTAId(header), (header, seq)) for header, seq in ReadFASTA(aa_path, True))
+        nucl = od((FASTAId(header), (header, seq)) for header, seq in ReadFASTA(nt_path, True))
+        lines = [line.rstrip("\n") for line in open(at_path) if line.rstrip("\n")]
+        rows = AttributeRows(tag, lines, prot, aa_path, nucl, nt_path)
+        found = set(row[0] for row in rows)
+
+        # Keep sequences without an attributes row.
+        for gene_id in list(prot) + list(nucl):
+            if gene_id in found:
+                continue
+            found.add(gene_id)
+            prot_header, prot_seq = prot.get(gene_id, (None, None))
+            nucl_header, nucl_seq = nucl.get(gene_id, (None, None))
+            rows.append((gene_id, tag, prot_header, prot_seq, nucl_header, nucl_seq, None))
+        self.InsertStrain(tag, rows, self.Stamp(tag))
+
+    def LoadCombined(self, tags, stamp):
+        """
+        (Re)load strains from the concatenated files of all strains, each strain's genes being those
+        of its rows in allatt.db (in file order). Sequences without an attributes row can't be told
+        apart by strain, so are left out. Raises ValueError as LoadStrain does.
+        """
+        aa_path, nt_path, at_path = self.CombinedPaths()
+        prot = dict((FASTAId(header), (header, seq)) for header, seq in ReadFASTA(aa_path, True))
+        nucl = dict((FASTAId(header), (header, seq)) for header, seq in ReadFASTA(nt_path, True))
+        lines = dict((tag, []) for tag in tags)
+        for line in open(at_path):
+            line = line.rstrip("\n")
+            if line and line.split("\t")[-1] in lines:
+                lines[line.split("\t")[-1]].append(line)
+        for tag in tags:
+            self.InsertStrain(tag, AttributeRows(tag, lines[tag], prot, aa_path, nucl, nt_path), stamp)
+
+    def InsertStrain(self, tag, rows, stamp):
+        """
+        Replace a strain's genes in the store with the given rows, recording the stamp of the files
+        they were loaded from.
+        """
+        self.DropStrain(tag)
+        self.db.executemany("INSERT OR REPLACE INTO genes VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        self.db.execute("INSERT INTO strains VALUES (?, ?)", (tag, stamp))
+        logging.info("GeneModelStore: Loaded {0} gene models for {1}.".format(len(rows), tag))
+
+    def Fetch(self, gene_ids, seq_type="prot"):
+        """
+        Return (header, sequence) tuples of the given genes, in the given order. seq_type is
+        either "prot" or "nucl". Raises KeyError for any gene not in the store, or without a sequence
+        of that type.
+        """
+        if seq_type not in ["prot", "nucl"]:
+            raise ValueError("GeneModelStore: Unknown sequence type {0}.".format(seq_type))
+        found = {}
+        unique = list(set(gene_ids))
+        for i in range(0, len(unique), QUERY_SIZE):
+            chunk = unique[i:i + QUERY_SIZE]
+            query = "SELECT gene_id, {0}_header, {0} FROM genes WHERE gene_id IN ({1})".format(
+                seq_type, ", ".join("?" * len(chunk)))
+            for gene_id, header, seq in self.db.execute(query, chunk):
+                if seq is not None:
+                    found[gene_id] = (header, seq)
+        return [found[gene_id] for gene_id in gene_ids]
+
+    def Attributes(self, tags):
+        """
+        Yield attributes rows (as lists) for all genes of the given strains, in strain order.
+        """
+        for tag in tags:
+            query = "SELECT attributes FROM genes WHERE tag = ? AND attributes IS NOT NULL ORDER BY rowid"
+            for row in self.db.execute(query, (tag,)):
+                yield row[0].split("\t")
+
+    def Delete(self, gene_ids):
+        """
+        Delete genes from the store, and export the text files of every strain that lost genes.
+        Returns the number of genes deleted.
+        """
+        gene_ids = list(set(gene_ids))
+        tags = set()
+        for i in range(0, len(gene_ids), QUERY_SIZE):
+            chunk = gene_ids[i:i + QUERY_SIZE]
+            query = "SELECT DISTINCT tag FROM genes WHERE gene_id IN ({0})".format(", ".join("?" * len(chunk)))
+            tags.update(row[0] for row in self.db.execute(query, chunk))
+        deleted = self.db.executemany("DELETE FROM genes WHERE gene_id = ?", ((gene_id,) for gene_id in gene_ids))
+        for tag in tags:
+            self.ExportStrain(tag)
+        self.db.commit()
+        return deleted.rowcount
+
+    def ExportStrain(self, tag):
+        """
+        Write a strain's genes back to its protein, nucleotide and attributes files.
+        """
+        aa_path, nt_path, at_path = self.Paths(tag)
+        query = "SELECT prot_header, prot, nucl_header, nucl, attributes FROM genes WHERE tag = ? ORDER BY rowid"
+        rows = self.db.execute(query, (tag,)).fetchall()
+        with open(aa_path, "w") as outpro:
+            WriteFASTA(outpro, ((row[0], row[1]) for row in rows if row[1] is not None))
+        with open(nt_path, "w") as outnuc:
+            WriteFASTA(outnuc, ((row[2], row[3]) for row in rows if row[3] is not None))
+        with open(at_path, "w") as outatt:
+            for row in rows:
+                if row[4] is not None:
+                    outatt.write(row[4] + "\n")
+        self.db.execute("UPDATE strains SET stamp = ? WHERE tag = ?", (self.Stamp(tag), tag))
+
+    def Close(self):
+        """
+        Commit any changes and close the store.
+        """
+        self.db.commit()
+        self.db.close()
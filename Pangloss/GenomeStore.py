@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+GenomeStore: Packed genome sequences with memory-mapped random access, shared by PanGuess and Karyotype.
+
+The first time a genome is opened, its FASTA file is imported into a store folder in the working directory
+rather than the (possibly read-only or shared) genome folder, e.g. gm_pred/genomes/STRAIN.fna.seq and
+STRAIN.fna.idx, named after the genome's full file name so STRAIN.fa and STRAIN.fna never share a
+store: contig sequences are written back to back as plain bytes with no headers or line breaks, and the
+index lists each contig's ID, offset and length in file order. Afterwards the .seq file is
+memory-mapped, so contig lengths come from the index and slices of a contig are read straight
+from the page cache without parsing the FASTA file again.
+
+Compressed (.gz/.bgz) genomes are streamed through gzip on import rather than decompressed to disk first.
+The index records the size and modification time of the FASTA file, and the genome is re-imported if
+either changes. Sequences are stored as given (case and ambiguity codes included) rather than 2-bit
+packed, so slices can be returned without decoding.
+"""
+
+import logging
+import mmap
+import os
+
+from FASTA import OpenFile
+
+
+class GenomeStore(object):
+    """
+    Read-only, memory-mapped access to the contigs of a genome FASTA file.
+    """
+
+    def __init__(self, genome, sdir="./gm_pred/genomes"):
+        """
+        Open the store of a genome, importing the genome first if needed.
+
+        - genome:  Path of genome FASTA file.
+        - sdir:    Store folder.
+        - seq:     Path of packed sequence file.
+        - idx:     Path of index file.
+        - contigs: Ordered list of contig IDs.
+        - index:   Dictionary of contig IDs to (offset, length).
+        """
+        self.genome = genome
+        name = os.path.basename(genome)
+        self.seq = "{0}/{1}.seq".format(sdir, name)
+        self.idx = "{0}/{1}.idx".format(sdir, name)
+        if not self.ReadIndex():
+            self.Import()
+            self.ReadIndex()
+
+        # Map sequence file (mmap can't map empty files, so genomes without sequence get an empty string).
+        self.handle = open(self.seq, "rb")
+        if os.path.getsize(self.seq):
+            self.data = mmap.mmap(self.handle.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.data = ""
+
+    def Stamp(self):
+        """
+        Return a string of the size and modification time of the genome FASTA file.
+        """
+        stat = os.stat(self.genome)
+        return "{0}:{1}".format(stat.st_size, stat.st_mtime)
+
+    def ReadIndex(self):
+        """
+        Read the index file into contigs and index. Returns False if there's no index or it's out of date.
+        """
+        if not os.path.isfile(self.idx) or not os.path.isfile(self.seq):
+            return False
+        with open(self.idx) as infile:
+            if infile.readline().rstrip("\n") != "# {0}".format(self.Stamp()):
+                return False
+            self.contigs = []
+            self.index = {}
+            for line in infile:
+                contig, offset, length = line.rstrip("\n").split("\t")
+                self.contigs.append(contig)
+                self.index[contig] = (int(offset), int(length))
+        return True
+
+    def Import(self):
+        """
+        Import the genome FASTA file into the store, streaming it line by line (through gzip if compressed).
+        Files are written under temporary names and moved into place when complete, so a partial import
+        is never read.
+        """
+        sdir = os.path.dirname(self.seq)
+        try:
+            os.makedirs(sdir)
+        except OSError:
+            if not os.path.isdir(sdir):
+                raise
+        stamp = self.Stamp()
+        rows = []
+        offset = 0
+        contig = None
+        length = 0
+        with open(self.seq + ".tmp", "wb") as outfile:
+            for line in OpenFile(self.genome):
+                if line.startswith(">"):
+                    if contig is not None:
+                        rows.append((contig, offset, length))
+                        offset = offset + length
+                    contig = line[1:].split()[0]
+                    length = 0
+                else:
+                    bases = "".join(line.split())
+                    outfile.write(bases)
+                    length = length + len(bases)
+            if contig is not None:
+                rows.append((contig, offset, length))
+        with open(self.idx + ".tmp", "w") as outfile:
+            outfile.write("# {0}\n".format(stamp))
+            for row in rows:
+                outfile.write("{0}\t{1}\t{2}\n".format(*row))
+        os.rename(self.seq + ".tmp", self.seq)
+        os.rename(self.idx + ".tmp", self.idx)
+        logging.info("GenomeStore: Imported {0} contigs ({1} bp) from {2}.".format(len(rows), offset + length,
+                                                                                  self.genome))
+
+    def __contains__(self, contig):
+        return contig in self.index
+
+    def Contigs(self):
+        """
+        Return list of (contig ID, length) tuples in genome file order.
+        """
+        return [(contig, self.index[contig][1]) for contig in self.contigs]
+
+    def Length(self, contig):
+        """
+        Return length of a contig.
+        """
+        return self.index[contig][1]
+
+    def Fetch(self, contig, start=0, end=None):
+        """
+        Return the sequence of a contig from start to end as a string, with 0-based, end-exclusive
+        co-ordinates like a Python slice, clipped to the contig (negative values count as 0 rather than from
+        the end). Defaults to the whole contig.
+        """
+        offset, length = self.index[contig]
+        end = length if end is None else min(max(end, 0), length)
+        start = min(max(start, 0), end)
+        return self.data[offset + start:offset + end]
+
+    def Close(self):
+        """
+        Unmap and close the sequence file.
+        """
+        if self.data:
+            self.data.close()
+        self.handle.close()
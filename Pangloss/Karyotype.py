@@ -11,25 +11,25 @@ import os
 import shutil
 import subprocess as sp
 import sys
-from csv import reader
 from glob import glob
 
-from Bio import SeqIO
+from GeneModelStore import GeneModelStore
+from GenomeStore import GenomeStore
+from Tools import Flatten, GenomeTags, ParseMatchtable, ParseKaryotypes, TryMkDirs
 
-from Tools import Flatten, ParseMatchtable, ParseKaryotypes, TryMkDirs
 
-
-def GenerateContigLengths(genomes):
+def GenerateContigLengths(genomes, sdir):
     """
-    Parse sequences in original genomes (contigs, chromosomes, &c.) and write their lengths to file.
+    Read lengths of sequences in original genomes (contigs, chromosomes, &c.) from their genome stores (in sdir)
+    and write them to file. Compressed genomes are read into their genome stores straight from the compressed file.
     """
     lengths = []
-    for genome in glob("{0}/*.fna".format(genomes)):
+    for genome in sorted(glob("{0}/*.fna".format(genomes)) + glob("{0}/*.fna.gz".format(genomes)) +
+                         glob("{0}/*.fna.bgz".format(genomes))):
         tag = genome.split("/")[2].split(".")[0]
-        gen = []
-        for seq in SeqIO.parse(genome, "fasta"):
-            gen.append([seq.id, "1", str(len(seq.seq)), tag])
-        lengths.append(gen)
+        store = GenomeStore(genome, sdir)
+        lengths.append([[contig, "1", str(length), tag] for contig, length in store.Contigs()])
+        store.Close()
 
     with open("{0}/lengths.txt".format(genomes), "w") as out:
         for gen in lengths:
@@ -38,15 +38,18 @@ def GenerateContigLengths(genomes):
                 row += "\n"
                 out.write(row)
 
-def GenerateKaryotypeFiles(attributes, matchtable):
+def GenerateKaryotypeFiles(genomes, matchtable, sdir):
     """
-    Parse concatenated attributes file and PanOCT matchtable, and generate the input needed for Karyotype.R.
+    Read attributes of all strains' gene models from the gene model store (in sdir) and parse PanOCT matchtable, and
+    generate the input needed for Karyotype.R.
     """
-    attread = reader(open(attributes), delimiter="\t")
+    tags = GenomeTags(genomes)
+    store = GeneModelStore(sdir)
+    store.Sync(tags)
     core, acc = ParseMatchtable(matchtable)
     karyotype = []
 
-    for row in attread:
+    for row in store.Attributes(tags):
         karyo = [row[0], row[1], row[2], row[3]]
         core_gms = Flatten(core.values())
         acc_gms = Flatten(acc.values())
@@ -71,6 +74,7 @@ def GenerateKaryotypeFiles(attributes, matchtable):
             line = "\t".join(karyo)
             line += "\n"
             out.write(line)
+    store.Close()
 
 
 def KaryoPloteR(tags, karyotypes, lengths):
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+ORF: Built-in open reading frame caller for non-coding regions, used by PanGuess in place of
+TransDecoder if ncr_orf_caller = builtin in the config file.
+
+For each non-coding region (NCR), all six frames are scanned for complete ORFs (ATG to stop
+codon) using NumPy codon lookups over the NCR's bytes, and the single longest ORF of at least
+the minimum protein length is called. Output is written in the format TransDecoder.Predict
+writes (NCR.fna.transdecoder.gff3/.pep/.cds), so it can be read by TransDecoderGTFToAttributes
+and ConstructGeneModelSets as is.
+
+Unlike TransDecoder, ORFs are not scored for coding potential and 5'/3' partial ORFs aren't
+called. Requires NumPy.
+"""
+
+from __future__ import division
+
+import logging
+
+import numpy as np
+
+from FASTA import FASTAId, ReadFASTA
+
+# Standard genetic code, for codons indexed as 16 * first + 4 * second + third base with
+# A = 0, C = 1, G = 2, T = 3. Codons with any other base are index 64 (X).
+CODON_TABLE = np.frombuffer(b"KNKNTTTTRSRSIIMIQHQHPPPPRRRRLLLLEDEDAAAAGGGGVVVV*Y*YSSSS*CWCLFLFX", dtype=np.uint8)
+START_CODON = 14  # ATG
+STOP_CODONS = np.array([48, 50, 56])  # TAA, TAG, TGA
+
+# Byte to base code lookup (anything other than A/C/G/T, either case, is 4) and complement lookup.
+BASE_CODES = np.full(256, 4, dtype=np.uint8)
+COMPLEMENT = np.arange(256, dtype=np.uint8)
+for base, code, comp in zip(b"ACGTacgt", [0, 1, 2, 3] * 2, b"TGCAtgca"):
+    BASE_CODES[ord(base)] = code
+    COMPLEMENT[ord(base)] = ord(comp)
+
+
+def Codons(seq):
+    """
+    Return codon indexes (see CODON_TABLE) starting at every position of a sequence given as
+    a NumPy byte array.
+    """
+    bases = BASE_CODES[seq].astype(np.int16)
+    if len(bases) < 3:
+        return np.zeros(0, dtype=np.int16)
+    codons = 16 * bases[:-2] + 4 * bases[1:-1] + bases[2:]
+    codons[(bases[:-2] > 3) | (bases[1:-1] > 3) | (bases[2:] > 3)] = 64
+    return codons
+
+
+def LongestStrandORF(seq):
+    """
+    Return (length, start, stop) of the longest complete ORF on the forward strand of a
+    sequence given as a NumPy byte array, with start/stop as 0-based positions of the
+    first base of the start and stop codons. Returns None if there are no complete ORFs.
+
+    For each start codon, the next in-frame stop codon is found with a binary search over
+    the stop codons in that frame, so the first start codon after a stop gives the longest
+    ORF ending at the next one.
+    """
+    codons = Codons(seq)
+    positions = np.arange(len(codons))
+    starts = positions[codons == START_CODON]
+    stops = positions[np.in1d(codons, STOP_CODONS)]
+    best = None
+    for frame in range(3):
+        frame_starts = starts[starts % 3 == frame]
+        frame_stops = stops[stops % 3 == frame]
+        if not len(frame_starts) or not len(frame_stops):
+            continue
+        index = np.searchsorted(frame_stops, frame_starts)
+        found = index < len(frame_stops)
+        if not found.any():
+            continue
+        orf_starts = frame_starts[found]
+        orf_stops = frame_stops[index[found]]
+        lengths = (orf_stops - orf_starts) // 3
+        longest = np.argmax(lengths)
+        orf = (int(lengths[longest]), int(orf_starts[longest]), int(orf_stops[longest]))
+        if not best or orf[0] > best[0] or (orf[0] == best[0] and orf[1] < best[1]):
+            best = orf
+    return best
+
+
+def LongestORF(seq, min_len):
+    """
+    Return the longest complete ORF over all six frames of a sequence (as a string) with
+    a protein of at least min_len amino acids, as a (strand, start, end, cds, protein)
+    tuple where start/end are 1-based positions on the forward strand including the stop
+    codon, and protein includes the trailing "*" like TransDecoder. Forward strand ORFs
+    win ties. Returns None if there's no ORF long enough.
+    """
+    forward = np.frombuffer(seq, dtype=np.uint8)
+    reverse = COMPLEMENT[forward][::-1]
+    best = None
+    for strand, strand_seq in [("+", forward), ("-", reverse)]:
+        orf = LongestStrandORF(strand_seq)
+        if orf and orf[0] >= min_len and (not best or orf[0] > best[0]):
+            best = (orf[0], strand, strand_seq, orf[1], orf[2] + 3)
+    if not best:
+        return None
+
+    # Translate ORF through codon table, convert to positions on forward strand.
+    length, strand, strand_seq, start, end = best
+    cds = strand_seq[start:end]
+    protein = CODON_TABLE[Codons(cds)[0::3]].tobytes()
+    if strand == "-":
+        start, end = len(seq) - end, len(seq) - start
+    return strand, start + 1, end, cds.tobytes().upper(), protein
+
+
+def CallORFs(ncr, min_len):
+    """
+    Call the longest complete ORF in every NCR in a FASTA file, and write calls to
+    <ncr>.transdecoder.gff3, .pep and .cds as TransDecoder.Predict would with the option
+    --single_best_only. ORFs are named <NCR ID>.p1.
+
+    Returns the number of ORFs called.
+    """
+    count = 0
+    with open(ncr + ".transdecoder.gff3", "w") as gff, open(ncr + ".transdecoder.pep", "w") as pep, \
+            open(ncr + ".transdecoder.cds", "w") as cds:
+        for ncr_header, seq in ReadFASTA(ncr, use_mmap=True):
+            orf = LongestORF(seq, min_len)
+            if not orf:
+                continue
+            strand, start, end, nucl, prot = orf
+            ncr_id = FASTAId(ncr_header)
+            gene_id = "GENE.{0}~~{0}.p1".format(ncr_id)
+            mrna_id = "{0}.p1".format(ncr_id)
+            header = "{0} {1}  ORF type:complete len:{2} ({3}),score=0 {4}:{5}-{6}({3})".format(
+                mrna_id, gene_id, len(prot) - 1, strand, ncr_id, start, end)
+
+            # GFF3 record spans the whole NCR, with UTRs either side of the CDS (if there's room).
+            five_utr = ("five_prime_UTR", "utr5p1")
+            three_utr = ("three_prime_UTR", "utr3p1")
+            if strand == "-":
+                five_utr, three_utr = three_utr, five_utr
+            rows = [[ncr_id, "transdecoder", "gene", 1, len(seq), ".", strand, ".",
+                     "ID={0};Name=ORF".format(gene_id)],
+                    [ncr_id, "transdecoder", "mRNA", 1, len(seq), ".", strand, ".",
+                     "ID={0};Parent={1};Name=ORF".format(mrna_id, gene_id)]]
+            if start > 1:
+                rows.append([ncr_id, "transdecoder", five_utr[0], 1, start - 1, ".", strand, ".",
+                             "ID={0}.{1};Parent={0}".format(mrna_id, five_utr[1])])
+            rows += [[ncr_id, "transdecoder", "exon", 1, len(seq), ".", strand, ".",
+                      "ID={0}.exon1;Parent={0}".format(mrna_id)],
+                     [ncr_id, "transdecoder", "CDS", start, end, ".", strand, "0",
+                      "ID=cds.{0};Parent={0}".format(mrna_id)]]
+            if end < len(seq):
+                rows.append([ncr_id, "transdecoder", three_utr[0], end + 1, len(seq), ".", strand, ".",
+                             "ID={0}.{1};Parent={0}".format(mrna_id, three_utr[1])])
+
+            # GFF3 gene records are separated by blank lines, as in TransDecoder.
+            if count:
+                gff.write("\n\n")
+            gff.write("\n".join("\t".join(str(field) for field in row) for row in rows))
+            pep.write(">{0}\n{1}\n".format(header, prot))
+            cds.write(">{0}\n{1}\n".format(header, nucl))
+            count = count + 1
+        if count:
+            gff.write("\n")
+
+    logging.info("ORF: Called {0} ORFs in {1}.".format(count, ncr))
+    return count
@@ -4,27 +4,29 @@ PAML: Module for handling yn00 selection analysis (and maybe CodeML in the futur
 """
 
 import cStringIO
+import logging
 import os
+import re
 
-from Bio import AlignIO, SeqIO
+from Bio import AlignIO
+from Bio.Data.CodonTable import TranslationError
 from Bio.Phylo.PAML import yn00
 from Bio.Phylo.PAML._paml import PamlError
-from glob import glob
+from Bio.Seq import translate
 
-from Tools import StringMUSCLE, Untranslate
+from ClusterArchive import ArchivePath, ClusterArchive
+from FASTA import FASTAId
+from Tools import LinkFile, StringMUSCLE, TryMkDirs, Untranslate
+
+# Alignment and yn00 result files of a cluster, named <cluster ID>.fna.aln(.yn00).
+YN00_FILE = re.compile(r"^((?:Core|Acc)_[^.]+)\.fna\.aln(?:\.yn00)?$")
 
 
 def TranslateCDS(seqs):
     """
-    Given a nucleotide FASTA file, translate each sequence.
+    Given a cluster's nucleotide (header, sequence) tuples, translate each sequence. Returns (ID, protein) tuples.
     """
-    tn = []
-    for seq in SeqIO.parse(seqs, "fasta"):
-        t = seq.translate()
-        t.id = seq.id
-        tn.append(t)
-
-    return tn
+    return [(FASTAId(header), translate(seq)) for header, seq in seqs]
 
 
 def MUSCLEAlign(ml_path, seqs):
@@ -35,7 +37,7 @@ def MUSCLEAlign(ml_path, seqs):
     return AlignIO.parse(cStringIO.StringIO(output), "fasta")
 
 
-def PutGaps(alignment, cluster):
+def PutGaps(alignment, seqs, output):
     """
     Given amino acid alignment, generate a matching nucleotide alignment which respects codons. Note: the alignment
     file that this function outputs contains sequence IDs without location data, as yn00 limits sequence IDs to 30
@@ -43,20 +45,20 @@ def PutGaps(alignment, cluster):
     parsing sequence IDs that contains dots (which will be fixed in 1.40) and/or sequence IDs that contains dots
     and are >30 characters in length.
     """
-    nucl = SeqIO.index(cluster, "fasta")
+    nucl = dict((FASTAId(header), seq) for header, seq in seqs)
     nucl_aln = ""
     for aln in alignment:
         for seq in aln._records:
-            nseq = nucl[seq.id].seq
+            nseq = nucl[seq.id]
             aseq = seq.seq
             unseq = Untranslate(aseq, nseq)
             unseq.id = seq.id.split("|")[0]
             nucl_aln += (">{0}\n{1}\n".format(unseq.id, unseq.seq))
 
     fas_aln = AlignIO.read(cStringIO.StringIO(nucl_aln), "fasta")
-    AlignIO.write(fas_aln, "{0}.aln".format(cluster), "phylip-sequential")
+    AlignIO.write(fas_aln, output, "phylip-sequential")
 
-    return "{0}.aln".format(cluster)
+    return output
 
 
 def RunYn00(yn_path, alignment):
@@ -72,18 +74,120 @@ def RunYn00(yn_path, alignment):
         pass
 
 
+def ReadFingerprints(ydir):
+    """
+    Return dictionary of cluster IDs to the fingerprints (see ClusterArchive.Fingerprint) of the clusters
+    that the yn00 results in a yn00 folder were run on.
+    """
+    path = "{0}/fingerprints.txt".format(ydir)
+    if not os.path.isfile(path):
+        return {}
+    return dict(line.rstrip("\n").split("\t") for line in open(path))
+
+
+def WriteFingerprints(ydir, fingerprints):
+    """
+    Write dictionary of cluster IDs to fingerprints of their yn00 results to a yn00 folder.
+    """
+    path = "{0}/fingerprints.txt".format(ydir)
+    with open(path + ".tmp", "w") as outfile:
+        for cluster in sorted(fingerprints):
+            outfile.write("{0}\t{1}\n".format(cluster, fingerprints[cluster]))
+    os.rename(path + ".tmp", path)
+
 
+def RemoveStaleYn00(ydir, clusters):
+    """
+    Remove alignments and yn00 results of clusters that are no longer in the cluster archives (e.g. after
+    PanOCT was run again), so they don't end up in the summary.
+    """
+    clusters = set(clusters)
+    for name in os.listdir(ydir):
+        match = YN00_FILE.match(name)
+        if match and match.group(1) not in clusters:
+            os.remove("{0}/{1}".format(ydir, name))
 
-def SummarizeYn00(refine=False):
+
+def RunClusterYn00(ml_path, yn_path, fdir):
+    """
+    Run yn00 on every core and accessory cluster in the cluster archives of a folder, writing alignments and
+    results to <fdir>/yn00. Returns a list of the folder's cluster IDs and the number of clusters whose
+    results were reused.
+
+    Each result is recorded with the fingerprint of the cluster it was run on (member IDs and sequences), and
+    only reused for a cluster with the same fingerprint: either the folder's own result from an earlier run,
+    or (for clusters shared with a base archive, see ClusterArchive) the base folder's result, hard linked.
+    Archives being rewritten by another PanOCT run doesn't matter as long as a cluster's contents don't change.
+    """
+    ydir = "{0}/yn00".format(fdir)
+    TryMkDirs(ydir)
+    previous = {ydir: ReadFingerprints(ydir)}
+    fingerprints = {}
+    clusters = []
+    reused = 0
+    for component in ["core", "acc"]:
+        archive = ClusterArchive(ArchivePath(fdir, component, "fna"))
+        for cluster in archive:
+            clusters.append(cluster)
+            fingerprint = archive.Fingerprint(cluster)
+            alignment = "{0}/{1}.fna.aln".format(ydir, cluster)
+            result = alignment + ".yn00"
+
+            # Keep result from an earlier run on the same cluster.
+            if previous[ydir].get(cluster) == fingerprint and os.path.isfile(result):
+                fingerprints[cluster] = fingerprint
+                reused = reused + 1
+                continue
+
+            # Otherwise link result of the same cluster in the base archive, if there is one.
+            source = archive.Source(cluster)
+            if source:
+                source_ydir = "{0}/yn00".format(os.path.dirname(source[0]))
+                if source_ydir not in previous:
+                    previous[source_ydir] = ReadFingerprints(source_ydir) if os.path.isdir(source_ydir) else {}
+                source_result = "{0}/{1}.fna.aln.yn00".format(source_ydir, source[1])
+                if previous[source_ydir].get(source[1]) == fingerprint and os.path.isfile(source_result):
+                    LinkFile(source_result, result)
+                    fingerprints[cluster] = fingerprint
+                    reused = reused + 1
+                    continue
+
+            # Remove old files first, the result may be hard linked to a base result that yn00 would overwrite.
+            for old in [alignment, result]:
+                if os.path.isfile(old):
+                    os.remove(old)
+            seqs = archive[cluster]
+            try:
+                trans_seqs = TranslateCDS(seqs)
+            except TranslationError as e:
+                print "{0}, {1} has unusual frameshift mutation and can't be run through yn00.".format(e, cluster)
+                trans_seqs = None
+            if trans_seqs:
+                prot_alignment = MUSCLEAlign(ml_path, trans_seqs)
+                nucl_alignment = PutGaps(prot_alignment, seqs, alignment)
+                RunYn00(yn_path, nucl_alignment)
+            if os.path.isfile(result):
+                fingerprints[cluster] = fingerprint
+        archive.Close()
+
+    RemoveStaleYn00(ydir, clusters)
+    WriteFingerprints(ydir, fingerprints)
+    if reused:
+        logging.info("PAML: Reused yn00 results of {0} unchanged clusters in {1}.".format(reused, fdir))
+    return clusters, reused
+
+
+def SummarizeYn00(clusters, refine=False):
     """
-    Summarize yn00 results for core and accessory gene clusters and write to file.
+    Summarize yn00 results for the given core and accessory gene clusters and write to file.
     """
     results = {}
     if refine:
-        clusters = glob("./panoct/clusters/refined/core/fna/Core*.fna.aln.yn00") + glob("./panoct/clusters/refined/acc/fna/Acc*.fna.aln.yn00")
+        ydir = "./panoct/clusters/refined/yn00"
     else:
-        clusters = glob("./panoct/clusters/core/fna/Core*.fna.aln.yn00") + glob("./panoct/clusters/acc/fna/Acc*.fna.aln.yn00")
-    for cluster in clusters:
+        ydir = "./panoct/clusters/yn00"
+    paths = ["{0}/{1}.fna.aln.yn00".format(ydir, cluster) for cluster in clusters]
+    for cluster in filter(os.path.isfile, paths):
         cl_number = cluster.split("_")[1].split(".")[0]
         cl_comp = cluster.split("_")[0].split("/")[-1]
         results[cl_number] = {"Component": cl_comp, "Size": None, "Kappa": None, "Omega > 1": None}
@@ -47,22 +47,45 @@ Maynooth University in 2017-2019 (Charley.McCarthy@nuim.ie).
 
 from __future__ import division
 
+import hashlib
 import logging
 import multiprocessing as mp
 import os
 import re
 import shutil
+import socket
 import subprocess as sp
-import sys
-import tarfile
+import time
+from distutils.spawn import find_executable
+from bisect import bisect_left
+from collections import OrderedDict as od
 from csv import reader
 from glob import glob
+from heapq import heappop, heappush
+from itertools import product
+from math import ceil
+from string import maketrans
 
-from Bio import SeqIO
 from Bio.Seq import Seq
-from Bio.SeqRecord import SeqRecord
 
-from Tools import ExonerateCmdLine, LocationOverlap, Pairwise, TryMkDirs  # get_gene_lengths
+from ExonerateGene import ExonerateGene, RYO_FORMAT
+from FASTA import FASTAId, FASTAIndex, ReadFASTA, WriteFASTA
+from GenomeStore import GenomeStore
+from GTF import ParseGeneRecords
+from Tools import CheckCallFASTA, Flatten, HashFile, JournalExonerateCmdLine, Pairwise, ReleaseInput, StageInput, \
+                  TransDecoderCmdLine, TryMkDirs
+
+# Standard genetic code and nucleotide clean-up table for GeneMark-ES gene model extraction.
+CODONS = {"".join(codon): aa for codon, aa in
+          zip(product("TCAG", repeat=3), "FFLLSSSSYY**CC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG")}
+GENEMARK_BASES = maketrans("URYKMSWBDHV", "TNNNNNNNNNN")
+
+# Modules whose code gene model predictions depend on. Their contents are part of the prediction
+# cache key, so predictions cached by older versions of Pangloss aren't reused after an upgrade.
+PREDICTION_MODULES = ["PanGuess.py", "ExonerateGene.py", "FASTA.py", "GenomeStore.py", "GTF.py", "ORF.py", "Tools.py"]
+
+# Seconds to wait for exonerate-server to load a genome's index and start accepting connections.
+SERVER_START_TIMEOUT = 600
 
 
 def LengthOverlap(gene, ref_lengths):
@@ -86,55 +109,622 @@ def MakeWorkingDir(workdir):
     TryMkDirs(workdir)
 
 
+def ToolFingerprint(path):
+    """
+    Identify the version of an external tool by hashing its executable (looked up on PATH
+    if need be). Falls back to the path as given if the executable can't be found.
+    """
+    executable = find_executable(path) or path
+    if os.path.isfile(executable):
+        return HashFile(os.path.realpath(executable))
+    return path
+
+
+def PredictionCacheKey(genome, tag, settings):
+    """
+    Cache key for a genome's gene model predictions: a hash of the genome's contents, its tag,
+    the code of the Pangloss modules used for prediction and a list of everything else the
+    predictions depend on (reference protein set and tool fingerprints, relevant config options),
+    given as strings.
+    """
+    sha = hashlib.sha1()
+    code = [HashFile(os.path.join(os.path.dirname(os.path.abspath(__file__)), module))
+            for module in PREDICTION_MODULES]
+    for field in [HashFile(genome), tag] + code + settings:
+        sha.update("{0}\n".format(field))
+    return sha.hexdigest()
+
+
+def FetchCachedPrediction(workdir, key, tag):
+    """
+    Copy a genome's cached gene model, protein and attribute sets into <workdir>/sets.
+    Returns False if there's no complete cache entry under the key.
+    """
+    cache = "{0}/cache/{1}".format(workdir, key)
+    if not os.path.isfile("{0}/complete".format(cache)):
+        return False
+    sdir = "{0}/sets".format(workdir)
+    TryMkDirs(sdir)
+    for ext in ["faa", "nucl", "attributes"]:
+        shutil.copy("{0}/{1}.{2}".format(cache, tag, ext), sdir)
+    return True
+
+
+def StorePrediction(workdir, key, tag):
+    """
+    Copy a genome's gene model, protein and attribute sets from <workdir>/sets into the
+    cache under the key. The entry is only marked complete once all files are copied.
+    """
+    cache = "{0}/cache/{1}".format(workdir, key)
+    TryMkDirs(cache)
+    for ext in ["faa", "nucl", "attributes"]:
+        shutil.copy("{0}/sets/{1}.{2}".format(workdir, tag, ext), cache)
+    with open("{0}/complete".format(cache), "w") as outfile:
+        outfile.write("{0}\n".format(tag))
+    logging.info("PanGuess: Cached gene model predictions for {0} under {1}.".format(tag, key))
+
+
 def BuildRefSet(workdir, ref):
     """
     Build temporary set of reference proteins. It's faster to run Exonerate by splitting
     up the dataset into individual files and running them as separate queries against
     the genome than as a full file.
     """
-    # Make folder for reference proteins, if not already present.
+    # Make folder for reference proteins, clear out proteins from previous runs.
     ref_folder = "{0}/ref".format(workdir)
     TryMkDirs(ref_folder)
+    for old_prot in glob("{0}/*.faa".format(ref_folder)):
+        os.remove(old_prot)
 
     # Split user-provided reference set into individual proteins (have to do this).
-    ref_db = SeqIO.index(ref, "fasta")
     logging.info("PanGuess: Building reference protein sequence dataset.")
-    for seq in ref_db:
-        SeqIO.write(ref_db[seq], "{0}/{1}.faa".format(ref_folder, ref_db[seq].id), "fasta")
-    ref_db.close()
+    for header, seq in ReadFASTA(ref):
+        with open("{0}/{1}.faa".format(ref_folder, FASTAId(header)), "w") as outfile:
+            WriteFASTA(outfile, [(header, seq)])
+
+
+def BuildRefBatches(workdir, ref, batch_size):
+    """
+    Build size-balanced batches of reference proteins for batched Exonerate searches.
+    Each batch is searched against the genome by a single Exonerate process, so the
+    genome is loaded once per batch rather than once per protein.
+
+    Proteins are handed out longest-first to whichever batch currently holds the fewest
+    residues, so batches finish in roughly the same time.
+    """
+    # Make folder for reference protein batches, clear out batches from previous runs.
+    batch_folder = "{0}/ref_batches".format(workdir)
+    TryMkDirs(batch_folder)
+    for old_batch in glob("{0}/*.faa".format(batch_folder)):
+        os.remove(old_batch)
+
+    # Sort reference proteins by length (ties broken by ID so batches are reproducible).
+    ref_db = FASTAIndex(ref)
+    lengths = sorted(((len(ref_db[seq][1]), seq) for seq in ref_db), key=lambda x: (-x[0], x[1]))
+    batch_count = max(1, int(ceil(len(lengths) / batch_size)))
+
+    # Assign each protein to the batch with the fewest residues so far.
+    heap = [(0, index) for index in range(batch_count)]
+    batches = [[] for _ in range(batch_count)]
+    for length, seq in lengths:
+        residues, index = heappop(heap)
+        batches[index].append(seq)
+        heappush(heap, (residues + length, index))
+
+    # Write out batches.
+    logging.info("PanGuess: Building {0} reference protein batches for Exonerate.".format(batch_count))
+    for index, batch in enumerate(batches):
+        if batch:
+            with open("{0}/batch_{1}.faa".format(batch_folder, index), "w") as outfile:
+                WriteFASTA(outfile, ref_db.Fetch(batch))
+    ref_db.Close()
+
+
+def ClusterRefSet(workdir, ref, cd_path, identity, cores):
+    """
+    Cluster reference proteins with CD-HIT at the given identity (0.4-1.0), so that near-identical
+    paralogs and isoforms are only searched against each genome once, via a representative.
+
+    Non-representative members are written to <workdir>/ref_members/ as individual proteins
+    for RefineClusterHits. Returns the FASTA file of cluster representatives (which stands in
+    for the reference set from here on) and a dictionary of representatives to their members.
+    Raises CalledProcessError if CD-HIT fails.
+    """
+    # Make folders for clustering output and cluster members, clear out members from previous runs.
+    cluster_folder = "{0}/ref_clusters".format(workdir)
+    member_folder = "{0}/ref_members".format(workdir)
+    TryMkDirs(cluster_folder)
+    TryMkDirs(member_folder)
+    for old_member in glob("{0}/*.faa".format(member_folder)):
+        os.remove(old_member)
+
+    # Run CD-HIT, word size has to shrink with identity threshold (see CD-HIT user guide).
+    identity = float(identity)
+    if identity >= 0.7:
+        word = 5
+    elif identity >= 0.6:
+        word = 4
+    elif identity >= 0.5:
+        word = 3
+    else:
+        word = 2
+    reps = "{0}/representatives.faa".format(cluster_folder)
+    logging.info("PanGuess: Clustering reference proteins at {0} identity with CD-HIT.".format(identity))
+    sp.check_call([cd_path, "-i", ref, "-o", reps, "-c", str(identity), "-n", str(word),
+                   "-d", "0", "-M", "0", "-T", str(cores)])
+
+    # Parse clusters from .clstr file, representatives are marked with a "*".
+    clusters = {}
+    members = []
+    rep = None
+    for line in open(reps + ".clstr"):
+        if line.startswith(">"):
+            if rep:
+                clusters[rep] = members
+            members = []
+            rep = None
+        else:
+            prot = line.split(">", 1)[1].split("...")[0]
+            if line.rstrip().endswith("*"):
+                rep = prot
+            else:
+                members.append(prot)
+    if rep:
+        clusters[rep] = members
+    clusters = {rep: members for rep, members in clusters.iteritems() if members}
+
+    # Write out non-representative members as individual proteins.
+    ref_db = FASTAIndex(ref)
+    for prot in Flatten(clusters.values()):
+        with open("{0}/{1}.faa".format(member_folder, prot), "w") as outfile:
+            WriteFASTA(outfile, [ref_db[prot]])
+    ref_db.Close()
+    logging.info("PanGuess: Searching {0} cluster representatives in place of {1} clustered proteins.".format(
+        len(clusters), len(clusters) + sum(len(members) for members in clusters.values())))
+    return reps, clusters
+
+
+def SeedExonerateRegions(workdir, ref, genome, tag, cores, pad, mb_path="makeblastdb", tn_path="tblastn"):
+    """
+    Find candidate loci for every reference protein with a tblastn search against the genome,
+    and write padded genomic windows around those loci as per-protein Exonerate targets.
+
+    HSPs for a protein on the same contig are merged into one locus if they lie within two
+    paddings of each other, so windows never overlap. Windows are named in the format
+    contig:start-end (1-based, inclusive) so calls can be moved back onto the contig by
+    RelocateExonerateGene. Contigs (from the genome store) and reference proteins are streamed to
+    makeblastdb and tblastn under ordinal IDs and mapped back afterwards, as BLAST+ rewrites IDs
+    with database prefixes or "|" (e.g. lcl|ctg1, sp|P12345|X) in its output. Returns the folder
+    holding the windows. Raises CalledProcessError if makeblastdb or tblastn fail, rather than
+    carrying on without seeds.
+    """
+    # Make seed folder for genome, clear out windows from previous runs.
+    seed_folder = "{0}/seed/{1}".format(workdir, tag)
+    TryMkDirs(seed_folder)
+    for old_window in glob("{0}/*.fna".format(seed_folder)):
+        os.remove(old_window)
+
+    # Build nucleotide BLAST database for genome and search all reference proteins against it.
+    logging.info("PanGuess: Seeding Exonerate searches with tblastn on {0} threads.".format(cores))
+    db = "{0}/genome".format(seed_folder)
+    hits = "{0}/seeds.tsv".format(seed_folder)
+    store = GenomeStore(genome, "{0}/genomes".format(workdir))
+    contigs = [contig for contig, _ in store.Contigs()]
+    prots = [FASTAId(header) for header, _ in ReadFASTA(ref)]
+    CheckCallFASTA([mb_path, "-in", "-", "-dbtype", "nucl", "-parse_seqids", "-title", tag, "-out", db],
+                   (("c{0}".format(index), store.Fetch(contig)) for index, contig in enumerate(contigs)))
+    CheckCallFASTA([tn_path, "-query", "-", "-db", db, "-evalue", "0.00001", "-num_threads", str(cores),
+                    "-outfmt", "6 qaccver saccver sstart send", "-out", hits],
+                   (("q{0}".format(index), seq) for index, (_, seq) in enumerate(ReadFASTA(ref))))
+
+    # Group HSP co-ordinates by contig and reference protein, mapping ordinal IDs back.
+    hsps = {}
+    for row in reader(open(hits), delimiter="\t"):
+        locs = sorted([int(row[2]), int(row[3])])
+        hsps.setdefault(contigs[int(row[1][1:])], {}).setdefault(prots[int(row[0][1:])], []).append(locs)
+
+    # Proteins without seeds aren't searched with Exonerate at all, so say which.
+    seeded = set(Flatten(prot_hsps.keys() for prot_hsps in hsps.values()))
+    unseeded = [prot for prot in prots if prot not in seeded]
+    if unseeded:
+        logging.warning("PanGuess: {0} of {1} reference proteins have no tblastn seeds in {2} and won't be "
+                        "searched with Exonerate.".format(len(unseeded), len(prots), genome))
+        logging.info("PanGuess: Reference proteins without seeds: {0}.".format(", ".join(unseeded)))
+
+    # Loop over contigs with seeds, merge nearby HSPs into loci and write padded windows.
+    window_count = 0
+    for contig, length in store.Contigs():
+        if contig not in hsps:
+            continue
+        for prot, locs in hsps[contig].iteritems():
+            locs.sort()
+            loci = [locs[0]]
+            for start, end in locs[1:]:
+                if start <= loci[-1][1] + 2 * pad:
+                    loci[-1][1] = max(loci[-1][1], end)
+                else:
+                    loci.append([start, end])
+            with open("{0}/{1}.fna".format(seed_folder, prot), "a") as outfile:
+                for start, end in loci:
+                    start = max(1, start - pad)
+                    end = min(length, end + pad)
+                    outfile.write(">{0}:{1}-{2}\n{3}\n".format(contig, start, end, store.Fetch(contig, start - 1, end)))
+                    window_count = window_count + 1
+    store.Close()
 
+    # Return folder of windows for BuildExonerateCmds.
+    logging.info("PanGuess: Wrote {0} seeded genomic windows for {1}.".format(window_count, genome))
+    return seed_folder
 
-def BuildExonerateCmds(workdir, ex_path, genome):
+
+def StartExonerateServer(workdir, ex_path, genome, tag, cores):
+    """
+    Build an Exonerate index (.esd/.esi) for a genome and start exonerate-server on it, so
+    that Exonerate searches don't each have to load and index the genome themselves. The index
+    is kept in <workdir>/esi/<tag>/ and only rebuilt if the genome is newer than it. Compressed
+    genomes are only decompressed (into the same folder) while the index is built.
+
+    fasta2esd, esd2esi and exonerate-server are expected to sit alongside exonerate.
+    Returns the server process and the host:port target to pass to exonerate. Raises
+    CalledProcessError if the index can't be built, and RuntimeError if the server exits or
+    doesn't accept connections within SERVER_START_TIMEOUT seconds.
+    """
+    # Exonerate index tools and server live in the same place as exonerate itself.
+    bin_dir = os.path.dirname(ex_path)
+    esi_folder = "{0}/esi/{1}".format(workdir, tag)
+    esd = "{0}/{1}.esd".format(esi_folder, tag)
+    esi = "{0}/{1}.esi".format(esi_folder, tag)
+    TryMkDirs(esi_folder)
+
+    # Build index for genome, unless there's an up-to-date one there already.
+    if not os.path.isfile(esi) or os.path.getmtime(esi) < os.path.getmtime(genome):
+        logging.info("PanGuess: Building Exonerate index for {0}.".format(genome))
+        staged = StageInput(genome, esi_folder)
+        try:
+            sp.check_call([os.path.join(bin_dir, "fasta2esd"), staged, esd])
+            sp.check_call([os.path.join(bin_dir, "esd2esi"), esd, esi, "--translate", "yes"])
+        except sp.CalledProcessError:
+            # Don't leave a partial index behind that looks up to date next time.
+            for index in [esd, esi]:
+                if os.path.isfile(index):
+                    os.remove(index)
+            raise
+        finally:
+            ReleaseInput(genome, staged)
+
+    # Find a free port and start server.
+    sock = socket.socket()
+    sock.bind(("localhost", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    logging.info("PanGuess: Starting exonerate-server for {0} on port {1}.".format(genome, port))
+    server = sp.Popen([os.path.join(bin_dir, "exonerate-server"), esi,
+                       "--port", str(port), "--maxconnections", str(cores)])
+
+    # Wait for server to finish loading the index and start accepting connections.
+    deadline = time.time() + SERVER_START_TIMEOUT
+    while True:
+        if server.poll() is not None:
+            raise RuntimeError("exonerate-server exited (code {0}) before accepting connections for {1}.".format(
+                server.returncode, genome))
+        if time.time() > deadline:
+            server.kill()
+            server.wait()
+            raise RuntimeError("exonerate-server didn't accept connections for {0} within {1} seconds.".format(
+                genome, SERVER_START_TIMEOUT))
+        try:
+            socket.create_connection(("localhost", port), 5).close()
+            break
+        except socket.error:
+            time.sleep(1)
+    return server, "localhost:{0}".format(port)
+
+
+def StopExonerateServer(server):
     """
-    Generate list of exonerate commands to run through multiprocessing.
+    Shut down an exonerate-server started by StartExonerateServer.
+    """
+    logging.info("PanGuess: Shutting down exonerate-server.")
+    if server.poll() is None:
+        server.terminate()
+    server.wait()
+
+
+def BuildExonerateCmds(workdir, ex_path, genome, batched=False, seeds=None, target=None):
+    """
+    Generate list of exonerate commands to run through multiprocessing. If batched,
+    queries are the reference protein batches built by BuildRefBatches rather than
+    individual reference proteins.
+
+    If a folder of seeded windows is given (see SeedExonerateRegions), each reference
+    protein is searched only against its own windows, and proteins without seeds are
+    skipped altogether. Otherwise, if a target is given in place of the genome (the
+    host:port of an exonerate-server holding it, or an uncompressed copy of it from
+    StageInput), proteins are searched against that.
     """
     # List of commands.
     exon_cmds = []
 
     # Generate and return commands.
     logging.info("PanGuess: Building set of Exonerate commands.")
-    for prot in glob("{0}/ref/*.faa".format(workdir)):
-        exon_cmds.append([ex_path, "--model", "protein2genome",
-                          "-t", genome, "-q", prot, "--percent", "90",  "--bestn", "1"])
+    if batched:
+        queries = glob("{0}/ref_batches/*.faa".format(workdir))
+    else:
+        queries = glob("{0}/ref/*.faa".format(workdir))
+    for prot in queries:
+        if seeds:
+            window = "{0}/{1}.fna".format(seeds, os.path.basename(prot)[:-4])
+            if os.path.isfile(window):
+                exon_cmds.append(ExonerateCmd(ex_path, window, prot))
+        else:
+            exon_cmds.append(ExonerateCmd(ex_path, target if target else genome, prot))
     return exon_cmds
 
 
-def RunExonerate(cmds, cores):
+def ExonerateCmd(ex_path, target, query):
+    """
+    Exonerate command for a query protein file against a target (FASTA file or host:port).
+    """
+    return [ex_path, "--model", "protein2genome",
+            "-t", target, "-q", query, "--percent", "90",  "--bestn", "1",
+            "--showalignment", "no", "--showvulgar", "no", "--ryo", RYO_FORMAT]
+
+
+def RelocateExonerateGene(gene):
+    """
+    Move an ExonerateGene called against a seeded genomic window (named contig:start-end)
+    back onto its contig, so contig_id, locs and id match a search against the whole genome.
+    """
+    contig_id, window = gene.contig_id.rsplit(":", 1)
+    offset = int(window.split("-")[0]) - 1
+    gene.contig_id = contig_id
+    gene.locs = (gene.locs[0] + offset, gene.locs[1] + offset)
+    gene.id = "{0}_{1}".format(contig_id, "_".join(str(loc) for loc in gene.locs))
+    return gene
+
+
+def ReadExonerateJournal(journal, header):
+    """
+    Read an Exonerate journal written by RunExonerate and return a dictionary of reference
+    protein IDs to ExonerateGene instances (or None for proteins without a hit).
+
+    Journals start with a header identifying the genome and searches they were written for
+    (see JournalHeader). If the header doesn't match the one given, the journal is stale and
+    an empty dictionary is returned. Incomplete lines (e.g. from a crash mid-write) are ignored.
+    """
+    records = {}
+    if not os.path.isfile(journal):
+        return records
+    with open(journal) as infile:
+        if infile.readline() != header:
+            return records
+        for line in infile:
+            if not line.endswith("\n"):
+                break
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) == 1:
+                records[fields[0]] = None
+            elif len(fields) == 11:
+                gene = ExonerateGene.__new__(ExonerateGene)
+                gene.__setstate__([fields[1], (int(fields[2]), int(fields[3]))] + fields[4:10] + [int(fields[10])])
+                records[fields[0]] = gene
+    return records
+
+
+def TruncateJournal(journal):
+    """
+    Truncate a journal back to the end of its last complete line.
+    """
+    with open(journal, "r+b") as infile:
+        infile.seek(0, os.SEEK_END)
+        end = infile.tell()
+        while end > 0:
+            start = max(end - 65536, 0)
+            infile.seek(start)
+            newline = infile.read(end - start).rfind("\n")
+            if newline != -1:
+                end = start + newline + 1
+                break
+            end = start
+        infile.truncate(end)
+
+
+def JournalHeader(genome, cmds, seeded=False, timeout=None, retry_model=None):
+    """
+    Header line identifying what an Exonerate journal was written for: the genome's path, size
+    and modification time, and a hash of the searches run against it. The hash covers the
+    Exonerate executable, options and query proteins of each command (and the contents of the
+    genomic windows searched if seeded), along with the timeout and retry settings, so that
+    changing the reference protein set or any search setting invalidates the journal.
+    """
+    searches = []
+    for cmd in cmds:
+        query = cmd.index("-q") + 1
+        target = cmd.index("-t") + 1
+        fields = list(cmd)
+        fields[query] = HashFile(cmd[query])
+        if seeded:
+            fields[target] = HashFile(cmd[target])
+        else:
+            fields[target] = "genome"  # Genome, a staged copy of it or an exonerate-server holding it.
+        fields[0] = ToolFingerprint(cmd[0])
+        searches.append("\t".join(fields))
+    sha = hashlib.sha1()
+    for field in sorted(searches) + [seeded, timeout, retry_model]:
+        sha.update("{0}\n".format(field))
+    stat = os.stat(genome)
+    return "#{0}\t{1}\t{2}\t{3}\n".format(os.path.abspath(genome), stat.st_size, int(stat.st_mtime), sha.hexdigest())
+
+
+def JournalExonerateResults(outfile, prots, genes, seeded=False, misses=True):
+    """
+    Append Exonerate results for a command's query proteins to an open journal, one line per
+    protein. Proteins without a hit are only journalled if misses is True. Returns the set of
+    proteins journalled with a hit.
+    """
+    hits = {}
+    for gene in genes:
+        if seeded:
+            gene = RelocateExonerateGene(gene)
+        hits[gene.ref.split("=", 1)[1]] = gene
+    for prot in prots:
+        if prot in hits:
+            state = hits[prot].__getstate__()
+            fields = [prot, state[0], state[1][0], state[1][1]] + list(state[2:])
+            outfile.write("\t".join(str(field) for field in fields) + "\n")
+        elif misses:
+            outfile.write(prot + "\n")
+    outfile.flush()
+    os.fsync(outfile.fileno())
+    return set(prot for prot in prots if prot in hits)
+
+
+def RunExonerate(cmds, cores, journal, genome, seeded=False, timeout=None, retry_model=None):
     """
     Farm list of exonerate commands to CPU threads using multiprocessing.
+
+    Results are taken as each command finishes and appended to an on-disk journal, with one
+    record per reference protein (whether or not it has a hit). If the journal already has
+    records for all of a command's query proteins, e.g. from a run that crashed, the command
+    is skipped. Journals are only resumed if written for the same genome and searches (see
+    JournalHeader). Once all commands are finished, ExonerateGene instances are rebuilt from
+    the journal, so memory use doesn't grow with the number of searches, and the journal is
+    removed.
+
+    Commands are handed out one at a time, most expensive first (query residues x target size),
+    so long searches don't hold up the end of the run. If a timeout (seconds) is given, commands
+    running longer than that are killed and logged. If a retry model is given as well, timed out
+    commands are rerun with that (cheaper) Exonerate model once everything else has finished.
+    Proteins of a timed out command without a hit aren't journalled (they may never have been
+    searched), so they are searched again when the run is resumed.
     
     Returns an unordered list of ExonerateGene instances. Default number of
     threads = (number of cores on computer - 1).
     """
-    # Farm out Exonerate processes, wait for all to finish and merge together.
+    # Query proteins of each command (keyed by query file), and proteins already searched in a previous run.
+    queries = {}
+    for cmd in cmds:
+        query = cmd[cmd.index("-q") + 1]
+        queries[query] = [line[1:].split()[0] for line in open(query) if line.startswith(">")]
+    header = JournalHeader(genome, cmds, seeded, timeout, retry_model)
+    done = set(ReadExonerateJournal(journal, header))
+    pending = [cmd for cmd in cmds if not done.issuperset(queries[cmd[cmd.index("-q") + 1]])]
+    logging.info("PanGuess: {0} of {1} Exonerate searches already in journal {2}.".format(
+        len(cmds) - len(pending), len(cmds), journal))
+
+    # Start a fresh journal unless we're resuming from one, in which case cut off any incomplete
+    # last line so new records aren't appended to it.
+    if len(pending) == len(cmds):
+        with open(journal, "w") as outfile:
+            outfile.write(header)
+    else:
+        TruncateJournal(journal)
+
+    # Order commands by expected cost, longest first. Targets are either files (genome or
+    # seeded windows) or an exonerate-server, in which case the genome's size is used.
+    costs = {}
+    for cmd in pending:
+        query = cmd[cmd.index("-q") + 1]
+        target = cmd[cmd.index("-t") + 1]
+        residues = sum(len(line.strip()) for line in open(query) if not line.startswith(">"))
+        costs[query] = residues * os.path.getsize(target if os.path.isfile(target) else genome)
+    pending.sort(key=lambda x: costs[x[x.index("-q") + 1]], reverse=True)
+
+    # Farm out Exonerate processes, journal results as they come back.
     logging.info("PanGuess: Running Exonerate searches on {0} threads".format(cores))
     farm = mp.Pool(processes=int(cores))
-    genes = farm.map(ExonerateCmdLine, cmds)
+    retries = {}
+    retry_jobs = []
+    with open(journal, "a") as outfile:
+        jobs = [(cmd, timeout) for cmd in pending]
+        for cmd, genes, timed_out in farm.imap_unordered(JournalExonerateCmdLine, jobs, 1):
+            query = cmd[cmd.index("-q") + 1]
+            if timed_out:
+                logging.warning("PanGuess: Exonerate search for {0} timed out after {1} seconds.".format(
+                    query, timeout))
+            if timed_out and retry_model:
+                retries[query] = JournalExonerateResults(outfile, queries[query], genes, seeded, False)
+                retry = list(cmd)
+                retry[retry.index("--model") + 1] = retry_model
+                retry_jobs.append((retry, timeout))
+            else:
+                JournalExonerateResults(outfile, queries[query], genes, seeded, not timed_out)
+
+        # Rerun timed out commands with cheaper model, for proteins that didn't get a hit the first time.
+        if retries:
+            logging.info("PanGuess: Retrying {0} timed out Exonerate searches with {1} model.".format(
+                len(retries), retry_model))
+            for cmd, genes, timed_out in farm.imap_unordered(JournalExonerateCmdLine, retry_jobs, 1):
+                query = cmd[cmd.index("-q") + 1]
+                if timed_out:
+                    logging.warning("PanGuess: Retried Exonerate search for {0} timed out as well.".format(query))
+                prots = [prot for prot in queries[query] if prot not in retries[query]]
+                JournalExonerateResults(outfile, prots, genes, seeded, not timed_out)
     farm.close()
     farm.join()
 
-    # Return predicted genes (ignore empty results).
-    return [gene for gene in genes if gene]
+    # Rebuild predicted genes from journal (ignore empty results), journal isn't needed once the run is complete.
+    records = ReadExonerateJournal(journal, header)
+    os.remove(journal)
+    return [records[prot] for prot in set(Flatten(queries.values())) if records.get(prot)]
+
+
+def RefineClusterHits(workdir, ex_path, genome, tag, genes, clusters, cores, pad, timeout=None, retry_model=None):
+    """
+    Check hits of clustered reference representatives (see ClusterRefSet) against the other
+    members of their cluster. Members are only searched against a padded window around their
+    representative's hit, and never for representatives without a hit. The highest scoring
+    call at each locus is kept (the representative's on ties), so that Exonerate=<ref> names
+    the best-matching original protein.
+
+    Member searches are journalled separately from the main Exonerate searches.
+    """
+    # Make folder for windows around representatives' hits, clear out windows from previous runs.
+    refine_folder = "{0}/refine/{1}".format(workdir, tag)
+    TryMkDirs(refine_folder)
+    for old_window in glob("{0}/*.fna".format(refine_folder)):
+        os.remove(old_window)
+
+    # Group hits of representatives with cluster members by contig.
+    hits = {}
+    for gene in genes:
+        if gene.ref.split("=", 1)[1] in clusters:
+            hits.setdefault(gene.contig_id, []).append(gene)
+    if not hits:
+        return genes
+
+    # Write padded windows around hits (named contig:start-end, as with seeded windows) and
+    # build commands for cluster members against their representative's window.
+    cmds = []
+    store = GenomeStore(genome, "{0}/genomes".format(workdir))
+    for contig, length in store.Contigs():
+        if contig not in hits:
+            continue
+        for gene in hits[contig]:
+            rep = gene.ref.split("=", 1)[1]
+            start = max(1, gene.locs[0] + 1 - pad)
+            end = min(length, gene.locs[1] + pad)
+            window = "{0}/{1}.fna".format(refine_folder, rep)
+            with open(window, "w") as outfile:
+                outfile.write(">{0}:{1}-{2}\n{3}\n".format(contig, start, end, store.Fetch(contig, start - 1, end)))
+            for member in clusters[rep]:
+                cmds.append(ExonerateCmd(ex_path, window, "{0}/ref_members/{1}.faa".format(workdir, member)))
+    store.Close()
+
+    # Search members and keep the best call for each representative's hit.
+    logging.info("PanGuess: Refining {0} clustered Exonerate hits against cluster members.".format(
+        sum(len(reps) for reps in hits.values())))
+    journal = "{0}/exonerate/{1}.refine.journal".format(workdir, tag)
+    member_genes = {gene.ref.split("=", 1)[1]: gene
+                    for gene in RunExonerate(cmds, cores, journal, genome, True, timeout, retry_model)}
+    refined = []
+    for gene in genes:
+        rep = gene.ref.split("=", 1)[1]
+        if rep in clusters:
+            candidates = [gene] + [member_genes[member] for member in clusters[rep] if member in member_genes]
+            gene = max(candidates, key=lambda x: x.score)
+        refined.append(gene)
+    return refined
 
 
 def GetExonerateAttributes(exonerate_genes, tag):
@@ -157,25 +747,138 @@ def GetExonerateAttributes(exonerate_genes, tag):
     return exonerate_attributes
 
 
-def RunGeneMark(genome, gm_path, gm_branch, cores):
+def TrainGeneMarkModel(workdir, genome, gm_path, gm_branch, cores):
+    """
+    Self-train a GeneMark-ES model on a genome, so it can be reused to predict genes in other
+    strains of the same species without training on each of them (see RunGeneMark).
+
+    Models are kept in <workdir>/gm_models/, named after a hash of the genome, the GeneMark-ES
+    executable and branching model option, and reused if already there. Training is run in its
+    own folder as GeneMark-ES writes fixed filenames into the current directory, and compressed
+    genomes are only decompressed (into <workdir>/staged/) for training. Returns the absolute
+    path of the model file.
+    """
+    # Model is cached under hash of everything it depends on.
+    model_folder = os.path.abspath("{0}/gm_models".format(workdir))
+    key = hashlib.sha1("\n".join([HashFile(genome), ToolFingerprint(gm_path), str(gm_branch)])).hexdigest()
+    model = "{0}/{1}.mod".format(model_folder, key)
+    if os.path.isfile(model):
+        logging.info("PanGuess: Reusing GeneMark-ES model {0} trained on {1}.".format(model, genome))
+        return model
+
+    # Train model in temporary folder, cleared of anything left by an earlier failed training run.
+    train_folder = "{0}/train_{1}".format(model_folder, key)
+    if os.path.isdir(train_folder):
+        shutil.rmtree(train_folder)
+    TryMkDirs(train_folder)
+    staged = StageInput(genome, "{0}/staged".format(workdir))
+    try:
+        if gm_branch:
+            logging.info("PanGuess: Training GeneMark-ES model on {0} with branching model.".format(genome))
+            sp.check_call([gm_path, "--ES", "--fungus", "--cores", cores, "--sequence", os.path.abspath(staged)],
+                          cwd=train_folder)
+        else:
+            logging.info("PanGuess: Training GeneMark-ES model on {0}.".format(genome))
+            sp.check_call([gm_path, "--ES", "--cores", cores, "--sequence", os.path.abspath(staged)],
+                          cwd=train_folder)
+    finally:
+        ReleaseInput(genome, staged)
+
+    # Keep model (moved into place in one go so there's never a partial model file), remove everything else.
+    trained = "{0}/output/gmhmm.mod".format(train_folder)
+    if not os.path.isfile(trained):
+        raise RuntimeError("GeneMark-ES training on {0} failed, see {1}.".format(genome, train_folder))
+    shutil.move(trained, model + ".tmp")
+    os.rename(model + ".tmp", model)
+    shutil.rmtree(train_folder)
+    return model
+
+
+def RunGeneMark(genome, gm_path, gm_branch, cores, model=None):
     """
     Run GeneMark-ES on given genome, with optional arguments for fungal-specific
     prediction models and number of cores.
-    """
-    # Get path for GTF extraction script.
-    gtf_path = os.path.dirname(os.path.realpath(sys.argv[0])) + "/get_sequence_from_GTF.pl"
 
-    # Run GeneMark-ES and extract data.
-    if gm_branch:
+    If a model file is given (see TrainGeneMarkModel), GeneMark-ES predicts genes with
+    that model instead of training on the genome itself. Raises CalledProcessError if
+    GeneMark-ES fails, so a failed prediction is never cached.
+    """
+    # Run GeneMark-ES.
+    if model:
+        logging.info("PanGuess: Running GeneMark-ES on {0} threads with model {1}.".format(cores, model))
+        sp.check_call([gm_path, "--predict_with", model, "--cores", cores, "--sequence", genome])
+    elif gm_branch:
         logging.info("PanGuess: Running GeneMark-ES on {0} threads with branching model.".format(cores))
-        sp.call([gm_path, "--ES", "--fungus", "--cores", cores, "--sequence", genome])
+        sp.check_call([gm_path, "--ES", "--fungus", "--cores", cores, "--sequence", genome])
     else:
         logging.info("PanGuess: Running GeneMark-ES on {0} threads.".format(cores))
-        sp.call([gm_path, "--ES", "--cores", cores, "--sequence", genome])
-    sp.call([gtf_path, "genemark.gtf", genome])
+        sp.check_call([gm_path, "--ES", "--cores", cores, "--sequence", genome])
+
+    # Return GTF file to convert into attribute data.
+    return "genemark.gtf"
+
+
+def ExtractGeneMarkSequences(gtf, genome, workdir):
+    """
+    Extract nucleotide and protein sequences of GeneMark-ES gene models from a GeneMark GTF
+    file and the genome, in place of get_sequence_from_GTF.pl (which it mirrors, including
+    its phase conventions). CDS rows are read in one pass and grouped by contig, so each
+    contig is fetched from the genome store once.
+
+    Returns dictionaries of gene IDs to nucleotide and protein sequences (as strings).
+    """
+    # Group CDS rows by contig and gene, in file order: strand, phase and exon co-ordinates.
+    genes = od()
+    for row in reader(open(gtf), delimiter="\t"):
+        if len(row) != 9 or row[2] != "CDS":
+            continue
+        gene_id = row[8].split("\"")[1]
+        contig = genes.setdefault(row[0].split()[0], od())
+        if gene_id not in contig:
+            contig[gene_id] = [row[6], int(row[7]), []]
+        contig[gene_id][2].append((int(row[7]), int(row[3]), int(row[4])))
+
+    # Slice exons out of each contig, trim to codons by phase and translate.
+    nucl = {}
+    prot = {}
+    store = GenomeStore(genome, "{0}/genomes".format(workdir))
+    for contig_id, contig in genes.iteritems():
+        seq = CleanGeneMarkSequence(store.Fetch(contig_id))
+        for gene_id, (strand, phase, exons) in contig.iteritems():
+            cds = "".join(seq[left - 1:right] for _, left, right in exons)
+            if strand == "+":
+                cds = cds[{0: 0, 1: 2, 2: 1}[phase]:]
+            else:
+                cds = cds[:len(cds) - {0: 0, 1: 2, 2: 1}[exons[-1][0]]]
+                cds = str(Seq(cds).reverse_complement())
+            cds = cds[:len(cds) - len(cds) % 3]
+            nucl[gene_id] = cds
+            prot[gene_id] = TranslateCDS(cds)
+    store.Close()
+    logging.info("PanGuess: Extracted {0} GeneMark-ES gene model sequences.".format(len(nucl)))
+    return nucl, prot
+
+
+def CleanGeneMarkSequence(seq):
+    """
+    Clean up a contig sequence as get_sequence_from_GTF.pl does: uppercase, drop anything
+    other than letters, U to T and other IUPAC nucleotide codes to N.
+    """
+    seq = re.sub("[^A-Z]", "", seq.upper()).translate(GENEMARK_BASES)
+    if re.search("[^ACGTN]", seq):
+        raise ValueError("Unexpected letter in genome sequence for GeneMark-ES gene model extraction.")
+    return seq
+
 
-    # Return CSV object to convert into attribute data.
-    return reader(open("genemark.gtf"), delimiter="\t")
+def TranslateCDS(cds):
+    """
+    Translate a coding sequence (with length a multiple of three) using the standard code,
+    with X for codons containing anything other than A, C, G or T, dropping a terminal stop.
+    """
+    prot = "".join(CODONS.get(cds[i:i + 3], "X") for i in range(0, len(cds), 3))
+    if prot.endswith("*"):
+        prot = prot[:-1]
+    return prot
 
 
 def GeneMarkGTFConverter(gtf, tag):
@@ -185,44 +888,15 @@ def GeneMarkGTFConverter(gtf, tag):
     """
     # Holding converted attributes and gene model info.
     attributes = []
-    locs = []
-    exon_count = 0
-
-    # Pairwise loop over GTF file, start extracting info.
-    for row, next_row in Pairwise(gtf):
-        if next_row is not None:
-            if row[8].split("\"") == next_row[8].split("\""):
-                if row[2] == "exon":
-                    exon_count = exon_count + 1
-                locs = locs + [int(row[3]), int(row[4])]
-
-            # End of info for current gene, get everything together and reset variables.
-            else:
-                if row[2] == "exon":
-                    exon_count = exon_count + 1
-                locs = locs + [int(row[3]), int(row[4])]
-                contig_id = row[0].split(" ")[0]
-                gene_id = row[8].split("\"")[1]
-                annotations = "GeneMark={0};IS=False;Introns={1}".format(gene_id, exon_count - 1)
-                attributes.append([contig_id, gene_id, min(locs), max(locs),
-                                   annotations, tag])
-                locs = []
-                exon_count = 0
-
-        # End of file.
-        else:
-            if row[2] == "exon":
-                exon_count = exon_count + 1
-            locs = locs + [int(row[3]), int(row[4])]
-            contig_id = row[0].split(" ")[0]
-            gene_id = row[8].split("\"")[1]
-            annotations = "GeneMark={0};IS=False;Introns={1}".format(gene_id, exon_count - 1)
-            attributes.append([contig_id, gene_id, min(locs), max(locs),
-                               annotations, tag])
-
-    # Return sorted GeneMark-ES attributes.
+
+    # Stream genes from GTF file.
+    for gene in ParseGeneRecords(gtf, "gtf"):
+        annotations = "GeneMark={0};IS=False;Introns={1}".format(gene.gene_id, gene.exons - 1)
+        attributes.append([gene.contig, gene.gene_id, gene.start, gene.end, annotations, tag])
+
+    # Return sorted GeneMark-ES attributes (these go straight to ExtractNCR if Exonerate is skipped).
     logging.info("PanGuess: Converted and sorted {0} GeneMark-ES attributes.".format(len(attributes)))
-    return sorted(attributes, key=lambda x: (x[0], int(x[2])))
+    return sorted(attributes, key=lambda x: (x[0], x[2]))
 
 
 def MergeAttributes(first_attributes, second_attributes):
@@ -230,22 +904,38 @@ def MergeAttributes(first_attributes, second_attributes):
     Return called genes from two methods that do not overlap. Done for both adding
     Exonerate and GeneMark-ES calls together, and then later when adding TransDecoder
     calls into the previous set of calls.
-    """
-    # Merge calls and sort by contig ID and start codon position.
-    unique_calls = first_attributes + second_attributes
-    unique_calls.sort(key=lambda x: (x[0], int(x[2])))
-    to_remove = []
 
-    # Go through all calls and earmark overlapping/redundant calls for removal.
-    for call, next_call in Pairwise(unique_calls):
-        if next_call:
-            overlap = LocationOverlap(call, next_call)
-            if overlap:
-                to_remove.append(overlap[1])
-
-    # Return all unique and non-overlapped calls.
-    logging.info("PanGuess: Found {0} attributes to remove. Merging all other attributes.".format(len(to_remove)))
-    return [call for call in unique_calls if call[1] not in to_remove]
+    Calls are kept longest first (later start codon first on ties) unless they overlap, or
+    lie within 20 bp of, a call already kept on the same contig. Kept calls are indexed per
+    contig as sorted, disjoint intervals, so each call is checked against its neighbours in
+    the index only, and overlaps are caught whether or not calls are adjacent by position.
+    """
+    # Convert co-ordinates once, keeping original order to break ties when sorting output.
+    unique_calls = [(call[0], int(call[2]), int(call[3]), index, call)
+                    for index, call in enumerate(first_attributes + second_attributes)]
+    unique_calls.sort(key=lambda x: (x[1] - x[2], -x[1]))
+
+    # Per-contig index of kept calls, as lists of start and end positions sorted by start.
+    starts = {}
+    ends = {}
+    kept = []
+    for contig, start, end, index, call in unique_calls:
+        contig_starts = starts.setdefault(contig, [])
+        contig_ends = ends.setdefault(contig, [])
+        i = bisect_left(contig_starts, start)
+        if i > 0 and contig_ends[i - 1] + 20 >= start:
+            continue
+        if i < len(contig_starts) and contig_starts[i] <= end + 20:
+            continue
+        contig_starts.insert(i, start)
+        contig_ends.insert(i, end)
+        kept.append((contig, start, index, call))
+
+    # Return all unique and non-overlapped calls, sorted by contig ID and start codon position.
+    logging.info("PanGuess: Found {0} attributes to remove. Merging all other attributes.".format(
+        len(unique_calls) - len(kept)))
+    kept.sort(key=lambda x: x[:3])
+    return [call[3] for call in kept]
 
 
 def MoveGeneMarkFiles(workdir, genome):
@@ -275,61 +965,167 @@ def MoveGeneMarkFiles(workdir, genome):
                 os.remove(f)
 
 
-def ExtractNCR(attributes, genome):
+def ExtractNCR(attributes, genome, workdir, name):
     """
     Generate noncoding sequences from a genome by slicing around known coordinates.
+
+    Attributes are grouped by contig in one pass, and NCRs are sliced out of the memory-mapped
+    genome store, so the whole genome is never held in memory. NCRs are written in genome order,
+    i.e. contigs in genome file order and calls by start position within each contig.
+    NCRs are written straight to NCR.fna in the genome's TransDecoder directory, the path to
+    which is returned for RunTransDecoder.
     """
-    # List of non-coding regions of genome.
-    ncr = []
-
-    # Parse genome file.
-    logging.info("PanGuess: Parsed genome file for non-coding region extraction.")
-    db = SeqIO.parse(open(genome), "fasta")
-
-    # Loop over every contig/chromosome in the genome.
-    for seq in db:
-        coding = filter(lambda x: x[0] == seq.id, attributes)
-        for gene, next_gene in Pairwise(coding):
-            if coding.index(gene) == 0:
-                if gene[2] != 0:
-                    extract_id = seq.id + "_NCR_0_{0}".format(gene[2] - 1)
-                    extract = seq.seq[0:gene[2] - 2]
-                    ncr.append(">{0}\n{1}\n".format(extract_id, extract))
-            elif next_gene is None:
-                extract_id = seq.id + "_NCR_{0}_{1}".format(gene[3] + 1, len(seq) + 1)
-                extract = seq.seq[gene[3]:]
-                ncr.append(">{0}\n{1}\n".format(extract_id, extract))
-            else:
-                extract_id = seq.id + "_NCR_{0}_{1}".format(gene[3] + 1, next_gene[2] - 1)
-                extract = seq.seq[gene[3]:next_gene[2] - 2]
-                ncr.append(">{0}\n{1}\n".format(extract_id, extract))
+    # Try to make a directory for TransDecoder. Might as well do it now.
+    tdir = "{0}/td/{1}/".format(workdir, name)
+    TryMkDirs(tdir)
+    ncr = "{0}/NCR.fna".format(tdir)
 
-    # Return list of NCR sequences.
-    logging.info("PanGuess: Extracted {0} NCR sequences from {1}.".format(len(ncr), genome))
+    # Group calls by contig, sorted by start position.
+    coding = {}
+    for gene in attributes:
+        coding.setdefault(gene[0], []).append(gene)
+    for calls in coding.values():
+        calls.sort(key=lambda x: x[2])
+
+    # Open genome store.
+    store = GenomeStore(genome, "{0}/genomes".format(workdir))
+
+    # Loop over every contig/chromosome with calls and write NCRs as we go.
+    count = 0
+    with open(ncr, "w") as outfile:
+        for contig, length in store.Contigs():
+            if contig not in coding:
+                continue
+            for index, (gene, next_gene) in enumerate(Pairwise(coding[contig])):
+                if index == 0:
+                    if gene[2] != 0:
+                        extract_id = contig + "_NCR_0_{0}".format(gene[2] - 1)
+                        extract = store.Fetch(contig, 0, gene[2] - 2)
+                    else:
+                        continue
+                elif next_gene is None:
+                    extract_id = contig + "_NCR_{0}_{1}".format(gene[3] + 1, length + 1)
+                    extract = store.Fetch(contig, gene[3])
+                else:
+                    extract_id = contig + "_NCR_{0}_{1}".format(gene[3] + 1, next_gene[2] - 1)
+                    extract = store.Fetch(contig, gene[3], next_gene[2] - 2)
+                outfile.write(">{0}\n{1}\n".format(extract_id, extract))
+                count = count + 1
+    store.Close()
+
+    # Return NCR file.
+    logging.info("PanGuess: Extracted {0} NCR sequences from {1}.".format(count, genome))
     return ncr
 
 
-def RunTransDecoder(ncr, tp_path, tl_path, workdir, genome, td_len):
+def RunTransDecoder(ncr, tp_path, tl_path, workdir, genome, td_len, shards=1, cores=None):
     """
-    Run the two TransDecoder commands via the command line.
+    Run the two TransDecoder commands via the command line, on the NCR file written by ExtractNCR.
+
+    If more than one shard is given, NCRs are split into that many size-balanced shards, each
+    run through TransDecoder in its own folder (at most cores at a time), and the outputs are merged
+    back into the TransDecoder directory (see MergeTransDecoderShards). Note TransDecoder.Predict
+    trains its coding model on each shard separately, so calls can differ slightly from an
+    unsharded run. Raises CalledProcessError if TransDecoder fails (on any shard).
     """
-    # Try to make a directory for TransDecoder. Might as well do it now.
+    # TransDecoder directory, made by ExtractNCR.
     tdir = "{0}/td/{1}/".format(workdir, genome)
-    TryMkDirs(tdir)
-
-    # Write NCRs to FASTA file
-    with open("{0}/NCR.fna".format(tdir), "w") as outfile:
-        for line in ncr:
-            outfile.write(line)
 
     # Run both TransDecoder processes sequentially.
-    sp.call([tl_path, "-t", "{0}/NCR.fna".format(tdir), "-m", "{0}".format(td_len)])
-    sp.call([tp_path, "-t", "{0}/NCR.fna".format(tdir), "--single_best_only"])
+    if shards <= 1:
+        sp.check_call([tl_path, "-t", ncr, "-m", "{0}".format(td_len)])
+        sp.check_call([tp_path, "-t", ncr, "--single_best_only"])
+
+    # Otherwise split NCRs into shards and run them in parallel.
+    else:
+        shard_folders = BuildNCRShards(ncr, tdir, shards)
+        tl_path, tp_path = [os.path.abspath(path) if os.sep in path else path for path in [tl_path, tp_path]]
+        logging.info("PanGuess: Running TransDecoder on {0} shards of non-coding regions.".format(len(shard_folders)))
+        processes = min(len(shard_folders), int(cores)) if cores else len(shard_folders)
+        farm = mp.Pool(processes=max(1, processes))
+        farm.map(TransDecoderCmdLine, [(tl_path, tp_path, td_len, shard) for shard in shard_folders])
+        farm.close()
+        farm.join()
+        MergeTransDecoderShards(tdir, shard_folders)
+
+    # Return the TransDecoder directory for MoveTransDecoderFiles.
+    return tdir
+
+
+def RunBuiltinORFCaller(ncr, workdir, genome, td_len):
+    """
+    Call the longest ORF in each NCR with the built-in ORF caller (see ORF module) instead of
+    TransDecoder. Output is written to the TransDecoder directory under TransDecoder's names.
+    """
+    # Imported here so that NumPy is only needed if the built-in ORF caller is used.
+    from ORF import CallORFs
+
+    # TransDecoder directory, made by ExtractNCR.
+    tdir = "{0}/td/{1}/".format(workdir, genome)
+    logging.info("PanGuess: Calling ORFs in non-coding regions with built-in ORF caller.")
+    CallORFs(ncr, int(td_len))
 
     # Return the TransDecoder directory for MoveTransDecoderFiles.
     return tdir
 
 
+def BuildNCRShards(ncr, tdir, shards):
+    """
+    Split NCRs into size-balanced shards for TransDecoder, handing them out longest-first to
+    whichever shard holds the fewest bases so far. Each shard is written to NCR.fna in its own
+    folder (<tdir>/shard_N) so output filenames match an unsharded run. Returns the shard folders
+    that have any NCRs in them.
+    """
+    # Clear out shards from previous runs.
+    for old_shard in glob("{0}/shard_*".format(tdir)):
+        shutil.rmtree(old_shard)
+
+    # Assign each NCR to the shard with the fewest bases so far.
+    ncr_db = FASTAIndex(ncr)
+    lengths = sorted(((len(ncr_db[seq][1]), seq) for seq in ncr_db), key=lambda x: (-x[0], x[1]))
+    heap = [(0, index) for index in range(shards)]
+    assigned = [[] for _ in range(shards)]
+    for length, seq in lengths:
+        bases, index = heappop(heap)
+        assigned[index].append(seq)
+        heappush(heap, (bases + length, index))
+
+    # Write out shards.
+    shard_folders = []
+    for index, shard in enumerate(assigned):
+        if shard:
+            shard_folder = os.path.abspath("{0}/shard_{1}".format(tdir, index))
+            TryMkDirs(shard_folder)
+            with open("{0}/NCR.fna".format(shard_folder), "w") as outfile:
+                WriteFASTA(outfile, ncr_db.Fetch(shard))
+            shard_folders.append(shard_folder)
+    ncr_db.Close()
+    return shard_folders
+
+
+def MergeTransDecoderShards(tdir, shard_folders):
+    """
+    Merge TransDecoder outputs (.gff3, .pep, .cds and .bed) of NCR shards into the TransDecoder
+    directory, as if TransDecoder had been run on all NCRs at once. GFF3 gene records stay
+    separated by blank lines, and only the first shard's BED track line is kept.
+    """
+    for ext in ["gff3", "pep", "cds", "bed"]:
+        with open("{0}/NCR.fna.transdecoder.{1}".format(tdir, ext), "w") as outfile:
+            blocks = []
+            for shard_folder in shard_folders:
+                shard_out = "{0}/NCR.fna.transdecoder.{1}".format(shard_folder, ext)
+                if not os.path.isfile(shard_out):
+                    continue
+                with open(shard_out) as infile:
+                    if ext == "bed" and blocks:
+                        infile.readline()
+                    block = infile.read().rstrip("\n")
+                if block:
+                    blocks.append(block)
+            if blocks:
+                outfile.write(("\n\n" if ext == "gff3" else "\n").join(blocks) + "\n")
+
+
 def MoveTransDecoderFiles(tdir):
     """
     Move all temporary TransDecoder files and folders to the TransDecoder directory.
@@ -353,71 +1149,43 @@ def MoveTransDecoderFiles(tdir):
 
 def TransDecoderGTFToAttributes(tdir, tag):
     """
-    Extract genomic attributes information from TransDecoder GTF file. A bit different
-    from our GeneMark GTF parser in that TransDecoder gene sections are seperated in
-    the latter GTF file by newline, which makes some things easier (and some things
-    harder).
-    
-    Note: sometimes TransDecoder will add comment lines into a GTF file, hence why we
-    have a check that a given line has the standard 9 columns.
+    Extract genomic attributes information from TransDecoder GFF3 file. TransDecoder calls
+    are made on NCRs, named in the format <contig>_NCR_<start>_<end> by ExtractNCR, so CDS
+    co-ordinates are moved back onto the contig.
+
+    Attributes don't need to be sorted, as they're only merged into the other calls.
     """
-    # Reader object and master lists/variables.
-    gtf = reader(open("{0}/NCR.fna.transdecoder.gff3".format(tdir)), delimiter="\t")
+    # Master list and regex for contig ID.
     attributes = []
-    locs = []
-    exon_count = 0
-    contig_id = ""
-    gene_id = ""
-    annotations = ""
     cregex = r"(.*)_NCR_"
 
-    # Pairwise loop, start extracting info if line in VALID GTF format.
-    for row, next_row in Pairwise(gtf):
-        if next_row is not None:
-            if row:
-                if len(row) == 9:
-                    contig_id = re.match(cregex, row[0]).group()[:-5]
-                    global_locs = map(int, row[0].split("_")[-2:])
-                    if row[2] == "exon":
-                        exon_count = exon_count + 1
-                    if row[2] == "CDS":
-                        relative_locs = map(int, row[3:5])
-                        start = global_locs[0] + relative_locs[0] - 1
-                        stop = global_locs[0] + relative_locs[1] - 1
-                        locs = [start, stop]
-                        gene_id = row[-1].split(";")[1].strip("Parent=")
-                        annotations = "TransDecoder={0};IS=False;Introns={1}".format(
-                            gene_id, exon_count - 1)
-
-                # Ignore comment line.
-                else:
-                    pass
+    # Stream genes from GFF3 file, skipping any without a CDS.
+    for gene in ParseGeneRecords("{0}/NCR.fna.transdecoder.gff3".format(tdir), "gff3"):
+        if not gene.cds:
+            continue
+        contig_id = re.match(cregex, gene.contig).group()[:-5]
+        global_locs = map(int, gene.contig.split("_")[-2:])
+        start = global_locs[0] + gene.cds[0] - 1
+        stop = global_locs[0] + gene.cds[1] - 1
+        annotations = "TransDecoder={0};IS=False;Introns={1}".format(gene.transcript_id, gene.exons - 1)
+        attributes.append([contig_id, gene.transcript_id, start, stop, annotations, tag])
 
-            # End of gene info, add attributes into master list and reset variables.
-            else:
-                attributes.append([contig_id, gene_id, min(locs), max(locs), annotations, tag])
-                locs = []
-                exon_count = 0
+    # Return TransDecoder attributes.
+    return attributes
 
-        # End of file.
-        else:
-            attributes.append([contig_id, gene_id, min(locs), max(locs), annotations, tag])
-            locs = []
-            exon_count = 0
 
-    # Return sorted TransDecoder attributes.
-    return sorted(attributes, key=lambda x: (x[0], int(x[2])))
-
-
-def ConstructGeneModelSets(attributes, exonerate_genes, workdir, genome, tag):
+def ConstructGeneModelSets(attributes, exonerate_genes, genemark_nucl, genemark_prot, workdir, genome, tag):
     """
-    Build completed gene model set for genome from our three sources.
+    Build completed gene model set for genome from our three sources. GeneMark-ES sequences
+    are given as dictionaries by ExtractGeneMarkSequences.
+
+    Gene models are renamed <tag>|<contig>_<start>_<end> (or <tag>|<Exonerate ID>), followed
+    by their original header so headers match those written by earlier versions.
     """
-    # Temporary gene/protein sets from GeneMark-ES and TransDecoder.
-    gm_prot_db = SeqIO.index("{0}/gmes/{1}/prot_seq.faa".format(workdir, genome), "fasta")
-    gm_nucl_db = SeqIO.index("{0}/gmes/{1}/nuc_seq.fna".format(workdir, genome), "fasta")
-    td_prot_db = SeqIO.index("{0}/td/{1}/NCR.fna.transdecoder.pep".format(workdir, genome), "fasta")
-    td_nucl_db = SeqIO.index("{0}/td/{1}/NCR.fna.transdecoder.cds".format(workdir, genome), "fasta")
+    # Temporary gene/protein sets from TransDecoder, and Exonerate genes by ID.
+    td_prot_db = FASTAIndex("{0}/td/{1}/NCR.fna.transdecoder.pep".format(workdir, genome))
+    td_nucl_db = FASTAIndex("{0}/td/{1}/NCR.fna.transdecoder.cds".format(workdir, genome))
+    exonerate_db = {gene.id: gene for gene in exonerate_genes or []}
 
     # Master lists.
     prot_models = []
@@ -427,42 +1195,36 @@ def ConstructGeneModelSets(attributes, exonerate_genes, workdir, genome, tag):
     sdir = "{0}/sets".format(workdir)
     TryMkDirs(sdir)
 
-
     # Loop over attributes, extract gene from given source based on parent method.
     for gene in attributes:
         if gene[4].startswith("TransDecoder"):
-            prot_seq = td_prot_db[gene[1]]
-            nucl_seq = td_nucl_db[gene[1]]
-            prot_seq.id = "{0}|{1}_{2}_{3}".format(tag, gene[0], gene[2], gene[3])
-            nucl_seq.id = prot_seq.id
-            gene[1] = prot_seq.id
-            prot_models.append(prot_seq)
-            nucl_models.append(nucl_seq)
+            gene_id = "{0}|{1}_{2}_{3}".format(tag, gene[0], gene[2], gene[3])
+            prot_header, prot_seq = td_prot_db[gene[1]]
+            nucl_header, nucl_seq = td_nucl_db[gene[1]]
         elif gene[4].startswith("GeneMark"):
-            prot_seq = gm_prot_db[gene[1]]
-            nucl_seq = gm_nucl_db[gene[1]]
-            prot_seq.id = "{0}|{1}_{2}_{3}".format(tag, gene[0], gene[2], gene[3])
-            nucl_seq.id = prot_seq.id
-            gene[1] = prot_seq.id
-            prot_models.append(prot_seq)
-            nucl_models.append(nucl_seq)
-        if gene[4].startswith("Exonerate"):
-            match = filter(lambda x: x.id == gene[1], exonerate_genes)
-            prot_seq = SeqRecord(Seq(match[0].prot), id=match[0].id)
-            nucl_seq = SeqRecord(Seq(match[0].nucl), id=match[0].id)
-            prot_seq.id = "{0}|{1}".format(tag, prot_seq.id)
-            nucl_seq.id = "{0}|{1}".format(tag, nucl_seq.id)
-            gene[1] = prot_seq.id
-            prot_models.append(prot_seq)
-            nucl_models.append(nucl_seq)
+            gene_id = "{0}|{1}_{2}_{3}".format(tag, gene[0], gene[2], gene[3])
+            prot_header, prot_seq = gene[1], genemark_prot[gene[1]]
+            nucl_header, nucl_seq = gene[1], genemark_nucl[gene[1]]
+        elif gene[4].startswith("Exonerate"):
+            match = exonerate_db[gene[1]]
+            gene_id = "{0}|{1}".format(tag, match.id)
+            prot_header, prot_seq = "<unknown description>", match.prot
+            nucl_header, nucl_seq = "<unknown description>", match.nucl
+        else:
+            continue
+        gene[1] = gene_id
+        prot_models.append(("{0} {1}".format(gene_id, prot_header), prot_seq))
+        nucl_models.append(("{0} {1}".format(gene_id, nucl_header), nucl_seq))
+    td_prot_db.Close()
+    td_nucl_db.Close()
 
     # Write protein sequences to file.
     with open("{0}/{1}.faa".format(sdir, tag), "w") as outpro:
-        SeqIO.write(prot_models, outpro, "fasta")
+        WriteFASTA(outpro, prot_models)
 
     # Write nucleotide sequences to file.
     with open("{0}/{1}.nucl".format(sdir, tag), "w") as outnuc:
-        SeqIO.write(nucl_models, outnuc, "fasta")
+        WriteFASTA(outnuc, nucl_models)
 
     # Write attributes to file.
     with open("{0}/{1}.attributes".format(sdir, tag), "w") as outatt:
@@ -470,20 +1232,75 @@ def ConstructGeneModelSets(attributes, exonerate_genes, workdir, genome, tag):
             outatt.write("\t".join(str(el) for el in line) + "\n")
 
 
-def TarballGenePredictionDirs(workdir, genome):
+def TarballGenePredictionDirs(workdir, genome, compressor="pigz", threads=1):
+    """
+    Compress temporary GeneMark-ES and TransDecoder folders into tar archives with a
+    multi-threaded compressor (pigz for .tar.gz or zstd for .tar.zst). Each folder is only
+    removed once its archive has been read back and lists every file in the folder.
     """
-    Compress temporary GeneMark-ES and Transdecoder folders into tar.gz files. VERY slow.
+    for folder in ["{0}/gmes/{1}".format(workdir, genome), "{0}/td/{1}".format(workdir, genome)]:
+        if not os.path.isdir(folder):
+            continue
+        try:
+            archive = TarballDir(folder, compressor, threads)
+        except OSError as e:
+            logging.warning("PanGuess: Could not run {0} ({1}).".format(compressor, e))
+            archive = None
+        if archive:
+            shutil.rmtree(folder)
+            logging.info("PanGuess: Compressed {0} into {1}.".format(folder, archive))
+        else:
+            logging.warning("PanGuess: Could not verify archive of {0}, keeping folder.".format(folder))
+            for partial in glob("{0}.tar.*".format(folder.rstrip("/"))):
+                os.remove(partial)
+
+
+def TarballDir(folder, compressor, threads):
     """
-    # Tarball genome's GeneMark-ES folder, remove uncompressed copy.
-    with tarfile.open("{0}/gmes/{1}.tar.gz".format(workdir, genome), "w:gz") as genemark_tar:
-        for root, dirs, files in os.walk("{0}/gmes/{1}".format(workdir, genome)):
-            for f in files:
-                genemark_tar.add(os.path.join(root, f))
-    shutil.rmtree("{0}/gmes/{1}".format(workdir, genome))
+    Tar and compress a folder alongside itself, piping tar through the compressor, then
+    verify the archive by decompressing and listing it. Compression runs at low priority
+    so it doesn't slow down gene model prediction running at the same time.
 
-    # Tarball genome's TransDecoder folder, remove uncompressed copy.
-    with tarfile.open("{0}/td/{1}.tar.gz".format(workdir, genome), "w:gz") as td_tar:
-        for root, dirs, files in os.walk("{0}/td/{1}".format(workdir, genome)):
-            for f in files:
-                td_tar.add(os.path.join(root, f))
-    shutil.rmtree("{0}/td/{1}".format(workdir, genome))
+    Returns the path of the archive, or None if it couldn't be verified.
+    """
+    folder = folder.rstrip("/")
+    parent, name = os.path.split(folder)
+    archive = "{0}.tar.{1}".format(folder, "zst" if compressor == "zstd" else "gz")
+    if compressor == "zstd":
+        compress = ["zstd", "-q", "-c", "-T{0}".format(threads)]
+    else:
+        compress = ["pigz", "-c", "-p", str(threads)]
+
+    # Compress folder.
+    with open(archive, "wb") as outfile:
+        tar = sp.Popen(["tar", "-cf", "-", "-C", parent or ".", name], stdout=sp.PIPE,
+                       preexec_fn=lambda: os.nice(10))
+        zipper = sp.Popen(compress, stdin=tar.stdout, stdout=outfile, preexec_fn=lambda: os.nice(10))
+        tar.stdout.close()
+        if zipper.wait() != 0 or tar.wait() != 0:
+            return None
+
+    # Verify that archive decompresses and holds every file in the folder.
+    expected = set()
+    for root, dirs, files in os.walk(folder):
+        for f in files:
+            expected.add(os.path.relpath(os.path.join(root, f), parent or "."))
+    unzipper = sp.Popen([compress[0], "-d", "-c", archive], stdout=sp.PIPE, preexec_fn=lambda: os.nice(10))
+    listing = sp.Popen(["tar", "-tf", "-"], stdin=unzipper.stdout, stdout=sp.PIPE)
+    unzipper.stdout.close()
+    archived = set(line.rstrip("\n").rstrip("/") for line in listing.stdout)
+    if listing.wait() != 0 or unzipper.wait() != 0 or not expected <= archived:
+        return None
+    return archive
+
+
+def TarballWorker(jobs, compressor, threads):
+    """
+    Compress temporary folders of finished genomes in the background (run as a thread), taking
+    (workdir, genome) pairs from a queue until it's given None.
+    """
+    for workdir, genome in iter(jobs.get, None):
+        try:
+            TarballGenePredictionDirs(workdir, genome, compressor, threads)
+        except (OSError, IOError) as e:
+            logging.warning("PanGuess: Compressing temporary folders of {0} failed ({1}).".format(genome, e))
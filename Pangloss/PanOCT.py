@@ -6,10 +6,12 @@ import subprocess as sp
 import sys
 from glob import glob
 
-from Bio import SeqIO, SearchIO
+from Bio import SearchIO
 
-from Tools import ConcatenateDatasets, ClusterMerge, Flatten, MultipleInsert, ParseMatchtable, \
-                  QueryClusterFirstHits, Reciprocal, TryMkDirs
+from ClusterArchive import ArchivePath, ClusterArchive, COMPONENTS, WriteClusterArchive
+from GeneModelStore import GeneModelStore
+from Tools import ClusterMerge, Flatten, GenomeTags, MultipleInsert, ParseMatchtable, QueryClusterFirstHits, \
+                  Reciprocal, TryMkDirs
 
 def RunPanOCT(fasta_db, attributes, blast, genome_list, **kwargs):
     """
@@ -123,69 +125,53 @@ def PanOCTOutputHandler():
                 os.remove(f)
 
 
-def GenerateClusterFASTAs(genomes, refined=False):
+def GenerateClusterFASTAs(genomes, sdir, refined=False):
     """
-    Extract gene model clusters from full database and write out nucleotide and protein sequence families to file.
+    Extract gene model clusters from the gene model store (in sdir) and write out nucleotide and protein sequence
+    families to file. Refined clusters are written as a diff against the unrefined clusters, so only clusters
+    changed by gap filling are extracted again.
     """
-    if not os.path.isfile("./gm_pred/sets/allnucl.db"):
-        ConcatenateDatasets(genomes)
-    elif not os.path.isfile("./gm_pred/sets/allprot.db"):
-        ConcatenateDatasets(genomes)
-    nt_index = SeqIO.index("./gm_pred/sets/allnucl.db", "fasta")
-    aa_index = SeqIO.index("./gm_pred/sets/allprot.db", "fasta")
-    fdir = "./panoct/clusters/"
-    matchtable = "./panoct/matchtable.txt"
-    TryMkDirs(fdir)
-    TryMkDirs("{0}/core/faa".format(fdir))
-    TryMkDirs("{0}/core/fna".format(fdir))
-    TryMkDirs("{0}/acc/faa".format(fdir))
-    TryMkDirs("{0}/acc/fna".format(fdir))
-
-    core, acc = ParseMatchtable(matchtable)
-
-    for cluster in core:
-        nt_seqs = [nt_index[member] for member in core[cluster]]
-        aa_seqs = [aa_index[member] for member in core[cluster]]
-        with open("{0}/core/fna/Core_{1}.fna".format(fdir, cluster), "w") as aa_out:
-            SeqIO.write(nt_seqs, aa_out, "fasta")
-
-        with open("{0}/core/faa/Core_{1}.faa".format(fdir, cluster), "w") as aa_out:
-            SeqIO.write(aa_seqs, aa_out, "fasta")
+    store = GeneModelStore(sdir)
+    store.Sync(GenomeTags(genomes))
+    WriteClusterFASTAs(store, "./panoct/matchtable.txt", "./panoct/clusters")
+    if refined:
+        WriteClusterFASTAs(store, "./panoct/refined_matchtable.txt", "./panoct/clusters/refined",
+                           "./panoct/matchtable.txt", "./panoct/clusters")
+    store.Close()
 
-    for cluster in acc:
-        nt_seqs = [nt_index[member] for member in acc[cluster] if member]
-        aa_seqs = [aa_index[member] for member in acc[cluster] if member]
-        with open("{0}/acc/fna/Acc_{1}.fna".format(fdir, cluster), "w") as aa_out:
-            SeqIO.write(nt_seqs, aa_out, "fasta")
 
-        with open("{0}/acc/faa/Acc_{1}.faa".format(fdir, cluster), "w") as aa_out:
-            SeqIO.write(aa_seqs, aa_out, "fasta")
+def WriteClusterFASTAs(store, matchtable, fdir, base_matchtable=None, base_fdir=None):
+    """
+    Write nucleotide and protein sequences of every core and accessory cluster in a matchtable to one
+    packed archive per component and sequence type (<fdir>/core.fna, <fdir>/core.faa, <fdir>/acc.fna and
+    <fdir>/acc.faa), with cluster IDs Core_<cluster> and Acc_<cluster>. If a base matchtable and its cluster
+    folder are given, clusters with the same members as a base cluster are shared with the base archives.
+    """
+    TryMkDirs(fdir)
+    core, acc = ParseMatchtable(matchtable)
 
-    if refined:
-        matchtable = "./panoct/refined_matchtable.txt"
-        rdir = "./panoct/clusters/refined"
-        TryMkDirs(rdir)
-        TryMkDirs("{0}/core/faa".format(rdir))
-        TryMkDirs("{0}/core/fna".format(rdir))
-        TryMkDirs("{0}/acc/faa".format(rdir))
-        TryMkDirs("{0}/acc/fna".format(rdir))
-
-        core, acc = ParseMatchtable(matchtable)
-
-        for cluster in core:
-            nt_seqs = [nt_index[member] for member in core[cluster]]
-            aa_seqs = [aa_index[member] for member in core[cluster]]
-            with open("{0}/core/fna/Core_{1}.fna".format(rdir, cluster), "w") as aa_out:
-                SeqIO.write(nt_seqs, aa_out, "fasta")
-
-            with open("{0}/core/faa/Core_{1}.faa".format(rdir, cluster), "w") as aa_out:
-                SeqIO.write(aa_seqs, aa_out, "fasta")
-
-        for cluster in acc:
-            nt_seqs = [nt_index[member] for member in acc[cluster] if member]
-            aa_seqs = [aa_index[member] for member in acc[cluster] if member]
-            with open("{0}/acc/fna/Acc_{1}.fna".format(rdir, cluster), "w") as aa_out:
-                SeqIO.write(nt_seqs, aa_out, "fasta")
-
-            with open("{0}/acc/faa/Acc_{1}.faa".format(rdir, cluster), "w") as aa_out:
-                SeqIO.write(aa_seqs, aa_out, "fasta")
\ No newline at end of file
+    # Map members of every base cluster to its cluster ID.
+    base_ids = {}
+    if base_matchtable:
+        base_core, base_acc = ParseMatchtable(base_matchtable)
+        for component, clusters in [("core", base_core), ("acc", base_acc)]:
+            for cluster in clusters:
+                base_ids[tuple(clusters[cluster])] = "{0}_{1}".format(COMPONENTS[component], cluster)
+
+    for component, clusters in [("core", core), ("acc", acc)]:
+        prefix = COMPONENTS[component]
+        order = sorted(clusters)
+        shared = dict((cluster, base_ids.get(tuple(clusters[cluster]))) for cluster in order)
+        for seq_type, store_type in [("fna", "nucl"), ("faa", "prot")]:
+            base = None
+            if base_fdir:
+                base = ClusterArchive(ArchivePath(base_fdir, component, seq_type))
+            records = (("{0}_{1}".format(prefix, cluster),
+                        shared[cluster] or store.Fetch([member for member in clusters[cluster] if member],
+                                                       store_type))
+                       for cluster in order)
+            count = WriteClusterArchive(ArchivePath(fdir, component, seq_type), records, base)
+            if base:
+                base.Close()
+        logging.info("PanOCT: Wrote {0} {1} clusters to {2} ({3} shared with {4}).".format(
+            count, component, fdir, len(order) - count, base_fdir))
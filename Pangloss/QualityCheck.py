@@ -15,16 +15,17 @@ import logging
 import multiprocessing as mp
 import os
 import shutil
-from csv import reader
 
-from Bio import SeqIO, SearchIO
+from Bio import SearchIO
 
-from Tools import MakeBLASTDBCmdLine, QCBLASTCmdLine, TryMkDirs
+from GeneModelStore import GeneModelStore
+from Tools import BLASTDBCurrent, MakeBLASTDBCmdLine, QCBLASTCmdLine, RecordBLASTDB, TryMkDirs
 
 
 def BuildMakeBLASTDBs(gene_sets, cores=None):
     """
-    Builds BLAST binary database for each strain in a dataset.
+    Builds BLAST binary database for each strain in a dataset, unless the strain's database was built from
+    the same gene model set before.
     """
     # If user doesn't specify cores in command line, just leave them with one free.
     logging.info("QualityCheck: Constructing QCBLAST databases using makeblastdb.")
@@ -34,16 +35,26 @@ def BuildMakeBLASTDBs(gene_sets, cores=None):
     # Holds makeblastdb commands.
     make_cmds = []
 
-    # Generate commands for every strain.
-    for strain in gene_sets:
+    # Generate commands for every strain with a new or changed gene model set.
+    stale = [strain for strain in gene_sets if not BLASTDBCurrent(strain, "{0}.db".format(strain))]
+    for strain in stale:
         cmd = ["makeblastdb", "-in", strain, "-dbtype", "prot", "-out", "{0}.db".format(strain)]
         make_cmds.append(cmd)
+    logging.info("QualityCheck: Reusing {0} unchanged QCBLAST databases.".format(len(gene_sets) - len(stale)))
 
     # Run simultaneous makeblastdb commands.
     logging.info("QualityCheck: Farming makeblastdb tasks to {0} threads.".format(cores))
     farm = mp.Pool(processes=int(cores))
-    farm.map(MakeBLASTDBCmdLine, make_cmds)
+    codes = farm.map(MakeBLASTDBCmdLine, make_cmds)
     farm.close()
+    farm.join()
+
+    # Only record databases that were built successfully, so failed ones are rebuilt next time.
+    for strain, code in zip(stale, codes):
+        if code == 0:
+            RecordBLASTDB(strain, "{0}.db".format(strain))
+        else:
+            logging.warning("QualityCheck: makeblastdb failed for {0} (exit code {1}).".format(strain, code))
     logging.info("QualityCheck: QCBLAST databases constructed.")
 
 
@@ -78,10 +89,11 @@ def QCBLAST(queries, sets, cores=None):
     return [SearchIO.parse(cStringIO.StringIO(blast), "blast-xml") for blast in blasts]
 
 
-def RemoveDubiousCalls(results, sets):
+def RemoveDubiousCalls(results, sets, sdir):
     """
-
-
+    Remove gene models with a QCBLAST top-hit covering >=70% of their length from their strain's gene
+    model set, keeping copies of the old files in <sdir>/old. Gene model sets are read from and written back
+    through the gene model store in sdir.
     """
     logging.info("QualityCheck: Filtering gene model sets for dubious calls.")
     # Master list for calls to remove.
@@ -99,43 +111,22 @@ def RemoveDubiousCalls(results, sets):
                     logging.info("QualityCheck: {0} has >=70% length overlap with {1}, assigning {0} as a"
                                  " dubious call.".format(query.hits[0].id, query.id))
 
-    # Remove flagged calls from nucleotide and protein sets, and genomic attributes file.
-    for path in sets:
-        genome = path.split("/")[-1]
-        tag = genome.split(".")[0]
+    # Remove flagged calls from nucleotide and protein sets, and genomic attributes file, through the
+    # gene model store (which writes the remaining calls back to each strain's files).
+    tags = [path.split("/")[-1].split(".")[0] for path in sets]
+    store = GeneModelStore(sdir)
+    store.Sync(tags)
+    for tag in tags:
         tr_strain = filter(lambda x: x.split("|")[0] == tag, to_remove)
         if tr_strain:
-            aa_path = "./gm_pred/sets/{0}.faa".format(tag)
-            nt_path = "./gm_pred/sets/{0}.nucl".format(tag)
-            at_path = "./gm_pred/sets/{0}.attributes".format(tag)
-            current_prot = list(SeqIO.parse(open(aa_path), "fasta"))
-            current_nucl = list(SeqIO.parse(open(nt_path), "fasta"))
-            current_att = list(reader(open(at_path), delimiter="\t"))
-            to_move = [aa_path, nt_path, at_path]
-            TryMkDirs("./gm_pred/sets/old/")
-
-            new_prot = filter(lambda x: x.id not in tr_strain, current_prot)
-            new_nucl = filter(lambda x: x.id not in tr_strain, current_nucl)
-            new_att = filter(lambda x: x[1] not in tr_strain, current_att)
-
-            logging.info("QualityCheck: Removed {0} dubious calls from {1},"
-                         " writing remaining calls to new files.".format(len(tr_strain), genome))
-
             logging.info("QualityCheck: Moving old calls.")
-            for f in to_move:
+            TryMkDirs("./gm_pred/sets/old/")
+            for f in store.Paths(tag):
                 shutil.copy(f, "./gm_pred/sets/old/")
 
-            # Write protein sequences to file.
-            with open(aa_path, "w") as outpro:
-                SeqIO.write(new_prot, outpro, "fasta")
-
-            # Write nucleotide sequences to file.
-            with open(nt_path, "w") as outnuc:
-                SeqIO.write(new_nucl, outnuc, "fasta")
-
-            # Write attributes to file.
-            with open(at_path, "w") as outatt:
-                for line in new_att:
-                    outatt.write("\t".join(str(el) for el in line) + "\n")
+            store.Delete(tr_strain)
+            logging.info("QualityCheck: Removed {0} dubious calls from {1},"
+                         " writing remaining calls to new files.".format(len(tr_strain), tag))
+    store.Close()
 
     logging.info("QualityCheck: Completed removal of dubious calls from all datasets.")
@@ -7,17 +7,26 @@ Functions imported explictly via "from Pangloss.Tools import <name>".
 
 from __future__ import division
 
-import cStringIO
 import datetime
+import hashlib
+import json
+import logging
 import os
+import shutil
 import subprocess as sp
+import threading
 from collections import Counter, OrderedDict as od
 from csv import reader
+from glob import glob
 from itertools import chain, izip_longest, tee
 
-from Bio import SeqIO, SeqRecord
+from Bio import SeqRecord
 
-from ExonerateGene import ExonerateGene
+from ExonerateGene import ParseExonerateOutput
+from FASTA import IsCompressed, OpenFile, WriteFASTA
+
+# Manifest of inputs that concatenated datasets and BLAST databases were built from.
+MANIFEST = "./gm_pred/sets/manifest.json"
 
 
 def TryMkDirs(path):
@@ -32,6 +41,76 @@ def TryMkDirs(path):
             raise
 
 
+def HashFile(path, block_size=1048576):
+    """
+    Return SHA-1 hex digest of a file's contents, read in blocks so large genomes aren't
+    held in memory.
+    """
+    sha = hashlib.sha1()
+    with open(path, "rb") as infile:
+        for block in iter(lambda: infile.read(block_size), ""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def StageInput(path, folder):
+    """
+    Return a path to an uncompressed copy of an input file for tools that can't read compressed
+    files. Uncompressed files are returned as they are, compressed files are decompressed into
+    folder once and only again if the compressed file is newer than the copy. Copies should be
+    removed with ReleaseInput once the tools are done with them, so compressed inputs are only
+    held uncompressed on disk while they're needed.
+    """
+    if not IsCompressed(path):
+        return path
+    staged = "{0}/{1}".format(folder, os.path.basename(path).rsplit(".", 1)[0])
+    if not os.path.isfile(staged) or os.path.getmtime(staged) < os.path.getmtime(path):
+        TryMkDirs(folder)
+        logging.info("StageInput: Decompressing {0} to {1}.".format(path, staged))
+        with OpenFile(path) as infile, open(staged + ".tmp", "wb") as outfile:
+            shutil.copyfileobj(infile, outfile, 1048576)
+        os.rename(staged + ".tmp", staged)
+    return staged
+
+
+def ReleaseInput(path, staged):
+    """
+    Remove an uncompressed copy of an input file made by StageInput (if one was made).
+    """
+    if staged != path and os.path.isfile(staged):
+        os.remove(staged)
+
+
+def CheckCallFASTA(cmd, records):
+    """
+    Run a command as sp.check_call would, writing (header, sequence) tuples to its stdin in FASTA
+    format, so that tools reading FASTA from stdin (given as "-") can be fed from any source without
+    writing a file first. Raises CalledProcessError if the command fails.
+    """
+    process = sp.Popen(cmd, stdin=sp.PIPE)
+    try:
+        WriteFASTA(process.stdin, records)
+    except IOError:
+        pass  # Command exited before reading all of its input, its return code says why.
+    finally:
+        process.stdin.close()
+    if process.wait() != 0:
+        raise sp.CalledProcessError(process.returncode, cmd)
+
+
+def LinkFile(src, dst):
+    """
+    Hard link a file to a new path (replacing any file there), or copy it if it can't be linked
+    (e.g. across filesystems).
+    """
+    if os.path.isfile(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
 def Pairwise(iterable):
     """
     Enables pairwise iteration. Taken from the Python Standard Library.
@@ -50,21 +129,40 @@ def Flatten(iterable):
     return list(chain.from_iterable(iterable))
 
 
-def ExonerateCmdLine(cmd):
+def JournalExonerateCmdLine(job):
     """
-    Carries out an exonerate command and return output as a ExonerateGene object.
+    Carries out an exonerate command with a (possibly multi-protein) query file, given as a
+    (command, timeout) pair. Output is parsed into ExonerateGene objects (one per query protein
+    with a hit) as it streams out of Exonerate. Commands running for longer than timeout (in
+    seconds, None for no timeout) are killed, results for query proteins finished before then
+    are kept.
 
-    If an exonerate command does not find a suitable homolog to the query gene
-    within the target genome (which is fine!), then the output will fail to be
-    passed as a ExonerateGene object correctly (which makes sense, as there's
-    no information to make an object from). As such, the contains check makes
-    sure only full exonerate hits are returned.
+    Returns the command alongside its results and whether it timed out, so they can be matched
+    up when results come back out of order.
     """
-    process = sp.check_output(cmd)
-    if "C4 Alignment:" in process:  # Empty results don't contain this line!
-        return ExonerateGene(cStringIO.StringIO(process))
-    else:
-        pass
+    cmd, timeout = job
+    process = sp.Popen(cmd, stdout=sp.PIPE)
+    timer = threading.Timer(timeout, process.kill) if timeout else None
+    if timer:
+        timer.start()
+    genes = list(ParseExonerateOutput(iter(process.stdout.readline, "")))
+    returncode = process.wait()
+    if timer:
+        timer.cancel()
+    if returncode > 0:
+        raise sp.CalledProcessError(returncode, cmd)
+    return cmd, genes, returncode < 0  # Killed processes have a negative return code.
+
+
+def TransDecoderCmdLine(job):
+    """
+    Runs TransDecoder.LongOrfs and TransDecoder.Predict on the NCR.fna file of a shard folder,
+    given as a (LongOrfs path, Predict path, minimum protein length, shard folder) tuple.
+    TransDecoder writes its output into the current directory, so both are run from the folder.
+    """
+    tl_path, tp_path, td_len, shard = job
+    sp.check_call([tl_path, "-t", "NCR.fna", "-m", "{0}".format(td_len)], cwd=shard)
+    sp.check_call([tp_path, "-t", "NCR.fna", "--single_best_only"], cwd=shard)
 
 
 def LocationOverlap(call, next_call):
@@ -89,20 +187,100 @@ def LocationOverlap(call, next_call):
             return call
 
 
-def ConcatenateDatasets(genomes):
+def GenomeTags(genomes):
     """
-    Concatenate all datasets and construct BLASTp database for gene model set.
+    Return strain tags of genomes listed in a genomes file (e.g. genomes/genomes.txt).
     """
-    # Generate cat commands for the three full datasets we have.
     tags = []
     for line in open(genomes):
         if "/" in line:
             tags.append(line.strip("\n").split(".")[0].split("/")[1])
         else:
             tags.append(line.strip("\n").split(".")[0])
+    return tags
+
+
+def ReadManifest(manifest):
+    """
+    Return contents of a manifest file (see ManifestCurrent), or an empty manifest if there isn't one.
+    """
+    if not os.path.isfile(manifest):
+        return {}
+    with open(manifest) as infile:
+        return json.load(infile)
+
+
+def FileStates(paths, previous=None):
+    """
+    Return dictionary of paths to [size, modification time, SHA-1 digest] of each file. Digests are
+    reused from a previous set of states for files whose size and modification time haven't changed.
+    """
+    previous = previous or {}
+    states = {}
+    for path in paths:
+        stat = os.stat(path)
+        state = previous.get(path)
+        if state and state[:2] == [stat.st_size, stat.st_mtime]:
+            states[path] = state
+        else:
+            states[path] = [stat.st_size, stat.st_mtime, HashFile(path)]
+    return states
+
+
+def ManifestCurrent(key, inputs, manifest=MANIFEST):
+    """
+    Return True if the outputs recorded under key in the manifest were built from inputs with the same
+    contents as now (by SHA-1 digest, in the same order), and are all still present and unchanged since.
+    Only inputs whose size or modification time have changed are hashed again.
+    """
+    entry = ReadManifest(manifest).get(key)
+    if not entry or entry["order"] != list(inputs):
+        return False
+    for path, (size, mtime) in entry["outputs"].iteritems():
+        if not os.path.isfile(path) or [os.path.getsize(path), os.path.getmtime(path)] != [size, mtime]:
+            return False
+    if not all(os.path.isfile(path) for path in inputs):
+        return False
+    states = FileStates(inputs, entry["inputs"])
+    if not all(states[path][2] == entry["inputs"][path][2] for path in inputs):
+        return False
+
+    # Inputs touched but not changed (e.g. copied from the prediction cache) don't need hashing again.
+    if states != entry["inputs"]:
+        RecordManifest(key, inputs, entry["outputs"].keys(), manifest)
+    return True
+
+
+def RecordManifest(key, inputs, outputs, manifest=MANIFEST):
+    """
+    Record in the manifest that outputs were built from inputs under key, with the current contents of
+    inputs and sizes and modification times of outputs.
+    """
+    contents = ReadManifest(manifest)
+    previous = contents.get(key, {}).get("inputs")
+    contents[key] = {"order": list(inputs), "inputs": FileStates(inputs, previous),
+                     "outputs": {path: [os.path.getsize(path), os.path.getmtime(path)] for path in outputs}}
+    TryMkDirs(os.path.dirname(manifest))
+    with open(manifest + ".tmp", "w") as outfile:
+        json.dump(contents, outfile, indent=1, sort_keys=True)
+    os.rename(manifest + ".tmp", manifest)
+
+
+def ConcatenateDatasets(genomes):
+    """
+    Concatenate all datasets and construct BLASTp database for gene model set. Skipped if the
+    concatenated files were built from the same per-strain files as now (see ManifestCurrent).
+    """
+    # Generate cat commands for the three full datasets we have.
+    tags = GenomeTags(genomes)
     nucl_cmd = ["cat"] + ["./gm_pred/sets/" + tag + ".nucl" for tag in tags]
     prot_cmd = ["cat"] + ["./gm_pred/sets/" + tag + ".faa" for tag in tags]
     att_cmd = ["cat"] + ["./gm_pred/sets/" + tag + ".attributes" for tag in tags]
+    inputs = nucl_cmd[1:] + prot_cmd[1:] + att_cmd[1:]
+    outputs = ["./gm_pred/sets/allnucl.db", "./gm_pred/sets/allprot.db", "./gm_pred/sets/allatt.db"]
+    if ManifestCurrent("concatenate", inputs):
+        logging.info("ConcatenateDatasets: Gene model sets unchanged, reusing concatenated datasets.")
+        return
 
     # Run commands.
     with open("./gm_pred/sets/allnucl.db", "w") as f:
@@ -111,13 +289,38 @@ def ConcatenateDatasets(genomes):
         sp.call(prot_cmd, stdout=f)
     with open("./gm_pred/sets/allatt.db", "w") as f:
         sp.call(att_cmd, stdout=f)
+    RecordManifest("concatenate", inputs, outputs)
+
+
+def BLASTDBFiles(db):
+    """
+    Return the files of a protein BLAST database, including the volumes of a multi-volume database
+    (<db>.00.pin &c.).
+    """
+    return sorted(glob("{0}.p*".format(db)) + glob("{0}.[0-9][0-9].p*".format(db)))
+
+
+def BLASTDBCurrent(fasta, db):
+    """
+    Return True if a protein BLAST database was built by makeblastdb from a FASTA file with the same
+    contents as now (see ManifestCurrent), and so can be reused.
+    """
+    return bool(BLASTDBFiles(db)) and ManifestCurrent("makeblastdb:" + db, [fasta])
+
+
+def RecordBLASTDB(fasta, db):
+    """
+    Record in the manifest that a protein BLAST database was built from a FASTA file. Only call this
+    once makeblastdb has finished successfully.
+    """
+    RecordManifest("makeblastdb:" + db, [fasta], BLASTDBFiles(db))
 
 
 def MakeBLASTDBCmdLine(cmd):
     """
-    Generalized function for running makeBLASTDB. Nothing fancy.
+    Generalized function for running makeBLASTDB. Returns makeblastdb's return code.
     """
-    sp.call(cmd)
+    return sp.call(cmd)
 
 
 def QCBLASTCmdLine(cmd):
@@ -146,6 +349,35 @@ def StringBLAST(query):
         pass
 
 
+def ChunkBLAST(job):
+    """
+    Runs BLASTp against the all-vs.-all database for a chunk of FASTA gene models in a single
+    process with several threads (job is a (queries, threads) tuple). The tabular output is split
+    back into one result per query, each ending in its own "# BLAST processed 1 queries" line, so
+    results are the same as running StringBLAST on every query. Queries without hits are dropped.
+    """
+    queries, threads = job
+    cmd = ['blastp', '-db', './gm_pred/sets/allprot.db', '-evalue', '0.0001', '-outfmt', '7',
+           '-num_threads', str(threads), '-query', "-"]
+    process = sp.Popen(cmd, stdin=sp.PIPE, stdout=sp.PIPE)
+    output = process.communicate("\n".join(queries))
+
+    # Each query's output starts with a program line (e.g. "# BLASTP 2.9.0+").
+    results = []
+    block = []
+    for line in output[0].split("\n"):
+        if not line or line.startswith("# BLAST processed"):
+            continue
+        if line.startswith("# BLASTP") and block:
+            results.append(block)
+            block = []
+        block.append(line)
+    if block:
+        results.append(block)
+    return ["\n".join(block) + "\n# BLAST processed 1 queries\n"
+            for block in results if "# 0 hits found" not in block]
+
+
 def ParseMatchtable(matchtable):
     """
     """
@@ -189,12 +421,12 @@ def ParseKaryotypes(karyotypes):
 
 def StringMUSCLE(ml_path, seqs):
     """
-    Runs a MUSCLE alignment given a valid set of translated nucleotides as stdin, returns
-    the alignment to stdout which is then processed within memory.
+    Runs a MUSCLE alignment given a valid set of translated nucleotides (as (header, sequence)
+    tuples) as stdin, returns the alignment to stdout which is then processed within memory.
     """
     cmd = [ml_path, "-quiet"]
     process = sp.Popen(cmd, stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE)
-    SeqIO.write(seqs, process.stdin, "fasta")
+    WriteFASTA(process.stdin, seqs)
     process.stdin.close()
     return process.stdout.read()
 
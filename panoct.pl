@@ -369,12 +369,10 @@ sub get_protein_info { #formerly get_fasta_headers.  Added calculation of protei
   my $sequence = "";
   my $length = "";
 
-  unless (open (PEPFILE, "<$pep_path/$pep_file") )  {
-    die ("can't open file $pep_path/$pep_file.\n");
-  }
+  my $pepfile = &open_input("$pep_path/$pep_file");
   my ($save_input_separator) = $/;
   $/="\n>";
-  while (<PEPFILE>) {
+  while (<$pepfile>) {
     ($title,$sequence) = /^>?\s*(.*)\n([^>]+)>?/; # split the header line and sequence (very cool)
     @line = split(/\s+/, $title);  # split the scalar $line on space or tab (to separate the identifier from the header and store in array @fasta
     $id = $line[0]; # unique orf identifier is in column 0, com_name is in rest
@@ -389,7 +387,7 @@ sub get_protein_info { #formerly get_fasta_headers.  Added calculation of protei
     $sequence = ""; #clear out the sequence for the next round.
   }
   $/ = $save_input_separator; # restore the input separator
-  close (PEPFILE);
+  close ($pepfile);
   return;
 }
 
@@ -405,10 +403,8 @@ sub get_gene_att {
     my $anno = "";
     my $failed = 0;
 
-    unless (open (ATTFILE, "<$basedir/$att_file") )  {
-	die ("ERROR: can not open file $basedir/$att_file.\n");
-    }
-    while (<ATTFILE>) {
+    my $attfile = &open_input("$basedir/$att_file");
+    while (<$attfile>) {
 	my @att_line = ();
 	chomp;
 	@att_line = split(/\t/, $_);  # split the scalar $line on tab
@@ -453,7 +449,7 @@ sub get_gene_att {
 	}
 	print STDERR "$feat_name $feat_hash{$feat_name}->{'header'} $feat_hash{$feat_name}->{'end5'} $feat_hash{$feat_name}->{'end3'} $feat_hash{$feat_name}->{'length'} $feat_hash{$feat_name}->{'orient'} $tag $asmbl_id\n" if ($DEBUG);
     }
-    close (ATTFILE);
+    close ($attfile);
 
     foreach my $feat_id (keys %feat_hash) {
 	if ($feat_id =~ /^CONTEXT[0-9]+:(.*)$/) {
@@ -551,6 +547,17 @@ sub rebuild_genome_hash {
     return;
 }
 
+sub open_input { # open an input file (BLAST results, protein FASTA, attributes) for reading, through gzip -dc if it is gzip/bgzip compressed (ends in .gz or .bgz)
+    my ($path) = @_;
+    my $fh;
+    if ($path =~ /\.b?gz$/) {
+	open ($fh, "-|", "gzip", "-dc", $path) || die ("ERROR: can't open file $path\n");
+    } else {
+	open ($fh, "<", $path) || die ("ERROR: can't open file $path\n");
+    }
+    return $fh;
+}
+
 sub select_max_scores_from_btab { # get tab-delimited BLAST results in either WUBLAST or NCBI -m8/-m9 formats
 ## new code - test for btab format (WUbtab or ncbi m8/m9)
 
@@ -561,7 +568,7 @@ sub select_max_scores_from_btab { # get tab-delimited BLAST results in either WU
     my $stag; # subject genome tag
     my $score = ""; # BLAST bit score
 
-    open (my $infile, "<", "$btabpath/$btabfile") || die ("ERROR: can't open file $btabpath/$btabfile\n");
+    my $infile = &open_input("$btabpath/$btabfile");
 
     # this while look is interrogate the file to determine which tabular output style it is
     while (<$infile>)  {
@@ -585,7 +592,7 @@ sub select_max_scores_from_btab { # get tab-delimited BLAST results in either WU
 	die ("ERROR:  BLAST data must be either WUBLAST btab or NCBI BLAST -m8 or -m9 formats.\n");
     }
     ### process BLAST results ###
-    open ($infile, "<", "$btabpath/$btabfile");
+    $infile = &open_input("$btabpath/$btabfile");
     while (<$infile>)  {
 	chomp;
 	@btab_line = split(/\t/);
@@ -659,10 +666,10 @@ sub select_data_from_btab { # get tab-delimited BLAST results in either WUBLAST
     my $qlength = ""; # size of query protein sequence
     my $slength = ""; # size of subject (database match) protein sequence
 
-    open (my $infile, "<", "$btabpath/$btabfile") || die ("ERROR: can't open file $btabpath/$btabfile\n");
+    my $infile = &open_input("$btabpath/$btabfile");
 
     ### process BLAST results ###
-    open ($infile, "<", "$btabpath/$btabfile");
+    $infile = &open_input("$btabpath/$btabfile");
     while (<$infile>)  {
 	chomp;
 	@btab_line = split(/\t/);
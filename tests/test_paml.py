@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for reuse of yn00 results across PanOCT runs (PAML.RunClusterYn00). MUSCLE and yn00 aren't run,
+their results are faked, so only which clusters get run (and which reuse earlier results) is tested.
+
+Run from the repository root with: python -m unittest discover tests
+"""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from Pangloss import PAML
+from Pangloss.PanOCT import WriteClusterFASTAs
+
+GENES = {"A|g1": "ATGAAA", "B|g1": "ATGAAG", "A|g2": "ATGCCC", "B|g2": "ATGCCA", "A|g3": "ATGTTT", "B|g3": "ATGTTC"}
+MATCHTABLE = ["A|g1\tB|g1", "A|g2\tB|g2", "A|g3\t----------", "----------\tB|g3"]
+# Gap filling merged the two accessory clusters.
+REFINED_MATCHTABLE = ["A|g1\tB|g1", "A|g2\tB|g2", "A|g3\tB|g3"]
+
+
+class FakeStore(object):
+    """
+    Stands in for GeneModelStore, with the same sequences for both sequence types.
+    """
+
+    def Fetch(self, members, store_type):
+        return [(member, GENES[member]) for member in members]
+
+
+class Yn00ReuseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        os.chdir(self.tmp)
+        os.makedirs("panoct/clusters")
+        self.runs = []
+        self.originals = (PAML.MUSCLEAlign, PAML.PutGaps, PAML.RunYn00)
+        PAML.MUSCLEAlign = lambda ml_path, seqs: None
+        PAML.PutGaps = self.FakePutGaps
+        PAML.RunYn00 = self.FakeRunYn00
+
+    def tearDown(self):
+        PAML.MUSCLEAlign, PAML.PutGaps, PAML.RunYn00 = self.originals
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def FakePutGaps(self, alignment, seqs, output):
+        with open(output, "w") as outfile:
+            outfile.write("".join(">{0}\n{1}\n".format(header, seq) for header, seq in seqs))
+        return output
+
+    def FakeRunYn00(self, yn_path, alignment):
+        self.runs.append(os.path.basename(alignment).split(".")[0])
+        shutil.copy(alignment, alignment + ".yn00")
+
+    def RunPanOCT(self, refined=False):
+        """
+        Write matchtables and cluster archives as a PanOCT run would, rewriting the unrefined archives.
+        """
+        with open("panoct/matchtable.txt", "w") as outfile:
+            outfile.write("\n".join(MATCHTABLE) + "\n")
+        WriteClusterFASTAs(FakeStore(), "panoct/matchtable.txt", "panoct/clusters")
+        if refined:
+            with open("panoct/refined_matchtable.txt", "w") as outfile:
+                outfile.write("\n".join(REFINED_MATCHTABLE) + "\n")
+            WriteClusterFASTAs(FakeStore(), "panoct/refined_matchtable.txt", "panoct/clusters/refined",
+                               "panoct/matchtable.txt", "panoct/clusters")
+
+    def testRefineReusesUnchangedClusters(self):
+        # --yn00, then --refine --yn00 (which runs PanOCT again).
+        self.RunPanOCT()
+        clusters, reused = PAML.RunClusterYn00("muscle", "yn00", "panoct/clusters")
+        self.assertEqual(sorted(self.runs), ["Acc_3", "Acc_4", "Core_1", "Core_2"])
+        self.assertEqual(reused, 0)
+
+        # Results are older than the archives PanOCT is about to rewrite, as they would be in a later run.
+        for name in os.listdir("panoct/clusters/yn00"):
+            past = time.time() - 100
+            os.utime("panoct/clusters/yn00/{0}".format(name), (past, past))
+        self.runs = []
+        self.RunPanOCT(refined=True)
+        clusters, reused = PAML.RunClusterYn00("muscle", "yn00", "panoct/clusters/refined")
+        self.assertEqual(self.runs, ["Core_3"])
+        self.assertEqual(reused, 2)
+        for cluster in ["Core_1", "Core_2"]:
+            base = os.stat("panoct/clusters/yn00/{0}.fna.aln.yn00".format(cluster))
+            refined = os.stat("panoct/clusters/refined/yn00/{0}.fna.aln.yn00".format(cluster))
+            self.assertEqual(base.st_ino, refined.st_ino)
+
+    def testRerunDropsStaleClusters(self):
+        self.RunPanOCT()
+        PAML.RunClusterYn00("muscle", "yn00", "panoct/clusters")
+
+        # PanOCT clusters the same genes differently, only unchanged clusters are reused.
+        self.runs = []
+        MATCHTABLE[2:] = ["A|g3\tB|g3"]
+        try:
+            self.RunPanOCT()
+            clusters, reused = PAML.RunClusterYn00("muscle", "yn00", "panoct/clusters")
+        finally:
+            MATCHTABLE[2:] = ["A|g3\t----------", "----------\tB|g3"]
+        self.assertEqual(self.runs, ["Core_3"])
+        self.assertEqual(reused, 2)
+        self.assertEqual(sorted(name for name in os.listdir("panoct/clusters/yn00") if name.endswith(".yn00")),
+                         ["Core_1.fna.aln.yn00", "Core_2.fna.aln.yn00", "Core_3.fna.aln.yn00"])
+
+
+if __name__ == "__main__":
+    unittest.main()